@@ -1,3 +1,4 @@
+from django import forms
 from django.contrib import admin
 
 from .models import Message, MessageAttachment, MessageItem, MessageTargetUser, MessageTargetCourse, MessageTargetGroup
@@ -40,9 +41,26 @@ class MessageAttachmentInline(admin.TabularInline):
     max_num = 0
 
 
+class MessageAdminForm(forms.ModelForm):
+    """
+    edits a message's body as it's shown, whether or not it's stored in the message body table (see MessageBody)
+    """
+
+    class Meta:
+        model = Message
+        exclude = ('shared_body',)
+
+    def __init__(self, *args, **kwargs):
+        super(MessageAdminForm, self).__init__(*args, **kwargs)
+        if self.instance.pk is not None:
+            self.initial['body'] = self.instance.get_body()
+
+
 class MessageAdmin(admin.ModelAdmin):
-    list_display = ('sender', 'subject', 'body', 'sent', 'is_notification',)
+    form = MessageAdminForm
+    list_display = ('sender', 'subject', 'message_body', 'sent', 'is_notification',)
     list_filter = ('sent', 'is_notification',)
+    list_select_related = ('user', 'shared_body',)
     search_fields = (
         'user__first_name',
         'user__last_name',
@@ -50,6 +68,7 @@ class MessageAdmin(admin.ModelAdmin):
         'user__email',
         'subject',
         'body',
+        'shared_body__body',
     )
     inlines = [
         MessageItemInline,
@@ -63,5 +82,15 @@ class MessageAdmin(admin.ModelAdmin):
         return obj.user
     sender.short_description = 'Sender'
 
+    def message_body(self, obj):
+        return obj.get_body()
+    message_body.short_description = 'Body'
+
+    def save_model(self, request, obj, form, change):
+        # the form's body replaces any stored body (and is stored again on saving, if bodies are deduplicated)
+        if obj.body or 'body' in form.changed_data:
+            obj.shared_body = None
+        super(MessageAdmin, self).save_model(request, obj, form, change)
+
 
 admin.site.register(Message, MessageAdmin)
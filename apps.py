@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class MessagingConfig(AppConfig):
+    name = 'messaging'
+    verbose_name = 'Messaging'
+
+    def ready(self):
+        # connect signal handlers
+        from . import signals  # noqa
@@ -0,0 +1,345 @@
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils.six import unichr
+from django.utils.translation import gettext as _
+
+from vle.models import CourseKVStore, GroupKVStore
+from .models import delimiter, tokenise, RecipientToken
+
+# cache keys of the change counter and of each change
+counter_key = 'messaging.autocomplete.counter'
+change_key = 'messaging.autocomplete.change.%d'
+
+# the (per process) index, which is never changed once it's in use (a refreshed copy replaces it), and a lock that
+# only lets one thread at a time build or refresh it
+_index = None
+_lock = threading.Lock()
+
+
+class RecipientIndex(object):
+    """
+    an in-memory index of users, groups and courses that answers token prefix queries (see tokenise) without the
+    database
+    tokens are kept in a sorted list (so that the tokens beginning with a prefix are a contiguous run, found by
+    bisection), each mapping to a tuple of the entities that have it (tuples being much smaller than sets)
+    an entity is a tuple of (kind, user id, course id, group id), like a row of the search query, and has the
+    (lowercase) fields it was tokenised from (see search._relevance)
+    an index is only changed (by build, update and remove) before it's in use, so that it can be matched by many
+    threads without a lock
+    """
+
+    def __init__(self, counter=0):
+        self.counter = counter
+        self.built = time.time()
+        self.tokens = []
+        self.token_entities = {}
+        self.entity_fields = {}
+        self.names = {}
+
+    def build(self, entries):
+        """
+        adds the given (iterable of) entries of (entity, name, fields) to an empty index
+        a name is the tuple of the parts that get_display_name formats
+        """
+        token_entities = {}
+        for (entity, name, fields) in entries:
+            self.names[entity] = name
+            self.entity_fields[entity] = fields = _normalise(fields)
+            for token in tokenise(*fields):
+                token_entities.setdefault(token, []).append(entity)
+        self.token_entities = dict((token, tuple(entities)) for (token, entities) in token_entities.items())
+        self.tokens = sorted(self.token_entities)
+
+    def copy(self):
+        """
+        gets a copy of the index that can be changed without changing this one (the tuples within are shared)
+        """
+        index = RecipientIndex(self.counter)
+        index.built = self.built
+        index.tokens = list(self.tokens)
+        index.token_entities = dict(self.token_entities)
+        index.entity_fields = dict(self.entity_fields)
+        index.names = dict(self.names)
+        return index
+
+    def update(self, entity, name, fields):
+        """
+        adds the given entity to the index (or replaces it), keeping the tokens sorted
+        """
+        self.remove(entity)
+        self.names[entity] = name
+        self.entity_fields[entity] = fields = _normalise(fields)
+        for token in tokenise(*fields):
+            entities = self.token_entities.get(token)
+            if entities is None:
+                self.tokens.insert(bisect_left(self.tokens, token), token)
+                entities = ()
+            self.token_entities[token] = entities + (entity,)
+
+    def remove(self, entity):
+        """
+        removes the given entity from the index (if it's there)
+        """
+        for token in tokenise(*self.entity_fields.pop(entity, ())):
+            entities = tuple(e for e in self.token_entities[token] if e != entity)
+            if entities:
+                self.token_entities[token] = entities
+            else:
+                del self.token_entities[token]
+                del self.tokens[bisect_left(self.tokens, token)]
+        self.names.pop(entity, None)
+
+    def match(self, q):
+        """
+        gets the set of entities that have, for each token of the given query, a token that begins with it
+        query tokens are matched in order of how many tokens begin with them, so that the intersection stays small
+        """
+        ranges = sorted([self._get_range(token) for token in tokenise(q)], key=lambda r: r[1] - r[0])
+        if not ranges:
+            return set(self.names)
+        matches = None
+        for (lo, hi) in ranges:
+            entities = set()
+            for token in self.tokens[lo:hi]:
+                entities.update(self.token_entities[token])
+            matches = entities if matches is None else matches & entities
+            if not matches:
+                break
+        return matches
+
+    def _get_range(self, prefix):
+        """
+        gets the (start, end) indexes of the run of tokens that begin with the given prefix (i.e. that sort between the
+        prefix and the prefix with its last character incremented)
+        """
+        successor = u''.join([prefix[:-1], unichr(ord(prefix[-1]) + 1)])
+        return bisect_left(self.tokens, prefix), bisect_left(self.tokens, successor)
+
+
+def search(q, exclude, user, per_page, page):
+    """
+    searches users, groups and courses as a super user (who can see everything) with the in-process index, in the
+    same way as search.search does with the database
+    """
+
+    # match and exclude entities
+    index = get_index()
+    excluded = _get_excluded_entities(exclude, user)
+    entities = [entity for entity in index.match(q) if entity not in excluded]
+
+    # sort by relevance, type and name (and then like search.search) and get one page
+    q = q.strip().lower()
+    results = sorted(
+        [(get_display_name(entity, index.names[entity]), entity) for entity in entities],
+        key=lambda result: (
+            get_relevance(q, index.entity_fields[result[1]]),
+            result[1][0],
+            result[0],
+            result[1][1] or 0,
+            result[1][2] or '',
+            result[1][3] or '',
+        )
+    )
+    index_from = per_page * page
+    index_to = index_from + per_page
+
+    return [
+        {
+            u'name': name,
+            u'id': delimiter.join([entity[2], entity[3]]) if entity[0] == RecipientToken.GROUP else entity[1] or entity[2],
+            u'type': {RecipientToken.USER: u'u', RecipientToken.GROUP: u'g', RecipientToken.COURSE: u'c'}[entity[0]],
+        }
+        for (name, entity) in results[index_from:index_to]
+    ], len(results)
+
+
+def get_display_name(entity, name):
+    """
+    formats the given name parts of the given entity in the same way as the search query
+    """
+    if entity[0] == RecipientToken.USER:
+        return u' '.join(name)
+    if entity[0] == RecipientToken.GROUP:
+        return u''.join([name[0], u' - ', name[1], u' (', _('Group'), u')'])
+    return u''.join([name[0], u' (', _('Module'), u')'])
+
+
+def get_relevance(q, fields):
+    """
+    ranks an entity with the given (lowercase) fields by how relevant it is to the given (lowercase) query, in the same
+    way as search._relevance
+    """
+    if not q or q in fields:
+        return 0
+    return 1 if any([field.startswith(q) for field in fields]) else 2
+
+
+def get_index():
+    """
+    gets this process's index, building it on first use (or when it's too old) and otherwise bringing it up to date
+    with the changes (see record_change) made since it was built
+    """
+    global _index
+
+    # if another thread is already bringing the index up to date, use the index as it is meanwhile (only waiting if
+    # there isn't one yet)
+    index = _index
+    if not _lock.acquire(index is None):
+        return index
+    try:
+        index = _index
+        counter = cache.get(counter_key, 0)
+        max_age = getattr(settings, 'MESSAGING_SEARCH_IN_PROCESS_INDEX_MAX_AGE', 300)
+        max_changes = getattr(settings, 'MESSAGING_SEARCH_IN_PROCESS_INDEX_MAX_CHANGES', 1000)
+
+        # get changes since the index was last brought up to date (if a change has expired, the index is rebuilt)
+        changes = None
+        if index is not None and index.counter <= counter <= index.counter + max_changes:
+            keys = [change_key % n for n in range(index.counter + 1, counter + 1)]
+            changes = cache.get_many(keys) if keys else {}
+            if len(changes) < len(keys):
+                changes = None
+
+        # build a new index, or refresh a copy of the index, then replace the index with it
+        if changes is None or time.time() - index.built > max_age:
+            index = RecipientIndex(counter)
+            index.build(_get_entries())
+            _index = index
+        elif changes:
+            index = _refresh(index, set(changes.values()))
+            index.counter = counter
+            _index = index
+        return index
+    finally:
+        _lock.release()
+
+
+def record_change(entity):
+    """
+    records that the given entity has changed, so that each process's index refreshes it
+    """
+    try:
+        n = cache.incr(counter_key)
+    except ValueError:
+        cache.add(counter_key, 0, None)
+        n = cache.incr(counter_key)
+    cache.set(change_key % n, entity, getattr(settings, 'MESSAGING_SEARCH_IN_PROCESS_INDEX_MAX_AGE', 300))
+
+
+def _normalise(fields):
+    """
+    lowercases the given fields
+    """
+    return tuple([field.lower() for field in fields])
+
+
+def _refresh(index, entities):
+    """
+    gets a copy of the given index with the given (changed) entities refreshed (leaving the given index as it is)
+    a course's name is part of the names of its groups, so a changed course refreshes its groups too
+    """
+    user_ids = [e[1] for e in entities if e[0] == RecipientToken.USER]
+    groups = [(e[2], e[3]) for e in entities if e[0] == RecipientToken.GROUP]
+    course_ids = [e[2] for e in entities if e[0] == RecipientToken.COURSE]
+    groups += GroupKVStore.objects.filter(vle_course_id__in=course_ids).values_list('vle_course_id', 'vle_group_id')
+
+    # get whatever still exists
+    entries = []
+    if user_ids:
+        entries += _get_user_entries(pk__in=user_ids)
+    for (vle_course_id, vle_group_id) in set(groups):
+        entries += _get_group_entries(vle_course_id=vle_course_id, vle_group_id=vle_group_id)
+    if course_ids:
+        entries += _get_course_entries(vle_course_id__in=course_ids)
+
+    # remove, then re-add it
+    index = index.copy()
+    for user_id in user_ids:
+        index.remove((RecipientToken.USER, user_id, None, None))
+    for (vle_course_id, vle_group_id) in groups:
+        index.remove((RecipientToken.GROUP, None, vle_course_id, vle_group_id))
+    for vle_course_id in course_ids:
+        index.remove((RecipientToken.COURSE, None, vle_course_id, None))
+    for (entity, name, fields) in entries:
+        index.update(entity, name, fields)
+    return index
+
+
+def _get_entries():
+    for entry in _get_user_entries():
+        yield entry
+    for entry in _get_group_entries():
+        yield entry
+    for entry in _get_course_entries():
+        yield entry
+
+
+def _get_user_entries(**filters):
+    users = get_user_model().objects.filter(**filters).values_list('id', 'first_name', 'last_name', 'username', 'email')
+    return [
+        (
+            (RecipientToken.USER, user_id, None, None),
+            (first_name, last_name),
+            (first_name, last_name, username, email, u' '.join([first_name, last_name])),
+        )
+        for (user_id, first_name, last_name, username, email) in users.iterator()
+    ]
+
+
+def _get_group_entries(**filters):
+    groups = list(GroupKVStore.objects.filter(**filters).values_list('vle_course_id', 'vle_group_id', 'name'))
+    course_names = _get_course_names(vle_course_id__in=set([group[0] for group in groups])) if filters else _get_course_names()
+    return [
+        (
+            (RecipientToken.GROUP, None, vle_course_id, vle_group_id),
+            (course_names.get(vle_course_id, u''), name),
+            (vle_course_id, vle_group_id, name),
+        )
+        for (vle_course_id, vle_group_id, name) in groups
+    ]
+
+
+def _get_course_entries(**filters):
+    """
+    gets one entry per course, like the search query: named by the course's greatest name, and with the fields of all
+    of its rows
+    """
+    course_names = {}
+    for (vle_course_id, name) in CourseKVStore.objects.filter(**filters).values_list('vle_course_id', 'name'):
+        course_names.setdefault(vle_course_id, set()).add(name)
+    return [
+        ((RecipientToken.COURSE, None, vle_course_id, None), (max(names),), (vle_course_id,) + tuple(sorted(names)))
+        for (vle_course_id, names) in course_names.items()
+    ]
+
+
+def _get_course_names(**filters):
+    """
+    gets a map of course id to course name (the greatest, if a course has more than one row, like the search query)
+    """
+    course_names = {}
+    for (vle_course_id, name) in CourseKVStore.objects.filter(**filters).values_list('vle_course_id', 'name'):
+        course_names[vle_course_id] = max(name, course_names.get(vle_course_id, name))
+    return course_names
+
+
+def _get_excluded_entities(exclude, user):
+    """
+    gets the set of entities excluded from a search by the given user (including the given user themself)
+    """
+    excluded = set([(RecipientToken.USER, user.id, None, None)])
+    for r in exclude:
+        if not r.get('id', ''):
+            continue
+        if r.get('type', '') == u'u':
+            excluded.add((RecipientToken.USER, int(r.get('id')), None, None))
+        elif r.get('type', '') == u'g' and len(r.get('id').split(delimiter)) == 2:
+            excluded.add((RecipientToken.GROUP, None) + tuple(r.get('id').split(delimiter)))
+        elif r.get('type', '') == u'c':
+            excluded.add((RecipientToken.COURSE, None, r.get('id'), None))
+    return excluded
@@ -0,0 +1,52 @@
+"""
+measures the memory footprint and prefix lookup latency of the in-process recipient index (see autocomplete) at 100k
+entities, without the database
+run with: py.test messaging/benchmarks/bench_autocomplete.py -s
+"""
+
+import random
+import timeit
+import tracemalloc
+
+from messaging.autocomplete import RecipientIndex
+from messaging.models import RecipientToken
+
+USERS = 90000
+GROUPS = 8000
+COURSES = 2000
+
+SYLLABLES = ['an', 'ar', 'bel', 'cer', 'dan', 'el', 'is', 'ja', 'kev', 'lan', 'mor', 'ny', 'or', 'ric', 'sa', 'ty', 'win']
+
+
+def _word(r):
+    return ''.join(r.choice(SYLLABLES) for _ in range(0, r.randint(2, 4))).capitalize()
+
+
+def _entries():
+    r = random.Random(0)
+    for i in range(0, USERS):
+        (first_name, last_name) = (_word(r), _word(r))
+        username = '%s.%s%d' % (first_name.lower(), last_name.lower(), i)
+        email = '%s@into.uk.com' % username
+        full_name = ' '.join([first_name, last_name])
+        yield (RecipientToken.USER, i, None, None), (first_name, last_name), (first_name, last_name, username, email, full_name)
+    for i in range(0, GROUPS):
+        (vle_course_id, vle_group_id, name) = ('c%d' % (i % COURSES), 'g%d' % i, '%s Group' % _word(r))
+        yield (RecipientToken.GROUP, None, vle_course_id, vle_group_id), (u'', name), (vle_course_id, vle_group_id, name)
+    for i in range(0, COURSES):
+        (vle_course_id, name) = ('c%d' % i, '%s Studies' % _word(r))
+        yield (RecipientToken.COURSE, None, vle_course_id, None), (name,), (vle_course_id, name)
+
+
+def test_memory_and_latency():
+    entries = list(_entries())
+    tracemalloc.start()
+    index = RecipientIndex()
+    index.build(entries)
+    (current, _peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('\n%d entities, %d tokens: %.1f MB' % (len(index.names), len(index.tokens), current / 1024.0 / 1024.0))
+
+    for q in ['t', 'ty', 'tywin', 'lan ty', 'c12', 'nothing']:
+        t = timeit.timeit(lambda: index.match(q), number=100)
+        print('%r: %d matches in %.1f us' % (q, len(index.match(q)), t * 10000))
@@ -0,0 +1,27 @@
+"""
+compares the cost of serialising a page of thread messages when bodies are rendered on every read with the cost when
+bodies are rendered once at write time
+run with: py.test messaging/benchmarks/bench_body_html.py -s
+"""
+
+import json
+import timeit
+
+from messaging.models import render_body_html
+
+
+def _bodies(n=100, paragraphs=20):
+    paragraph = u'Please read chapters 3 & 4 before <Thursday>\'s seminar and bring "your notes".'
+    return [u'\n\n'.join([paragraph] * paragraphs) for _ in range(0, n)]
+
+
+def test_serialise_rendered_on_read():
+    bodies = _bodies()
+    t = timeit.timeit(lambda: json.dumps([{u'body': render_body_html(b)} for b in bodies]), number=100)
+    print('\nrendered on read: %.3f ms per 100-message page' % (t * 10))
+
+
+def test_serialise_precomputed():
+    bodies_html = [render_body_html(b) for b in _bodies()]
+    t = timeit.timeit(lambda: json.dumps([{u'body': b} for b in bodies_html]), number=100)
+    print('\nprecomputed: %.3f ms per 100-message page' % (t * 10))
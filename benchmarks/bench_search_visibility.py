@@ -0,0 +1,71 @@
+"""
+compares the cost of searching for recipients as a tutor who can see every other tutor when visibility is resolved
+by pulling visible user ids into Python (and sending them back as a pk__in list) with the cost when visibility is
+resolved within the search query itself (an EXISTS subquery) and with the cost when (cached) visible user ids are
+inlined into the search query
+run with: py.test messaging/benchmarks/bench_search_visibility.py -s
+"""
+
+import timeit
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test.utils import override_settings
+from django.utils.six import StringIO
+
+import pytest
+
+from vle.models import CourseMember
+from messaging.search import search, _get_visible_user_ids, _get_visible_tutor_ids
+
+# kept below SQLite's default limit on the number of query parameters, which the pk__in list would otherwise exceed
+TUTORS = 900
+
+
+def _tutors():
+    get_user_model().objects.bulk_create([
+        get_user_model()(username='tutor.%d' % i, first_name='Tutor', last_name='%d' % i, email='tutor.%d@into.uk.com' % i)
+        for i in range(0, TUTORS)
+    ])
+    users = list(get_user_model().objects.filter(username__startswith='tutor.'))
+    CourseMember.objects.bulk_create([
+        CourseMember(user=u, vle_course_id='c%d' % i, is_tutor=True)
+        for (i, u) in enumerate(users)
+    ])
+    call_command('messaging_rebuild_recipient_index', stdout=StringIO())
+    return users[0]
+
+
+def _search_with_visible_ids(user):
+    visible_user_ids = _get_visible_user_ids(user) + _get_visible_tutor_ids(user)
+    users = get_user_model().objects.filter(first_name__icontains='tutor', pk__in=visible_user_ids).exclude(pk=user.pk)
+    return sorted([u' '.join([u.first_name, u.last_name]) for u in users])[0:10], users.count()
+
+
+@pytest.mark.django_db
+def test_search_with_visible_ids():
+    user = _tutors()
+    assert search(q='tutor', user=user)[1] == _search_with_visible_ids(user)[1] == TUTORS - 1
+    t = timeit.timeit(lambda: _search_with_visible_ids(user), number=20)
+    print('\nvisible ids in Python: %.3f ms per search' % (t * 50))
+
+
+@pytest.mark.django_db
+def test_search_with_visibility_in_query():
+    cache.clear()
+    user = _tutors()
+    with override_settings(MESSAGING_SEARCH_VISIBLE_USER_IDS_MAX=0):
+        assert search(q='tutor', user=user)[1] == TUTORS - 1
+        t = timeit.timeit(lambda: search(q='tutor', user=user), number=20)
+    print('\nvisibility in query: %.3f ms per search' % (t * 50))
+
+
+@pytest.mark.django_db
+def test_search_with_cached_visible_ids():
+    cache.clear()
+    user = _tutors()
+    with override_settings(MESSAGING_SEARCH_VISIBLE_USER_IDS_MAX=TUTORS):
+        assert search(q='tutor', user=user)[1] == TUTORS - 1
+        t = timeit.timeit(lambda: search(q='tutor', user=user), number=20)
+    print('\ncached visible ids in query: %.3f ms per search' % (t * 50))
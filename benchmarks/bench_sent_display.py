@@ -0,0 +1,39 @@
+"""
+compares the cost of formatting the sent datetimes of a page of messages one message at a time (getting the date today
+and the time zone for every message) with the cost of formatting them with one formatter per page
+run with: py.test messaging/benchmarks/bench_sent_display.py -s
+"""
+
+import timeit
+from datetime import timedelta
+
+from django.utils import timezone
+
+from messaging.models import format_sent_display, SentDisplayFormatter
+
+
+def _sents(n=100):
+    now = timezone.now()
+    return [now - timedelta(hours=i * 7) for i in range(0, n)]
+
+
+def test_format_each():
+    sents = _sents()
+    t = timeit.timeit(lambda: [format_sent_display(sent) for sent in sents], number=100)
+    print('\nformatted one at a time: %.3f ms per 100-message page' % (t * 10))
+
+
+def test_format_with_formatter():
+    sents = _sents()
+
+    def f():
+        formatter = SentDisplayFormatter()
+        return [formatter.format(sent) for sent in sents]
+    t = timeit.timeit(f, number=100)
+    print('\nformatted with a formatter: %.3f ms per 100-message page' % (t * 10))
+
+
+def test_format_all():
+    sents = _sents()
+    t = timeit.timeit(lambda: SentDisplayFormatter().format_all(sents), number=100)
+    print('\nformatted all at once: %.3f ms per 100-message page' % (t * 10))
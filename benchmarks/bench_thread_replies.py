@@ -0,0 +1,58 @@
+"""
+compares reply throughput of the mptt and path thread models (see MESSAGING_THREAD_MODEL) with concurrent repliers
+in one hot thread
+this is only meaningful against a database that supports concurrent writers (i.e. not SQLite)
+run with: py.test messaging/benchmarks/bench_thread_replies.py -s
+"""
+
+import random
+import threading
+import time
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import override_settings
+
+import pytest
+
+from messaging.models import Message
+
+REPLIERS = 8
+REPLIES_PER_REPLIER = 50
+
+
+def _reply(sender, message_ids, errors):
+    try:
+        for _ in range(0, REPLIES_PER_REPLIER):
+            parent = Message.objects.get(pk=random.choice(message_ids))
+            reply = Message.objects.create(user=sender, subject=parent.subject, body='Reply', parent=parent)
+            message_ids.append(reply.pk)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        connection.close()
+
+
+def _throughput(thread_model):
+    with override_settings(MESSAGING_THREAD_MODEL=thread_model):
+        sender = get_user_model().objects.create_user(username='sender.%s' % thread_model, password='Wibble123!')
+        root = Message.objects.create(user=sender, subject='Hot thread', body='')
+        message_ids = [root.pk]
+        errors = []
+        threads = [threading.Thread(target=_reply, args=(sender, message_ids, errors)) for _ in range(0, REPLIERS)]
+        t0 = time.time()
+        list(map(lambda t: t.start(), threads))
+        list(map(lambda t: t.join(), threads))
+        elapsed = time.time() - t0
+    replies = Message.objects.filter(tree_id=root.tree_id, parent__isnull=False).count()
+    print('\n%s: %d replies in %.2fs (%.1f replies/s), %d errors' % (thread_model, replies, elapsed, replies / elapsed, len(errors)))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_mptt_reply_throughput():
+    _throughput('mptt')
+
+
+@pytest.mark.django_db(transaction=True)
+def test_path_reply_throughput():
+    _throughput('path')
@@ -0,0 +1,103 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from messaging.models import (
+    Message,
+    MessageAttachment,
+    MessageItem,
+    MessageTargetUser,
+    MessageTargetCourse,
+    MessageTargetGroup,
+    ArchivedMessage,
+    ArchivedMessageAttachment,
+    ArchivedMessageItem,
+    ArchivedMessageTargetUser,
+    ArchivedMessageTargetCourse,
+    ArchivedMessageTargetGroup,
+)
+
+# pairs of (hot, archive) models, in the order in which rows are copied
+archive_models = (
+    (Message, ArchivedMessage),
+    (MessageItem, ArchivedMessageItem),
+    (MessageTargetUser, ArchivedMessageTargetUser),
+    (MessageTargetCourse, ArchivedMessageTargetCourse),
+    (MessageTargetGroup, ArchivedMessageTargetGroup),
+    (MessageAttachment, ArchivedMessageAttachment),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves threads whose latest message was sent more than the given number of days ago out of the message tables '
+        'and into the archive tables (which have the same columns). '
+        'Works in small batches of threads (each in a transaction, sleeping in between), and can be stopped and rerun.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=365, help='Archive threads with no messages in this many days')
+        parser.add_argument('--batch-size', type=int, default=100, help='Number of threads per batch')
+        parser.add_argument('--sleep', type=float, default=0.5, help='Number of seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        batch_size = options['batch_size']
+        sleep = options['sleep']
+
+        total = 0
+        last_tree_id = -1
+        while True:
+            tree_ids = self._get_stale_tree_ids(cutoff, last_tree_id, batch_size)
+            if not tree_ids:
+                break
+            with transaction.atomic():
+                self._archive_threads(tree_ids)
+            last_tree_id = tree_ids[-1]
+            total += len(tree_ids)
+            self.stdout.write('Archived %d threads (up to tree id %d)' % (total, last_tree_id))
+            time.sleep(sleep)
+        self.stdout.write('Done, archived %d threads' % total)
+
+    def _get_stale_tree_ids(self, cutoff, last_tree_id, batch_size):
+        """
+        gets (up to batch size) ids of (message, not notification) threads after the given tree id whose latest
+        message was sent before the cutoff
+        """
+        sql = """
+            SELECT m.tree_id
+            FROM messaging_message m
+            WHERE m.tree_id > %s
+                AND m.is_notification = %s
+            GROUP BY m.tree_id
+            HAVING MAX(m.sent) < %s
+            ORDER BY m.tree_id
+            LIMIT %s
+        """
+        cursor = connection.cursor()
+        cursor.execute(sql, [last_tree_id, False, cutoff, batch_size])
+        return [t[0] for t in cursor.fetchall()]
+
+    def _archive_threads(self, tree_ids):
+        """
+        copies the messages in the given threads (along with their items, targets and attachments) into the archive
+        tables with INSERT ... SELECT, then deletes them (deepest first) from the message tables
+        attachment files are left where they are, since archived attachments refer to them
+        """
+        cursor = connection.cursor()
+        in_tree_ids = '(%s)' % ','.join(str(tree_id) for tree_id in tree_ids)
+        for (model, archive_model) in archive_models:
+            columns = ', '.join(connection.ops.quote_name(f.column) for f in archive_model._meta.concrete_fields)
+            if model is Message:
+                where = 'tree_id IN %s' % in_tree_ids
+            else:
+                where = 'message_id IN (SELECT id FROM messaging_message WHERE tree_id IN %s)' % in_tree_ids
+            cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s WHERE %s' % (
+                archive_model._meta.db_table, columns, columns, model._meta.db_table, where,
+            ))
+        levels = Message.objects.filter(tree_id__in=tree_ids).order_by('-level').values_list('level', flat=True).distinct()
+        for level in list(levels):
+            Message.objects.filter(tree_id__in=tree_ids, level=level).delete()
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from messaging.models import Message, render_body_html
+
+
+class Command(BaseCommand):
+    help = 'Renders the HTML body of messages sent before bodies were rendered at write time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of messages to render per batch')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = 0
+        total = 0
+
+        # walk the messages in primary key order, one batch at a time, so the command can be stopped and rerun
+        while True:
+            batch = list(
+                Message.objects.filter(pk__gt=last_id, is_notification=False, body_html='').exclude(body='')
+                .order_by('pk').values_list('pk', 'body')[:batch_size]
+            )
+            if not batch:
+                break
+            for (pk, body) in batch:
+                Message.objects.filter(pk=pk).update(body_html=render_body_html(body))
+            last_id = batch[-1][0]
+            total += len(batch)
+            self.stdout.write('Rendered %d messages (up to id %d)' % (total, last_id))
+
+        self.stdout.write('Done, rendered %d messages' % total)
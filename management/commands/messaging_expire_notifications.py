@@ -0,0 +1,59 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from messaging.models import Message, MessageBody, MessageItem
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes notifications (and their message items) that have expired, then deletes stored message bodies that no '
+        '(archived) message has any more. '
+        'Works in small batches (sleeping in between) so it never holds long locks, and can be stopped and rerun.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of notifications (or items) per batch')
+        parser.add_argument('--sleep', type=float, default=0.5, help='Number of seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        batch_size = options['batch_size']
+        sleep = options['sleep']
+
+        # delete expired notifications, their message items first (in batches, since a notification may have many)
+        total = 0
+        items = 0
+        while True:
+            expired = Message.objects.filter(is_notification=True, expires__lt=now)
+            ids = list(expired.order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            while True:
+                item_ids = list(MessageItem.objects.filter(message_id__in=ids).values_list('pk', flat=True)[:batch_size])
+                if not item_ids:
+                    break
+                MessageItem.objects.filter(pk__in=item_ids).delete()
+                items += len(item_ids)
+                time.sleep(sleep)
+            Message.objects.filter(pk__in=ids).delete()
+            total += len(ids)
+            self.stdout.write('Expired %d notifications and %d message items (up to id %d)' % (total, items, ids[-1]))
+            time.sleep(sleep)
+        self.stdout.write('Done, expired %d notifications and %d message items' % (total, items))
+
+        # delete stored bodies (see MessageBody) that no message or archived message has any more
+        total = 0
+        last_id = 0
+        while True:
+            unused = MessageBody.objects.filter(pk__gt=last_id, message=None, archivedmessage=None)
+            ids = list(unused.order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            MessageBody.objects.filter(pk__in=ids, message=None, archivedmessage=None).delete()
+            last_id = ids[-1]
+            total += len(ids)
+            self.stdout.write('Deleted %d message bodies (up to id %d)' % (total, last_id))
+            time.sleep(sleep)
+        self.stdout.write('Done, deleted %d message bodies' % total)
@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand
+
+from messaging.models import Message, path_delimiter
+
+
+class Command(BaseCommand):
+    help = (
+        'Migrates message threads between thread models (see MESSAGING_THREAD_MODEL). '
+        'By default, gives replies sent under the mptt thread model their materialised path, which must be done '
+        'before switching to the path thread model. '
+        'With --rebuild-trees, renumbers the nested sets of threads that have had replies under the path thread model, '
+        'which must be done before switching back to the mptt thread model.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of messages to update per batch')
+        parser.add_argument('--rebuild-trees', action='store_true', default=False, help='Rebuild nested sets instead')
+
+    def handle(self, *args, **options):
+        if options['rebuild_trees']:
+            self._rebuild_trees()
+        else:
+            self._backfill_paths(options['batch_size'])
+
+    def _backfill_paths(self, batch_size):
+        """
+        walks replies level by level (so that a parent's path is always set before its children's) in batches
+        every reply's path is recomputed (not only empty ones), since a reply sent to a reply that hadn't been
+        backfilled yet was given a path that's missing its parent's ancestors
+        """
+        total = 0
+        level = 1
+        while Message.objects.filter(level=level).exists():
+            last_id = 0
+            while True:
+                batch = list(
+                    Message.objects.filter(level=level, pk__gt=last_id)
+                    .order_by('pk').values_list('pk', 'parent_id', 'path')[:batch_size]
+                )
+                if not batch:
+                    break
+                parent_paths = dict(Message.objects.filter(pk__in=set(p[1] for p in batch)).values_list('pk', 'path'))
+                for (pk, parent_id, old_path) in batch:
+                    path = ''.join([parent_paths[parent_id], str(parent_id), path_delimiter])
+                    if path != old_path:
+                        Message.objects.filter(pk=pk).update(path=path)
+                        total += 1
+                last_id = batch[-1][0]
+            level += 1
+        self.stdout.write('Done, set the path of %d messages' % total)
+
+    def _rebuild_trees(self):
+        """
+        rebuilds the nested set of each thread that contains a reply without one (which keeps the thread's tree_id)
+        """
+        tree_ids = Message.objects.filter(lft=0).order_by('tree_id').values_list('tree_id', flat=True).distinct()
+        tree_ids = list(tree_ids)
+        for tree_id in tree_ids:
+            Message.objects.partial_rebuild(tree_id)
+        self.stdout.write('Done, rebuilt %d threads' % len(tree_ids))
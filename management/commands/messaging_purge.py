@@ -0,0 +1,97 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from messaging.models import Message, MessageAttachment, MessageItem
+
+
+class Command(BaseCommand):
+    help = (
+        'Hard-deletes message items that were (soft-)deleted more than the given number of days ago, then deletes '
+        'threads (messages, their targets and their attachments) that have no message items left and that have had no '
+        'messages sent in that many days. '
+        'Works in small batches (sleeping in between) so it never holds long locks, and can be stopped and rerun.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90, help='Purge items deleted more than this many days ago')
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of items (or threads) per batch')
+        parser.add_argument('--sleep', type=float, default=0.5, help='Number of seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        batch_size = options['batch_size']
+        sleep = options['sleep']
+
+        # hard-delete message items that were deleted before the cutoff
+        total = 0
+        while True:
+            ids = list(MessageItem.objects.filter(deleted__lt=cutoff).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            MessageItem.objects.filter(pk__in=ids).delete()
+            total += len(ids)
+            self.stdout.write('Purged %d message items (up to id %d)' % (total, ids[-1]))
+            time.sleep(sleep)
+        self.stdout.write('Done, purged %d message items' % total)
+
+        # delete threads that have no message items left (and no recent messages)
+        total = 0
+        last_tree_id = -1
+        while True:
+            tree_ids = self._get_orphaned_tree_ids(cutoff, last_tree_id, batch_size)
+            if not tree_ids:
+                break
+            self._delete_threads(tree_ids)
+            last_tree_id = tree_ids[-1]
+            total += len(tree_ids)
+            self.stdout.write('Purged %d threads (up to tree id %d)' % (total, last_tree_id))
+            time.sleep(sleep)
+        self.stdout.write('Done, purged %d threads' % total)
+
+    def _get_orphaned_tree_ids(self, cutoff, last_tree_id, batch_size):
+        """
+        gets (up to batch size) ids of threads after the given tree id whose messages all have no message items
+        and were all sent before the cutoff (so that a message just sent, whose items are yet to be created, is kept)
+        """
+        sql = """
+            SELECT DISTINCT m.tree_id
+            FROM messaging_message m
+            WHERE m.tree_id > %s
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM messaging_message m1
+                    INNER JOIN messaging_messageitem mi1
+                        ON mi1.message_id = m1.id
+                    WHERE m1.tree_id = m.tree_id
+                )
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM messaging_message m2
+                    WHERE m2.tree_id = m.tree_id
+                        AND m2.sent >= %s
+                )
+            ORDER BY m.tree_id
+            LIMIT %s
+        """
+        cursor = connection.cursor()
+        cursor.execute(sql, [last_tree_id, cutoff, batch_size])
+        return [t[0] for t in cursor.fetchall()]
+
+    def _delete_threads(self, tree_ids):
+        """
+        deletes the messages in the given threads along with their targets and attachments (including attachment files)
+        messages are deleted deepest first so that no message is deleted before its replies
+        the rows are deleted in one transaction and the files only once it's committed, so that no row is ever left
+        pointing at a file that's gone (an interruption at worst leaves files that no row points at)
+        """
+        files = [a.file for a in MessageAttachment.objects.filter(message__tree_id__in=tree_ids)]
+        with transaction.atomic():
+            levels = Message.objects.filter(tree_id__in=tree_ids).order_by('-level').values_list('level', flat=True).distinct()
+            for level in list(levels):
+                Message.objects.filter(tree_id__in=tree_ids, level=level).delete()
+        for f in files:
+            f.storage.delete(f.name)
@@ -0,0 +1,68 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from vle.models import CourseKVStore, GroupKVStore
+from messaging.models import RecipientToken
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuilds the recipient index (of user, group and course tokens) used when searching for recipients. '
+        'The index is otherwise kept in sync by signals, so this is only needed after bulk changes (which don\'t send '
+        'signals) or when first installing the index.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of tokens to insert per batch')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        # rebuild the index in a transaction, so that searches never see it partially built
+        with transaction.atomic():
+            RecipientToken.objects.all().delete()
+
+            # users
+            count = self._bulk_create((
+                RecipientToken(token=token, kind=RecipientToken.USER, user_id=user.id)
+                for user in get_user_model().objects.only('first_name', 'last_name', 'username', 'email').iterator()
+                for token in RecipientToken.get_user_tokens(user)
+            ), batch_size)
+            self.stdout.write('Indexed users with %d tokens' % count)
+
+            # groups (a group may have more than one row)
+            groups = {}
+            for group in GroupKVStore.objects.iterator():
+                key = (group.vle_course_id, group.vle_group_id)
+                groups[key] = groups.get(key, set()) | RecipientToken.get_group_tokens(group)
+            count = self._bulk_create((
+                RecipientToken(token=token, kind=RecipientToken.GROUP, vle_course_id=key[0], vle_group_id=key[1])
+                for (key, group_tokens) in groups.items()
+                for token in group_tokens
+            ), batch_size)
+            self.stdout.write('Indexed groups with %d tokens' % count)
+
+            # courses (a course may have more than one row)
+            courses = {}
+            for course in CourseKVStore.objects.iterator():
+                courses[course.vle_course_id] = courses.get(course.vle_course_id, set()) | RecipientToken.get_course_tokens(course)
+            count = self._bulk_create((
+                RecipientToken(token=token, kind=RecipientToken.COURSE, vle_course_id=vle_course_id)
+                for (vle_course_id, course_tokens) in courses.items()
+                for token in course_tokens
+            ), batch_size)
+            self.stdout.write('Indexed courses with %d tokens' % count)
+
+    def _bulk_create(self, tokens, batch_size):
+        """
+        inserts the given (iterable of) tokens in batches, returning how many were inserted
+        """
+        count, batch = 0, []
+        for token in tokens:
+            batch.append(token)
+            if len(batch) == batch_size:
+                RecipientToken.objects.bulk_create(batch)
+                count, batch = count + len(batch), []
+        RecipientToken.objects.bulk_create(batch)
+        return count + len(batch)
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0002_message_body_html'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='path',
+            field=models.TextField(editable=False, blank=True),
+            preserve_default=True,
+        ),
+    ]
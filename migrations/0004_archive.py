@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+import django.core.files.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('messaging', '0003_message_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.IntegerField(serialize=False, primary_key=True)),
+                ('is_notification', models.BooleanField(default=False)),
+                ('url', models.URLField(blank=True)),
+                ('subject', models.CharField(max_length=200, blank=True)),
+                ('body', models.TextField(blank=True)),
+                ('body_html', models.TextField(blank=True)),
+                ('sent', models.DateTimeField(db_index=True)),
+                ('target_all', models.BooleanField(default=False)),
+                ('path', models.TextField(editable=False, blank=True)),
+                ('lft', models.PositiveIntegerField(editable=False)),
+                ('rght', models.PositiveIntegerField(editable=False)),
+                ('tree_id', models.PositiveIntegerField(editable=False, db_index=True)),
+                ('level', models.PositiveIntegerField(editable=False)),
+                ('parent', models.ForeignKey(related_name='children', db_constraint=False, blank=True, to='messaging.ArchivedMessage', null=True)),
+                ('user', models.ForeignKey(blank=True, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='ArchivedMessageAttachment',
+            fields=[
+                ('id', models.IntegerField(serialize=False, primary_key=True)),
+                ('file', models.FileField(storage=django.core.files.storage.FileSystemStorage(location=settings.MESSAGE_ATTACHMENT_ROOT), upload_to=b'%Y/%m/%d')),
+                ('message', models.ForeignKey(to='messaging.ArchivedMessage')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='ArchivedMessageItem',
+            fields=[
+                ('id', models.IntegerField(serialize=False, primary_key=True)),
+                ('source', models.BooleanField(default=False)),
+                ('read', models.DateTimeField(null=True, blank=True)),
+                ('deleted', models.DateTimeField(db_index=True, null=True, blank=True)),
+                ('message', models.ForeignKey(to='messaging.ArchivedMessage')),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='ArchivedMessageTargetCourse',
+            fields=[
+                ('id', models.IntegerField(serialize=False, primary_key=True)),
+                ('vle_course_id', models.CharField(max_length=100)),
+                ('message', models.ForeignKey(to='messaging.ArchivedMessage')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='ArchivedMessageTargetGroup',
+            fields=[
+                ('id', models.IntegerField(serialize=False, primary_key=True)),
+                ('vle_course_id', models.CharField(max_length=100)),
+                ('vle_group_id', models.CharField(max_length=100)),
+                ('message', models.ForeignKey(to='messaging.ArchivedMessage')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='ArchivedMessageTargetUser',
+            fields=[
+                ('id', models.IntegerField(serialize=False, primary_key=True)),
+                ('message', models.ForeignKey(to='messaging.ArchivedMessage')),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='archivedmessageitem',
+            unique_together=set([('message', 'user')]),
+        ),
+    ]
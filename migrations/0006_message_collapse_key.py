@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0005_recipienttoken'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='collapse_key',
+            field=models.CharField(db_index=True, max_length=100, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='archivedmessage',
+            name='collapse_key',
+            field=models.CharField(max_length=100, blank=True),
+            preserve_default=True,
+        ),
+    ]
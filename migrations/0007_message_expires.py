@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0006_message_collapse_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='expires',
+            field=models.DateTimeField(db_index=True, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='archivedmessage',
+            name='expires',
+            field=models.DateTimeField(null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
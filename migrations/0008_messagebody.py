@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0007_message_expires'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageBody',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('hash', models.CharField(unique=True, max_length=64)),
+                ('body', models.TextField()),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='shared_body',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, blank=True, to='messaging.MessageBody', null=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='archivedmessage',
+            name='shared_body',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, blank=True, to='messaging.MessageBody', null=True),
+            preserve_default=True,
+        ),
+    ]
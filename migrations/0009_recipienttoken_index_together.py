@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0008_messagebody'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='recipienttoken',
+            index_together=set([('kind', 'vle_course_id', 'vle_group_id')]),
+        ),
+    ]
@@ -1,22 +1,178 @@
+import hashlib
+import operator
 import re
+from functools import reduce
 
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.core.files.storage import FileSystemStorage
 from django.conf import settings
 from django.core.mail import send_mass_mail
 from django.core.urlresolvers import reverse
-from django.db import models, connection
+from django.db import models, connection, transaction
+from django.db.models import Q
+from django.db.models.query import QuerySet
 from django.utils import timezone
 from django.template import loader
+from django.template.defaultfilters import linebreaksbr
+from django.utils.html import escape
 from django.utils.encoding import python_2_unicode_compatible
 
 from mptt.models import MPTTModel, TreeForeignKey
 
-from vle.models import CourseMember, GroupMember, expand_user_group_course_ids_to_user_ids
+from vle.models import CourseKVStore, GroupKVStore, CourseMember, GroupMember, expand_user_group_course_ids_to_user_ids
 
 
 date_format = '%d/%m/%Y %H:%M:%S'
 delimiter = '::'
+path_delimiter = '/'
+token_max_length = 100
+
+
+def get_thread_model():
+    """
+    gets how message threads are represented, either 'mptt' (the default) or 'path'
+    'mptt' maintains a nested set (lft/rght) for each thread, which is renumbered on every reply
+    'path' only gives each reply its parent's tree_id and a materialised path of ancestor ids (lft/rght aren't maintained)
+    """
+    return getattr(settings, 'MESSAGING_THREAD_MODEL', 'mptt')
+
+
+def _substitute_tables(sql, archived):
+    """
+    substitutes '{MESSAGE}' and '{MESSAGE_ITEM}' in the given SQL with the names of the message and message item tables
+    (or, if archived, the names of their archive tables)
+    """
+    sql = re.sub(r'\{MESSAGE\}', 'messaging_archivedmessage' if archived else 'messaging_message', sql)
+    return re.sub(r'\{MESSAGE_ITEM\}', 'messaging_archivedmessageitem' if archived else 'messaging_messageitem', sql)
+
+
+def _get_inbox_sql(archived):
+    """
+    gets the FROM and WHERE clauses of a user's inbox (see MessageItem.get_inbox), with the user's id as the first
+    parameter
+    if archived, of the user's archived inbox instead
+    """
+    sql = """
+        FROM {MESSAGE_ITEM} mi
+        INNER JOIN {MESSAGE} m
+            ON mi.message_id = m.id
+        INNER JOIN auth_user u
+            ON u.id = m.user_id
+        WHERE mi.user_id = %s
+            AND m.is_notification = %s
+            AND m.id = (
+                SELECT m1.id
+                FROM {MESSAGE} m1
+                INNER JOIN {MESSAGE_ITEM} mi1
+                    ON mi1.message_id = m1.id
+                WHERE mi1.user_id = mi.user_id
+                    AND m1.is_notification = %s
+                    AND m1.tree_id = m.tree_id
+                    AND mi1.deleted IS NULL
+                    AND mi1.source = %s
+                ORDER BY m1.sent DESC
+                LIMIT 1
+            )
+    """
+    return _substitute_tables(sql, archived)
+
+
+def format_sent_display(sent):
+    """
+    if it's today, return the time
+    otherwise, return the date
+    """
+    fmt = '%H:%M' if sent.date() == timezone.now().date() else '%a %d/%m'
+    return timezone.localtime(sent).strftime(fmt)
+
+
+class SentDisplayFormatter(object):
+    """
+    formats sent datetimes like format_sent_display, but gets the date today and the current time zone just once (so
+    is meant to be created once per request, or per page of messages)
+    format_all formats a whole page of datetimes, formatting each distinct date only once
+    """
+
+    def __init__(self):
+        self.today = timezone.now().date()
+        self.tz = timezone.get_current_timezone()
+
+    def format(self, sent):
+        fmt = '%H:%M' if sent.date() == self.today else '%a %d/%m'
+        return sent.astimezone(self.tz).strftime(fmt)
+
+    def format_all(self, sents):
+        dates = {}
+        formatted = []
+        for sent in sents:
+            local = sent.astimezone(self.tz)
+            if sent.date() == self.today:
+                formatted.append('%02d:%02d' % (local.hour, local.minute))
+                continue
+            date = local.date()
+            if date not in dates:
+                dates[date] = date.strftime('%a %d/%m')
+            formatted.append(dates[date])
+        return formatted
+
+
+def tokenise(*values):
+    """
+    normalises the given values into a set of (lowercase) tokens, split on anything that isn't a letter or a digit
+    used for both the recipient index (see RecipientToken) and recipient search queries (so that e.g.
+    'tywin.lannister@into.uk.com' is found by 'tywin', by 'lann' and by 'tywin.lann')
+    """
+    tokens = set()
+    for value in values:
+        tokens.update([t[:token_max_length] for t in re.split(r'[\W_]+', (value or u'').lower(), flags=re.UNICODE) if t])
+    return tokens
+
+
+def _chunks(values, size=500):
+    """
+    splits the given list into lists of at most the given size (e.g. to keep an IN clause within database limits)
+    """
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+def render_body_html(body):
+    """
+    renders a message body as HTML (escaped, with line breaks converted to <br /> tags)
+    """
+    return linebreaksbr(escape(body))
+
+
+def _get_body_html(message):
+    """
+    gets the body of the given message (or archived message) rendered as HTML (see Message.get_body_html)
+    """
+    if message.body_html:
+        return message.body_html
+    body = message.get_body()
+    return render_body_html(body) if body else ''
+
+
+@python_2_unicode_compatible
+class MessageBody(models.Model):
+    """
+    a message body that's stored once, however many messages have it (keyed by a SHA-256 hash of the body)
+    used for notification bodies if MESSAGING_DEDUPLICATE_NOTIFICATION_BODIES is set (see Message.save)
+    bodies no message has any more are deleted by the messaging_expire_notifications command
+    """
+    hash = models.CharField(max_length=64, unique=True)
+    body = models.TextField()
+
+    def __str__(self):
+        return self.hash
+
+    @classmethod
+    def get_body(cls, body):
+        """
+        gets the stored body that's the same as the given body (storing it if it isn't already)
+        """
+        digest = hashlib.sha256(body.encode('utf-8')).hexdigest()
+        return MessageBody.objects.get_or_create(hash=digest, defaults={'body': body})[0]
 
 
 @python_2_unicode_compatible
@@ -26,9 +182,14 @@ class Message(MPTTModel):
     url = models.URLField(blank=True)
     subject = models.CharField(max_length=200, blank=True)
     body = models.TextField(blank=True)
+    body_html = models.TextField(blank=True)
     sent = models.DateTimeField(auto_now_add=True, db_index=True)
     target_all = models.BooleanField(default=False, db_index=True)
     parent = TreeForeignKey('self', null=True, blank=True, related_name='children')
+    path = models.TextField(blank=True, editable=False)
+    collapse_key = models.CharField(max_length=100, blank=True, db_index=True)
+    expires = models.DateTimeField(null=True, blank=True, db_index=True)
+    shared_body = models.ForeignKey(MessageBody, null=True, blank=True, on_delete=models.PROTECT)
 
     def __str__(self):
         t = (
@@ -38,18 +199,140 @@ class Message(MPTTModel):
         )
         return u'(%s) subject "%s" sent @ %s' % t
 
+    def save(self, *args, **kwargs):
+        """
+        gives a new reply the materialised path of its ancestors
+        when using the 'path' thread model, a new reply also inherits its parent's tree without renumbering it
+        optionally stores a notification's body once, however many notifications have it (see MessageBody and get_body)
+        """
+        if self.is_notification and self.body and getattr(settings, 'MESSAGING_DEDUPLICATE_NOTIFICATION_BODIES', False):
+            self.shared_body = MessageBody.get_body(self.body)
+            self.body = ''
+        if self.pk is None and self.parent_id is not None:
+            parent = self.parent
+            self.path = ''.join([parent.path, str(parent.pk), path_delimiter])
+            if get_thread_model() == 'path':
+                self.tree_id = parent.tree_id
+                self.level = parent.level + 1
+                self.lft = self.rght = 0
+                return models.Model.save(self, *args, **kwargs)
+        return super(Message, self).save(*args, **kwargs)
+
+    @classmethod
+    def get_unexpired_filter(cls, prefix=''):
+        """
+        gets a Q object that matches messages (given by the given lookup prefix, e.g. 'message__') that haven't expired
+        """
+        return Q(**{prefix + 'expires': None}) | Q(**{prefix + 'expires__gt': timezone.now()})
+
+    def get_thread_ancestors(self):
+        """
+        gets the ancestors of the message (including the message itself), nearest first
+        """
+        if get_thread_model() != 'path':
+            return self.get_ancestors(ascending=True, include_self=True)
+        ids = [int(_id) for _id in self.path.split(path_delimiter) if _id]
+        ancestors = {m.pk: m for m in Message.objects.filter(pk__in=ids).select_related('user')}
+        return [self] + [ancestors[_id] for _id in reversed(ids) if _id in ancestors]
+
+    def get_target_recipients(self):
+        """
+        gets the users, groups and courses the message was sent to, as a list of dictionaries (of name, id and type)
+        users are ordered by id, then groups and courses are in the order they were targeted
+        users, groups and courses that no longer exist are omitted
+        targets don't change once a message is sent, so their ids are cached per message (the sent datetime is part of
+        the key so that a recycled message id can't be given another message's targets), but names are always got
+        afresh (with one query per type of target)
+        """
+        key = 'messaging.message.%d.%s.targets' % (self.pk, self.sent.isoformat())
+        targets = cache.get(key)
+        if targets is None:
+            targets = self._get_targets()
+            timeout = getattr(settings, 'MESSAGING_TARGET_RECIPIENTS_CACHE_TIMEOUT', 3600)
+            cache.set(key, targets, timeout)
+        return self._get_target_recipients(*targets)
+
+    def _get_targets(self):
+        """
+        gets the ids of the users, groups and courses the message was sent to with one query per type of target
+        """
+        user_ids = list(MessageTargetUser.objects.filter(message=self).order_by('user__id').values_list('user_id', flat=True))
+        group_ids = list(MessageTargetGroup.objects.filter(message=self).order_by('id').values_list('vle_course_id', 'vle_group_id'))
+        course_ids = list(MessageTargetCourse.objects.filter(message=self).order_by('id').values_list('vle_course_id', flat=True))
+        return user_ids, group_ids, course_ids
+
+    @classmethod
+    def _get_target_recipients(cls, user_ids, group_ids, course_ids):
+        """
+        gets the given users, groups and courses (that still exist) with one query per type of name lookup
+        """
+
+        # user targets
+        recipients = []
+        if user_ids:
+            users = get_user_model().objects.filter(pk__in=user_ids).order_by('id').values_list('id', 'first_name', 'last_name')
+            recipients.extend([
+                {
+                    u'name': u' '.join([first_name, last_name]),
+                    u'id': user_id,
+                    u'type': u'u'
+                }
+                for (user_id, first_name, last_name) in users
+            ])
+
+        # group targets
+        if group_ids:
+            names = GroupKVStore.objects.filter(GroupMember.get_groups_filter(group_ids)).values_list('vle_course_id', 'vle_group_id', 'name')
+            names = {(t[0], t[1]): t[2] for t in names}
+            recipients.extend([
+                {
+                    u'name': names[_id],
+                    u'id': delimiter.join(_id),
+                    u'type': u'g'
+                }
+                for _id in group_ids
+                if _id in names
+            ])
+
+        # course targets
+        if course_ids:
+            names = dict(CourseKVStore.objects.filter(vle_course_id__in=course_ids).values_list('vle_course_id', 'name'))
+            recipients.extend([
+                {
+                    u'name': names[_id],
+                    u'id': _id,
+                    u'type': u'c'
+                }
+                for _id in course_ids
+                if _id in names
+            ])
+
+        return recipients
+
     def get_sent_display(self):
         """
         if it's today, return the time
         otherwise, return the date
         """
-        fmt = '%H:%M' if self.sent.date() == timezone.now().date() else '%a %d/%m'
-        return timezone.localtime(self.sent).strftime(fmt)
+        return format_sent_display(self.sent)
+
+    def get_body(self):
+        """
+        gets the body, which may be stored (once) in the message body table (see MessageBody)
+        """
+        return self.shared_body.body if self.shared_body_id else self.body
+
+    def get_body_html(self):
+        """
+        gets the body rendered as HTML
+        it's rendered once when the message is sent, so only (not yet backfilled) older messages are rendered here
+        """
+        return _get_body_html(self)
 
     @classmethod
     def send_message(cls, sender, recipients, subject, body, parent=None, send_email=False):
         # create one Message
-        message = Message.objects.create(user=sender, subject=subject, body=body, parent=parent)
+        message = Message.objects.create(user=sender, subject=subject, body=body, body_html=render_body_html(body), parent=parent)
 
         # TODO create one MessageAttachment per attachment
 
@@ -87,7 +370,9 @@ class Message(MPTTModel):
     @classmethod
     def send_message_all(cls, sender, subject, body, parent=None):
         # create one Message
-        message = Message.objects.create(user=sender, subject=subject, body=body, target_all=True, parent=parent)
+        message = Message.objects.create(
+            user=sender, subject=subject, body=body, body_html=render_body_html(body), target_all=True, parent=parent
+        )
 
         # TODO create one MessageAttachment per attachment
 
@@ -100,8 +385,8 @@ class Message(MPTTModel):
 
     @classmethod
     def email_thread(cls, message, all_user_ids):
-        # use mptt to get ancestors of the message (including the message itself)
-        messages = message.get_ancestors(ascending=True, include_self=True)
+        # get ancestors of the message (including the message itself)
+        messages = message.get_thread_ancestors()
 
         # build email body
         c = {
@@ -118,17 +403,58 @@ class Message(MPTTModel):
         send_mass_mail(tuple(l), fail_silently=True)
 
     @classmethod
-    def send_notification(cls, usernames, url, subject, body):
-        # create one notification
-        notification = Message.objects.create(is_notification=True, url=url, subject=subject, body=body)
-
-        # send a MessageItem to each user
-        for username in usernames:
-            try:
-                user = get_user_model().objects.get(username=username)
-                MessageItem.objects.get_or_create(user=user, message=notification)
-            except get_user_model().DoesNotExist:
-                pass
+    def send_notification(cls, usernames, url, subject, body, collapse_key='', expires=None, course_ids=None, group_ids=None):
+        """
+        sends a notification to each of the given users, and to each member of the given courses and groups (given by
+        vle_course_id and by 'course::group' ids, as for send_message)
+        message items are created (and updated) a batch of users at a time, rather than one user at a time
+        if a collapse key is given, the notification supersedes any earlier notification with the same key: a user's
+        existing message item is moved onto the new notification (and made unread again) instead of another being added,
+        and superseded notifications that no longer have any message items are deleted
+        if an expiry datetime is given, the notification isn't shown after it (and is eventually deleted by the
+        messaging_expire_notifications command)
+        """
+        course_ids = course_ids or []
+        group_ids = group_ids or []
+        with transaction.atomic():
+            # create one notification
+            notification = Message.objects.create(
+                is_notification=True, url=url, subject=subject, body=body, collapse_key=collapse_key, expires=expires)
+
+            # get the ids of the users to notify (ignoring usernames that don't exist)
+            user_ids = []
+            for chunk in _chunks(list(set(usernames))):
+                user_ids.extend(get_user_model().objects.filter(username__in=chunk).values_list('pk', flat=True))
+            if course_ids or group_ids:
+                user_ids = expand_user_group_course_ids_to_user_ids(delimiter, user_ids, group_ids, course_ids)
+
+            for chunk in _chunks(sorted(set(user_ids))):
+                # move the message items of the notifications this one supersedes (so that only the remaining users need
+                # new message items)
+                if collapse_key:
+                    superseded = MessageItem.objects.filter(
+                        message__is_notification=True, message__collapse_key=collapse_key, user_id__in=chunk)
+                    superseded = dict(superseded.exclude(message=notification).values_list('user_id', 'pk'))
+                    if superseded:
+                        MessageItem.objects.filter(pk__in=list(superseded.values())).update(
+                            message=notification, read=None, deleted=None)
+                        chunk = [_id for _id in chunk if _id not in superseded]
+
+                # send a MessageItem to each (remaining) user
+                MessageItem.objects.bulk_create([MessageItem(user_id=_id, message=notification) for _id in chunk])
+
+            # delete superseded notifications that no user has any more
+            if collapse_key:
+                Message.objects.filter(is_notification=True, collapse_key=collapse_key, messageitem=None).exclude(pk=notification.pk).delete()
+
+            # record the targeted courses and groups
+            MessageTargetCourse.objects.bulk_create([
+                MessageTargetCourse(vle_course_id=_id, message=notification) for _id in course_ids
+            ])
+            MessageTargetGroup.objects.bulk_create([
+                MessageTargetGroup(vle_course_id=_id[0], vle_group_id=_id[1], message=notification)
+                for _id in map(lambda p: p.split(delimiter), group_ids)
+            ])
 
         # return the newly created notification
         return notification
@@ -155,33 +481,65 @@ class MessageItem(models.Model):
     read = models.DateTimeField(null=True, blank=True, db_index=True)
     deleted = models.DateTimeField(null=True, blank=True, db_index=True)
 
-    def get_thread(self):
+    def get_thread(self, limit=None, before=None, since=None):
         """
         Gets a thread (a list of undeleted message items) given by self.message.
         To do this, we select all undeleted message items (belonging to self.user) that have a message.tree_id
         equal to self.message.tree_id.
         The ordering is newest first, like OWA (as opposed to gmail, which orders by oldest first).
+        Optionally gets just one page of the thread using keyset pagination over (message.sent, message item id):
+        'before' and 'since' are ids of message items in the thread; 'before' gets (up to 'limit') items older than
+        the given item and 'since' gets (up to 'limit') items newer than the given item.
+        The count is always of the entire thread.
+        """
+        return MessageItem._get_thread(self, limit, before, since, archived=False)
+
+    @classmethod
+    def _get_thread(cls, message_item, limit, before, since, archived):
+        """
+        gets a thread given by the given message item (see get_thread)
+        if archived, the given message item (and so the entire thread) is in the archive tables
         """
 
         # query
         sql = """
-            FROM messaging_messageitem mi1
-            INNER JOIN messaging_message m1
+            FROM {MESSAGE_ITEM} mi1
+            INNER JOIN {MESSAGE} m1
                 ON m1.id = mi1.message_id
                 AND m1.is_notification = %s
-            INNER JOIN messaging_message m2
+            INNER JOIN {MESSAGE} m2
                 ON m2.tree_id = m1.tree_id
                 AND m2.is_notification = %s
-            INNER JOIN messaging_messageitem mi2
+            INNER JOIN {MESSAGE_ITEM} mi2
                 ON mi2.message_id = m2.id
                 AND mi2.user_id = mi1.user_id
                 AND mi2.deleted IS NULL
             WHERE mi1.id = %s
         """
-
-        # get items
-        params = [False, False, self.id]
-        items = MessageItem.objects.raw(''.join(['SELECT mi2.*', sql, ' ORDER BY m2.sent DESC']), params)
+        sql = _substitute_tables(sql, archived)
+        params = [False, False, message_item.id]
+
+        # restrict to one page (if a cursor is given) and determine order by clause
+        page_sql, page_params = '', []
+        order_by_clause = ' ORDER BY m2.sent DESC, mi2.id DESC'
+        if before is not None:
+            cursor_sent = MessageItem._get_thread_cursor_sent(message_item, before, archived)
+            page_sql = ' AND (m2.sent < %s OR (m2.sent = %s AND mi2.id < %s))'
+            page_params = [cursor_sent, cursor_sent, before]
+        elif since is not None:
+            cursor_sent = MessageItem._get_thread_cursor_sent(message_item, since, archived)
+            page_sql = ' AND (m2.sent > %s OR (m2.sent = %s AND mi2.id > %s))'
+            page_params = [cursor_sent, cursor_sent, since]
+            order_by_clause = ' ORDER BY m2.sent, mi2.id'
+        if limit is not None:
+            order_by_clause = ''.join([order_by_clause, ' LIMIT %s'])
+            page_params.append(limit)
+
+        # get items (newer items are fetched oldest first, so that a limit keeps them contiguous with the cursor)
+        model = ArchivedMessageItem if archived else MessageItem
+        items = model.objects.raw(''.join(['SELECT mi2.*', sql, page_sql, order_by_clause]), params + page_params)
+        if since is not None:
+            items = list(reversed(list(items)))
 
         # get count
         cursor = connection.cursor()
@@ -191,27 +549,94 @@ class MessageItem(models.Model):
         # return a pair
         return items, count[0]
 
+    @classmethod
+    def _get_thread_cursor_sent(cls, message_item, cursor_id, archived):
+        """
+        gets the sent datetime of the message corresponding to the message item given by cursor_id (a thread cursor)
+        that message item must belong to the same user as the given message item, otherwise raises DoesNotExist
+        """
+        model = ArchivedMessageItem if archived else MessageItem
+        return model.objects.filter(pk=cursor_id, user_id=message_item.user_id).values_list('message__sent', flat=True).get()
+
     @classmethod
     def mark_all_read(cls, message_items):
         """
         marks each of the given message items as read
+        issues a single UPDATE for all of the given message items that aren't already read
         """
-        unread = filter(lambda mi: mi.read is None, message_items)
-        n = timezone.now()
-        for message_item in unread:
-            message_item.read = n
-            message_item.save()
+        return MessageItem._mark_all(message_items, 'read')
 
     @classmethod
     def mark_all_deleted(cls, message_items):
         """
         marks each of the given message items as deleted
+        issues a single UPDATE for all of the given message items that aren't already deleted
+        """
+        return MessageItem._mark_all(message_items, 'deleted')
+
+    @classmethod
+    def mark_thread_deleted(cls, user, tree_id):
+        """
+        marks each of the given user's undeleted message items in the given message thread as deleted
+        issues a single UPDATE (the thread's messages are selected in a subquery)
+        returns the number of message items marked as deleted
+        """
+        return MessageItem.bulk_mark(user, 'delete', tree_ids=[tree_id])
+
+    @classmethod
+    def bulk_mark(cls, user, action, message_item_ids=(), tree_ids=()):
+        """
+        marks the given message items, and the message items in the given message threads, as read, unread or deleted
+        (according to the given action) but only those belonging to the given user
+        issues a single UPDATE (any threads' messages are selected in a subquery)
+        returns the number of message items updated
+        """
+        if not message_item_ids and not tree_ids:
+            return 0
+
+        # determine which message items need updating and how
+        n = timezone.now()
+        (unchanged, update) = {
+            'read': ({'read__isnull': True, 'deleted__isnull': True}, {'read': n}),
+            'unread': ({'read__isnull': False, 'deleted__isnull': True}, {'read': None}),
+            'delete': ({'deleted__isnull': True}, {'deleted': n}),
+        }[action]
+
+        # select the given message items and the message items in the given threads
+        filters = []
+        if message_item_ids:
+            filters.append(Q(pk__in=message_item_ids))
+        if tree_ids:
+            messages = Message.objects.filter(is_notification=False, tree_id__in=tree_ids).values('id')
+            filters.append(Q(message__in=messages))
+        f = reduce(operator.or_, filters)
+
+        with transaction.atomic():
+            return MessageItem.objects.filter(f, user=user, **unchanged).update(**update)
+
+    @classmethod
+    def _mark_all(cls, message_items, field):
+        """
+        sets the given datetime field to now on each of the given message items where it isn't already set
+        message items can be given as a queryset (in which case it is updated without being evaluated) or as an
+        iterable of instances (in which case each instance is also updated in memory)
+        returns the number of rows updated
         """
-        unread = filter(lambda mi: mi.deleted is None, message_items)
         n = timezone.now()
-        for message_item in unread:
-            message_item.deleted = n
-            message_item.save()
+        unset = {'%s__isnull' % field: True}
+
+        # update a queryset in the database without fetching it
+        if isinstance(message_items, QuerySet):
+            return message_items.filter(**unset).update(**{field: n})
+
+        # otherwise update the instances in the database and in memory
+        unset_items = [mi for mi in message_items if getattr(mi, field) is None]
+        if not unset_items:
+            return 0
+        count = MessageItem.objects.filter(pk__in=[mi.pk for mi in unset_items], **unset).update(**{field: n})
+        for message_item in unset_items:
+            setattr(message_item, field, n)
+        return count
 
     @classmethod
     def create_message_items(cls, message, all_user_ids):
@@ -226,40 +651,74 @@ class MessageItem(models.Model):
         """
         gets the message items which comprise the given user's notifications
         """
-        mi = MessageItem.objects.filter(message__is_notification=True, user=user, deleted=None).order_by('-message__sent')
+        mi = MessageItem._get_notifications(user)
         return mi, mi.count()
 
     @classmethod
-    def get_inbox(cls, user, sort_field='date', sort_dir='desc'):
+    def get_notifications_page(cls, user, limit, before=None):
+        """
+        gets (a list of) at most limit of the message items which comprise the given user's notifications, optionally
+        older than the message item given by before (a cursor, which must be one of the user's notifications, otherwise
+        raises DoesNotExist)
+        paging by cursor (rather than by offset) means a page costs the same however far back it is
+        """
+        mi = MessageItem._get_notifications(user)
+        if before is not None:
+            cursor_sent = mi.filter(pk=before).values_list('message__sent', flat=True).get()
+            mi = mi.filter(Q(message__sent__lt=cursor_sent) | Q(message__sent=cursor_sent, id__lt=before))
+        return list(mi[:limit])
+
+    @classmethod
+    def get_unread_count(cls, user, notifications=False):
+        """
+        counts the given user's unread (and undeleted) messages, or (unexpired) notifications
+        """
+        mi = MessageItem.objects.filter(message__is_notification=notifications, user=user, read=None, deleted=None)
+        if notifications:
+            mi = mi.filter(Message.get_unexpired_filter('message__'))
+        return mi.count()
+
+    @classmethod
+    def mark_all_notifications_read(cls, user, upto=None):
+        """
+        marks all of the given user's notifications as read with a single UPDATE, optionally only those no newer than
+        the message item given by upto (a cursor, which must be one of the user's notifications, otherwise raises
+        DoesNotExist)
+        returns the number of notifications marked as read and the number still unread (counted in the same transaction)
+        """
+        with transaction.atomic():
+            mi = MessageItem.objects.filter(message__is_notification=True, user=user, deleted=None)
+            if upto is not None:
+                cursor_sent = mi.filter(pk=upto).values_list('message__sent', flat=True).get()
+                mi = mi.filter(Q(message__sent__lt=cursor_sent) | Q(message__sent=cursor_sent, id__lte=upto))
+            count = MessageItem._mark_all(mi, 'read')
+            return count, MessageItem.get_unread_count(user, notifications=True)
+
+    @classmethod
+    def _get_notifications(cls, user):
+        """
+        gets a queryset of the given user's (unexpired) notifications (newest first), loading only the columns that are
+        displayed (along with their messages, in the same query)
+        """
+        mi = MessageItem.objects.filter(message__is_notification=True, user=user, deleted=None)
+        mi = mi.filter(Message.get_unexpired_filter('message__')).select_related('message__shared_body')
+        mi = mi.only(
+            'id', 'read', 'message', 'message__subject', 'message__body', 'message__url', 'message__sent',
+            'message__shared_body', 'message__shared_body__body',
+        )
+        return mi.order_by('-message__sent', '-id')
+
+    @classmethod
+    def get_inbox(cls, user, sort_field='date', sort_dir='desc', archived=False):
         """
         gets the message items which comprise the given user's inbox
         main query: select all the message items that should appear in the given user's inbox
         sub query: select the most recently sent message (that was sent to the given user) within the thread
+        if archived, gets the (archived) message items which comprise the given user's archived inbox instead
         """
 
         # query
-        sql = """
-            FROM messaging_messageitem mi
-            INNER JOIN messaging_message m
-                ON mi.message_id = m.id
-            INNER JOIN auth_user u
-                ON u.id = m.user_id
-            WHERE mi.user_id = %s
-                AND m.is_notification = %s
-                AND m.id = (
-                    SELECT m1.id
-                    FROM messaging_message m1
-                    INNER JOIN messaging_messageitem mi1
-                        ON mi1.message_id = m1.id
-                    WHERE mi1.user_id = mi.user_id
-                        AND m1.is_notification = %s
-                        AND m1.tree_id = m.tree_id
-                        AND mi1.deleted IS NULL
-                        AND mi1.source = %s
-                    ORDER BY m1.sent DESC
-                    LIMIT 1
-                )
-        """
+        sql = _get_inbox_sql(archived)
 
         # determine order by clause
         order_by = {
@@ -272,7 +731,8 @@ class MessageItem(models.Model):
 
         # get items
         params = [user.id, False, False, False]
-        items = MessageItem.objects.raw(''.join(['SELECT mi.*', sql, ' ORDER BY ', order_by_clause]), params)
+        model = ArchivedMessageItem if archived else MessageItem
+        items = model.objects.raw(''.join(['SELECT mi.*', sql, ' ORDER BY ', order_by_clause]), params)
 
         # get count
         cursor = connection.cursor()
@@ -283,23 +743,76 @@ class MessageItem(models.Model):
         return items, count[0]
 
     @classmethod
-    def get_undeleted_message_item_count_for_message_trees(cls, user, tree_ids):
+    def get_inbox_page(cls, user, sort_field='date', sort_dir='desc', offset=0, limit=10, include_archived=False):
+        """
+        gets one page of the message items which comprise the given user's inbox (sorted as by get_inbox), along with
+        the count of the whole inbox
+        if include_archived, the archived inbox is merged in by the database (a UNION ALL of both inboxes, sorted and
+        paginated as one), so the page holds message items and archived message items
+        only the ids of the page are selected by the merging query, then just those message items are got (along with
+        their messages and senders)
+        """
+
+        # query (the inbox, or both inboxes), selecting the columns to sort by
+        parts = [(False, MessageItem)] + ([(True, ArchivedMessageItem)] if include_archived else [])
+        sql = ' UNION ALL '.join([''.join([
+            'SELECT mi.id AS id, %d AS archived, m.sent AS sent, u.first_name AS first_name, u.last_name AS last_name'
+            % int(archived),
+            _get_inbox_sql(archived),
+        ]) for (archived, _) in parts])
+        params = [user.id, False, False, False] * len(parts)
+
+        # determine order by clause (ids break ties, so that pages don't overlap)
+        order_by = {
+            'date asc': 'i.sent',
+            'date desc': 'i.sent DESC',
+            'sender asc': 'i.first_name, i.last_name',
+            'sender desc': 'i.first_name DESC, i.last_name DESC',
+        }
+        order_by_clause = order_by[' '.join([sort_field, sort_dir])]
+
+        # get the page's ids (and whether each is archived)
+        cursor = connection.cursor()
+        cursor.execute(''.join([
+            'SELECT i.id, i.archived FROM (', sql, ') i ORDER BY ', order_by_clause, ', i.archived, i.id LIMIT %s OFFSET %s'
+        ]), params + [limit, offset])
+        rows = cursor.fetchall()
+
+        # get the page's message items, in order
+        items = {}
+        for (archived, model) in parts:
+            ids = [row[0] for row in rows if bool(row[1]) == archived]
+            if ids:
+                for (pk, mi) in model.objects.select_related('message__user').in_bulk(ids).items():
+                    items[(archived, pk)] = mi
+        items = [items[(bool(row[1]), row[0])] for row in rows]
+
+        # get count
+        cursor.execute(''.join(['SELECT COUNT(i.id) FROM (', sql, ') i']), params)
+        count = cursor.fetchone()
+
+        # return a pair
+        return items, count[0]
+
+    @classmethod
+    def get_undeleted_message_item_count_for_message_trees(cls, user, tree_ids, archived=False):
         """
         counts the number of undeleted message items belonging to the given user for each given message tree
         """
-        return MessageItem._get_general_message_item_count_for_message_trees(user, tree_ids, exclude_read=False)
+        return MessageItem._get_general_message_item_count_for_message_trees(user, tree_ids, exclude_read=False, archived=archived)
 
     @classmethod
-    def get_unread_message_item_count_for_message_trees(cls, user, tree_ids):
+    def get_unread_message_item_count_for_message_trees(cls, user, tree_ids, archived=False):
         """
         counts the number of unread message items belonging to the given user for each given message tree
         """
-        return MessageItem._get_general_message_item_count_for_message_trees(user, tree_ids, exclude_read=True)
+        return MessageItem._get_general_message_item_count_for_message_trees(user, tree_ids, exclude_read=True, archived=archived)
 
     @classmethod
-    def _get_general_message_item_count_for_message_trees(cls, user, tree_ids, exclude_read):
+    def _get_general_message_item_count_for_message_trees(cls, user, tree_ids, exclude_read, archived=False):
         """
         counts the number of message items belonging to the given user for each given message tree
+        if archived, counts (archived) message items in the given archived message trees instead
         """
 
         if not tree_ids:
@@ -308,8 +821,8 @@ class MessageItem(models.Model):
         # query
         sql = """
             SELECT m.tree_id, COUNT(mi.id)
-            FROM messaging_messageitem mi
-            INNER JOIN messaging_message m
+            FROM {MESSAGE_ITEM} mi
+            INNER JOIN {MESSAGE} m
                 ON mi.message_id = m.id
             WHERE mi.user_id = %s
                 AND m.is_notification = %s
@@ -325,6 +838,9 @@ class MessageItem(models.Model):
         # substitute 'UNREAD' with a clause that excludes read (if we're excluding read) or nothing (if we're not)
         sql = re.sub(r'\{UNREAD\}', 'AND mi.read IS NULL' if exclude_read else '', sql)
 
+        # substitute '{MESSAGE}' and '{MESSAGE_ITEM}' with the names of the (hot or archive) tables
+        sql = _substitute_tables(sql, archived)
+
         # execute query
         params = [user.id, False]
         cursor = connection.cursor()
@@ -398,3 +914,209 @@ class MessageTargetGroup(models.Model):
 
     class Meta:
         unique_together = ('message', 'vle_course_id', 'vle_group_id',)
+
+
+@python_2_unicode_compatible
+class ArchivedMessage(models.Model):
+    """
+    a message in a thread that has been moved out of the message table by the messaging_archive command
+    has the same columns as Message (but is no longer maintained as a tree)
+    """
+    id = models.IntegerField(primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True)
+    is_notification = models.BooleanField(default=False)
+    url = models.URLField(blank=True)
+    subject = models.CharField(max_length=200, blank=True)
+    body = models.TextField(blank=True)
+    body_html = models.TextField(blank=True)
+    sent = models.DateTimeField(db_index=True)
+    target_all = models.BooleanField(default=False)
+    parent = models.ForeignKey('self', null=True, blank=True, related_name='children', db_constraint=False)
+    path = models.TextField(blank=True, editable=False)
+    collapse_key = models.CharField(max_length=100, blank=True)
+    expires = models.DateTimeField(null=True, blank=True)
+    shared_body = models.ForeignKey(MessageBody, null=True, blank=True, db_constraint=False, on_delete=models.DO_NOTHING)
+    lft = models.PositiveIntegerField(editable=False)
+    rght = models.PositiveIntegerField(editable=False)
+    tree_id = models.PositiveIntegerField(editable=False, db_index=True)
+    level = models.PositiveIntegerField(editable=False)
+
+    def __str__(self):
+        t = (
+            self.subject,
+            self.sent.strftime(date_format),
+        )
+        return u'(Archived) subject "%s" sent @ %s' % t
+
+    def get_sent_display(self):
+        """
+        see Message.get_sent_display
+        """
+        return format_sent_display(self.sent)
+
+    def get_body(self):
+        """
+        see Message.get_body
+        """
+        return self.shared_body.body if self.shared_body_id else self.body
+
+    def get_body_html(self):
+        """
+        see Message.get_body_html
+        """
+        return _get_body_html(self)
+
+
+@python_2_unicode_compatible
+class ArchivedMessageAttachment(models.Model):
+    id = models.IntegerField(primary_key=True)
+    message = models.ForeignKey(ArchivedMessage)
+    file = models.FileField(upload_to='%Y/%m/%d', storage=FileSystemStorage(location=settings.MESSAGE_ATTACHMENT_ROOT))
+
+    def __str__(self):
+        t = (
+            self.message.subject,
+            self.file,
+        )
+        return u'(Archived) subject "%s" attachment "%s"' % t
+
+
+@python_2_unicode_compatible
+class ArchivedMessageItem(models.Model):
+    """
+    a message item belonging to an archived message
+    has the same columns as MessageItem, and is read-only
+    """
+    id = models.IntegerField(primary_key=True)
+    message = models.ForeignKey(ArchivedMessage)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL)
+    source = models.BooleanField(default=False)
+    read = models.DateTimeField(null=True, blank=True)
+    deleted = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    def get_thread(self, limit=None, before=None, since=None):
+        """
+        see MessageItem.get_thread
+        """
+        return MessageItem._get_thread(self, limit, before, since, archived=True)
+
+    def __str__(self):
+        t = (
+            self.message.subject,
+            ' '.join([self.user.first_name, self.user.last_name]),
+        )
+        return u'(Archived) subject "%s" sent to "%s"' % t
+
+    class Meta:
+        unique_together = ('message', 'user',)
+
+
+@python_2_unicode_compatible
+class ArchivedMessageTargetUser(models.Model):
+    id = models.IntegerField(primary_key=True)
+    message = models.ForeignKey(ArchivedMessage)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL)
+
+    def __str__(self):
+        t = (
+            self.message.subject,
+            ' '.join([self.user.first_name, self.user.last_name]),
+        )
+        return u'(Archived) subject "%s" was sent to user "%s"' % t
+
+
+@python_2_unicode_compatible
+class ArchivedMessageTargetCourse(models.Model):
+    id = models.IntegerField(primary_key=True)
+    message = models.ForeignKey(ArchivedMessage)
+    vle_course_id = models.CharField(max_length=100)
+
+    def __str__(self):
+        t = (
+            self.message.subject,
+            self.vle_course_id,
+        )
+        return u'(Archived) subject "%s" was sent to course "%s"' % t
+
+
+@python_2_unicode_compatible
+class ArchivedMessageTargetGroup(models.Model):
+    id = models.IntegerField(primary_key=True)
+    message = models.ForeignKey(ArchivedMessage)
+    vle_course_id = models.CharField(max_length=100)
+    vle_group_id = models.CharField(max_length=100)
+
+    def __str__(self):
+        t = (
+            self.message.subject,
+            self.vle_course_id,
+            self.vle_group_id,
+        )
+        return u'(Archived) subject "%s" was sent to group "%s|%s"' % t
+
+
+class RecipientToken(models.Model):
+    """
+    a normalised token (see tokenise) of a user, group or course, so that recipients can be searched by prefix
+    (see search.search)
+    kept in sync by signals, and rebuilt by the messaging_rebuild_recipient_index command
+    """
+    USER = 0
+    GROUP = 1
+    COURSE = 2
+
+    token = models.CharField(max_length=token_max_length, db_index=True)
+    kind = models.PositiveSmallIntegerField()
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True)
+    vle_course_id = models.CharField(max_length=100, blank=True)
+    vle_group_id = models.CharField(max_length=100, blank=True)
+
+    class Meta:
+        index_together = (('kind', 'vle_course_id', 'vle_group_id'),)
+
+    @classmethod
+    def get_user_tokens(cls, user):
+        return tokenise(user.first_name, user.last_name, user.username, user.email)
+
+    @classmethod
+    def get_group_tokens(cls, group):
+        return tokenise(group.vle_course_id, group.vle_group_id, group.name)
+
+    @classmethod
+    def get_course_tokens(cls, course):
+        return tokenise(course.vle_course_id, course.name)
+
+    @classmethod
+    def index_user(cls, user):
+        """
+        (re)indexes the given user
+        """
+        cls._index(cls.get_user_tokens(user), kind=cls.USER, user_id=user.id)
+
+    @classmethod
+    def index_group(cls, vle_course_id, vle_group_id):
+        """
+        (re)indexes the given group (or unindexes it, if it no longer exists)
+        """
+        groups = GroupKVStore.objects.filter(vle_course_id=vle_course_id, vle_group_id=vle_group_id)
+        tokens = set().union(*[cls.get_group_tokens(group) for group in groups])
+        cls._index(tokens, kind=cls.GROUP, vle_course_id=vle_course_id, vle_group_id=vle_group_id)
+
+    @classmethod
+    def index_course(cls, vle_course_id):
+        """
+        (re)indexes the given course (or unindexes it, if it no longer exists)
+        """
+        tokens = set().union(*[cls.get_course_tokens(course) for course in CourseKVStore.objects.filter(vle_course_id=vle_course_id)])
+        cls._index(tokens, kind=cls.COURSE, vle_course_id=vle_course_id)
+
+    @classmethod
+    def _index(cls, tokens, **entity):
+        """
+        makes the indexed tokens of the given entity match the given tokens, changing only what's changed (since e.g. a
+        user is saved whenever they log in)
+        """
+        existing = set(cls.objects.filter(**entity).values_list('token', flat=True))
+        if existing - tokens:
+            cls.objects.filter(token__in=existing - tokens, **entity).delete()
+        cls.objects.bulk_create([cls(token=token, **entity) for token in tokens - existing])
@@ -1,18 +1,30 @@
-from operator import itemgetter
+from array import array
+from bisect import bisect_left
 
 from django.conf import settings
-from django.contrib.auth import get_user_model
-from django.db.models import Q
+from django.core.cache import cache
 from django.db import connection
 from django.utils.translation import gettext as _
 
-from vle.models import CourseKVStore, GroupKVStore, GroupMember, CourseMember
-from .models import delimiter
+from vle.models import CourseMember, GroupMember
+from .models import delimiter, tokenise, RecipientToken
+from . import autocomplete, search_cache
+
+# kinds of search result (in the order in which results with the same name are sorted)
+_USER = RecipientToken.USER
+_GROUP = RecipientToken.GROUP
+_COURSE = RecipientToken.COURSE
+
+# cache key of the ids of all tutors
+tutor_ids_key = 'messaging.search.tutor_ids'
 
 
 def search(q='', exclude=None, user=None, per_page=None, page=0):
     """
     search users, groups and courses
+    the searches are combined with UNION ALL, so that ranking, sorting, pagination and the total count all happen
+    in a single query
+    results are ranked by relevance (see _relevance), then by type (users, then groups, then courses), then by name
     """
 
     if exclude is None:
@@ -24,124 +36,375 @@ def search(q='', exclude=None, user=None, per_page=None, page=0):
     if per_page is None:
         per_page = settings.MESSAGING_SEARCH_RESULTS_PER_PAGE if hasattr(settings, 'MESSAGING_SEARCH_RESULTS_PER_PAGE') else 10
 
-    (users, users_count) = _search_users(q=q, exclude=exclude, user=user)
-    (groups, groups_count) = _search_groups(q=q, exclude=exclude, user=user)
-    (courses, courses_count) = _search_courses(q=q, exclude=exclude, user=user)
+    # a super user (who can see everything) can optionally search an in-process index instead of the database
+    if user.is_superuser and getattr(settings, 'MESSAGING_SEARCH_IN_PROCESS_INDEX', False):
+        (results, total) = autocomplete.search(q=q, exclude=exclude, user=user, per_page=per_page, page=page)
+        return results, total, per_page
+
+    # optionally, serve pages from a short lived cache of the first so many results of the same search
+    if getattr(settings, 'MESSAGING_SEARCH_RESULT_CACHE', False):
+        (rows, total) = _search_cached(q=q, exclude=exclude, user=user, per_page=per_page, page=page)
+    else:
+        (rows, total) = _search(q=q, exclude=exclude, user=user, limit=per_page, offset=per_page * page)
+
+    # return a list of users, groups and courses, a (total) count and the number of results per page
+    return [_search_result(row) for row in rows], total, per_page
+
+
+def _search_cached(q, exclude, user, per_page, page):
+    """
+    gets a page of search results (and the total count) from the search result cache (see search_cache), searching
+    (and caching) the first MESSAGING_SEARCH_RESULT_CACHE_MAX_RESULTS results if they're not cached
+    a page beyond those results is searched for (uncached)
+    """
+    key = search_cache.get_key(user, q, exclude)
+    entry = search_cache.get_entry(key)
+    if entry is None:
+        max_results = getattr(settings, 'MESSAGING_SEARCH_RESULT_CACHE_MAX_RESULTS', 100)
+        entry = _search(q=q, exclude=exclude, user=user, limit=max_results, offset=0)
+        search_cache.set_entry(key, entry)
+    (rows, total) = entry
+    (start, end) = (per_page * page, per_page * (page + 1))
+    if end > len(rows) and len(rows) < total:
+        search_cache.record_overflow()
+        return _search(q=q, exclude=exclude, user=user, limit=per_page, offset=start)
+    return rows[start:end], total
+
+
+def _search(q, exclude, user, limit, offset):
+    """
+    gets the given slice of the (ordered) rows of (kind, user id, course id, group id, name) matching a search, and the
+    total count
+    """
+
+    # get a query (and its params) for each of users, groups and courses
+    parts = [
+        _search_users(q=q, exclude=exclude, user=user),
+        _search_groups(q=q, exclude=exclude, user=user),
+        _search_courses(q=q, exclude=exclude, user=user),
+    ]
+
+    # query
+    # the total count is left joined to the page, so that it's returned even if the page is empty
+    # ties (on relevance, type and name) are broken by id
+    sql = """
+        SELECT t.total, r.kind, r.user_id, r.vle_course_id, r.vle_group_id, r.name
+        FROM (
+            SELECT COUNT(*) AS total
+            FROM ({UNION}) a
+        ) t
+        LEFT JOIN (
+            SELECT b.relevance, b.kind, b.user_id, b.vle_course_id, b.vle_group_id, b.name
+            FROM ({UNION}) b
+            ORDER BY b.relevance, b.kind, b.name, b.user_id, b.vle_course_id, b.vle_group_id
+            LIMIT %s OFFSET %s
+        ) r
+            ON 1 = 1
+        ORDER BY r.relevance, r.kind, r.name, r.user_id, r.vle_course_id, r.vle_group_id
+    """
+
+    # substitute '{UNION}' with the UNION ALL of each query
+    sql = sql.replace('{UNION}', ' UNION ALL '.join([part[0] for part in parts]))
+
+    # execute query
+    union_params = [param for part in parts for param in part[1]]
+    params = union_params + union_params + [limit, offset]
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    rows = cursor.fetchall()
+
+    # drop the total count from each row (and the row of nulls that there is if the page is empty)
+    return [row[1:] for row in rows if row[1] is not None], rows[0][0]
 
-    total = sorted(users + groups + courses, key=itemgetter('name'))
-    total_count = users_count + groups_count + courses_count
-    index_from = per_page * page
-    index_to = index_from + per_page
 
-    return total[index_from:index_to], total_count, per_page
+def _search_result(row):
+    """
+    converts a row of the search query into a dictionary
+    """
+    (kind, user_id, vle_course_id, vle_group_id, name) = row
+    if kind == _USER:
+        return {u'name': name, u'id': user_id, u'type': u'u'}
+    if kind == _GROUP:
+        return {u'name': name, u'id': delimiter.join([vle_course_id, vle_group_id]), u'type': u'g'}
+    return {u'name': name, u'id': vle_course_id, u'type': u'c'}
 
 
 def _search_users(q, exclude, user):
     """
     search users by first_name, last_name, username and email according to the given query
     if the given user is not a super user, restrict visibility of (other) users according to the given user's courses
+    returns a query (and its params) for use in search
+    """
+
+    # query
+    sql = """
+        SELECT {KIND} AS kind, {RELEVANCE} AS relevance, u.id AS user_id, NULL AS vle_course_id, NULL AS vle_group_id,
+            {NAME} AS name
+        FROM auth_user u
+        WHERE {SEARCH}
+            {VISIBLE}
+            AND u.id NOT IN ({EXCLUDE})
     """
+    sql = sql.replace('{KIND}', str(_USER))
+    sql = sql.replace('{NAME}', _concat('u.first_name', "' '", 'u.last_name'))
+
+    # rank by relevance to the given query (a user's full name counts as a column)
+    columns = ['u.first_name', 'u.last_name', 'u.username', 'u.email', _concat('u.first_name', "' '", 'u.last_name')]
+    (relevance_sql, params) = _relevance(q, columns)
+    sql = sql.replace('{RELEVANCE}', relevance_sql)
 
     # text search according to given query
-    f = Q(first_name__icontains=q) | \
-        Q(last_name__icontains=q) | \
-        Q(username__icontains=q) | \
-        Q(email__icontains=q)
-    u = get_user_model().objects.filter(f)
+    (search_sql, search_params) = _search_tokens(q, _USER, [('u.id', 'user_id')])
+    sql = sql.replace('{SEARCH}', search_sql)
+    params += search_params
 
     # if the user isn't a super user then filter by visible users
+    # a short list of (cached) visible user ids is used as is, otherwise visibility is resolved within the query
+    # (see _get_visible_user_ids and _get_visible_tutor_ids, which this replicates)
+    visible_sql = ''
     if not user.is_superuser:
-        visible_user_ids = _get_visible_user_ids(user) + _get_visible_tutor_ids(user)
+        visible_user_ids = get_visibility(user)['user_ids']
         if not visible_user_ids:
-            return [], 0
-        u = u.filter(pk__in=visible_user_ids)
+            visible_sql = 'AND 1 = 0'
+        elif len(visible_user_ids) <= getattr(settings, 'MESSAGING_SEARCH_VISIBLE_USER_IDS_MAX', 1000):
+            visible_sql = 'AND u.id IN (%s)' % ','.join(map(lambda x: str(x), visible_user_ids))
+        else:
+            # a tutor can also see every other tutor
+            tutor_sql = ''
+            if _contains(get_tutor_ids(), user.id):
+                tutor_sql = """
+                    OR EXISTS (
+                        SELECT 1
+                        FROM vle_coursemember cm3
+                        WHERE cm3.user_id = u.id
+                            AND cm3.is_tutor = %s
+                    )
+                """
+            visible_sql = """
+                AND (
+                    EXISTS (
+                        SELECT 1
+                        FROM vle_coursemember cm1
+                        INNER JOIN vle_coursemember cm2
+                            ON cm2.vle_course_id = cm1.vle_course_id
+                            AND cm2.user_id = %s
+                        WHERE cm1.user_id = u.id
+                    )
+                    {TUTORS}
+                )
+            """.replace('{TUTORS}', tutor_sql)
+            params += [user.id] + ([True] if tutor_sql else [])
+    sql = sql.replace('{VISIBLE}', visible_sql)
 
     # exclude given users
-    exclude_pks = [r.get('id') for r in exclude if r.get('id', '') and r.get('type', '') == u'u']
+    exclude_pks = [int(r.get('id')) for r in exclude if r.get('id', '') and r.get('type', '') == u'u']
     exclude_pks.append(user.id)
-    u = u.exclude(pk__in=exclude_pks)
-
-    # return a list of users and a (total) count
-    return [
-        {
-            u'name': u' '.join([user.first_name, user.last_name]),
-            u'id': user.pk,
-            u'type': u'u'
-        }
-        for user in u
-    ], u.count()
+    sql = sql.replace('{EXCLUDE}', ','.join(['%s'] * len(exclude_pks)))
+    params += exclude_pks
+
+    return sql, params
 
 
 def _search_groups(q, exclude, user):
     """
     search groups by vle_course_id, vle_group_id and name according to the given query
     if the given user is not a super user, restrict visibility of groups according to the given user's groups
+    returns a query (and its params) for use in search
+    """
+
+    # query
+    # a group's name is prefixed by the name of its course, which is joined (a course may have more than one row, in
+    # which case the greatest name is used)
+    sql = """
+        SELECT {KIND} AS kind, {RELEVANCE} AS relevance, NULL AS user_id, g.vle_course_id, g.vle_group_id,
+            {NAME} AS name
+        FROM vle_groupkvstore g
+        LEFT JOIN (
+            SELECT c.vle_course_id, MAX(c.name) AS name
+            FROM vle_coursekvstore c
+            GROUP BY c.vle_course_id
+        ) gc
+            ON gc.vle_course_id = g.vle_course_id
+        WHERE {SEARCH}
+            {VISIBLE}
+            {EXCLUDE}
     """
+    sql = sql.replace('{KIND}', str(_GROUP))
+    sql = sql.replace('{NAME}', _concat("COALESCE(gc.name, '')", "' - '", 'g.name', "' ('", '%s', "')'"))
+
+    # rank by relevance to the given query
+    (relevance_sql, params) = _relevance(q, ['g.vle_course_id', 'g.vle_group_id', 'g.name'])
+    sql = sql.replace('{RELEVANCE}', relevance_sql)
+    params.append(_('Group'))
 
     # text search according to given query
-    f = Q(vle_course_id__icontains=q) | \
-        Q(vle_group_id__icontains=q) | \
-        Q(name__icontains=q)
-    g = GroupKVStore.objects.filter(f)
+    (search_sql, search_params) = _search_tokens(q, _GROUP, [('g.vle_course_id', 'vle_course_id'), ('g.vle_group_id', 'vle_group_id')])
+    sql = sql.replace('{SEARCH}', search_sql)
+    params += search_params
 
-    # if the user isn't a super user then filter by visible groups
+    # if the user isn't a super user then filter by (cached) visible groups
+    visible_sql = ''
     if not user.is_superuser:
-        visible_groups = GroupMember.objects.filter(user=user).values_list('vle_course_id', 'vle_group_id')
+        visible_groups = sorted(get_visibility(user)['groups'])
         if not visible_groups:
-            return [], 0
-        g = g.filter(GroupMember.get_groups_filter(visible_groups))
+            visible_sql = 'AND 1 = 0'
+        else:
+            visible_sql = 'AND (%s)' % ' OR '.join(['(g.vle_course_id = %s AND g.vle_group_id = %s)'] * len(visible_groups))
+            params += [_id for ids in visible_groups for _id in ids]
+    sql = sql.replace('{VISIBLE}', visible_sql)
 
     # exclude given groups
     exclude_ids = [r.get('id').split(delimiter) for r in exclude if r.get('id', '') and r.get('type', '') == u'g']
+    exclude_ids = [ids for ids in exclude_ids if len(ids) == 2]
+    exclude_sql = ''
     if exclude_ids:
-        g = g.exclude(GroupMember.get_groups_filter(exclude_ids))
+        exclude_sql = 'AND NOT (%s)' % ' OR '.join(['(g.vle_course_id = %s AND g.vle_group_id = %s)'] * len(exclude_ids))
+        params += [_id for ids in exclude_ids for _id in ids]
+    sql = sql.replace('{EXCLUDE}', exclude_sql)
 
-    # create a map of vle_course_id to course names
-    courses = dict(CourseKVStore.objects.filter(vle_course_id__in=[grp.vle_course_id for grp in g]).values_list('vle_course_id', 'name').distinct())
-
-    # return a list of groups and a (total) count
-    return [
-        {
-            u'name': u''.join([courses.get(group.vle_course_id, ''), ' - ', group.name, u' (', _('Group'), u')']),
-            u'id': delimiter.join([group.vle_course_id, group.vle_group_id]),
-            u'type': u'g'
-        }
-        for group in g
-    ], g.count()
+    return sql, params
 
 
 def _search_courses(q, exclude, user):
     """
     search courses by vle_course_id and name according to the given query
     if the given user is not a super user, restrict visibility of courses according to the given user's courses
+    a course with more than one row is one result, named by its greatest name and as relevant as its most relevant row
+    returns a query (and its params) for use in search
     """
 
+    # query
+    sql = """
+        SELECT {KIND} AS kind, MIN({RELEVANCE}) AS relevance, NULL AS user_id, c.vle_course_id, NULL AS vle_group_id,
+            {NAME} AS name
+        FROM vle_coursekvstore c
+        WHERE {SEARCH}
+            {VISIBLE}
+            {EXCLUDE}
+        GROUP BY c.vle_course_id
+    """
+    sql = sql.replace('{KIND}', str(_COURSE))
+    sql = sql.replace('{NAME}', _concat('MAX(c.name)', "' ('", '%s', "')'"))
+
+    # rank by relevance to the given query
+    (relevance_sql, params) = _relevance(q, ['c.vle_course_id', 'c.name'])
+    sql = sql.replace('{RELEVANCE}', relevance_sql)
+    params.append(_('Module'))
+
     # text search according to given query
-    f = Q(vle_course_id__icontains=q) | \
-        Q(name__icontains=q)
-    c = CourseKVStore.objects.filter(f)
+    (search_sql, search_params) = _search_tokens(q, _COURSE, [('c.vle_course_id', 'vle_course_id')])
+    sql = sql.replace('{SEARCH}', search_sql)
+    params += search_params
 
-    # if the user isn't a super user then filter by visible courses
+    # if the user isn't a super user then filter by (cached) visible courses
+    visible_sql = ''
     if not user.is_superuser:
-        visible_courses = CourseMember.objects.filter(user=user).values_list('vle_course_id', flat=True)
+        visible_courses = sorted(get_visibility(user)['course_ids'])
         if not visible_courses:
-            return [], 0
-        c = c.filter(vle_course_id__in=visible_courses)
+            visible_sql = 'AND 1 = 0'
+        else:
+            visible_sql = 'AND c.vle_course_id IN (%s)' % ','.join(['%s'] * len(visible_courses))
+            params += visible_courses
+    sql = sql.replace('{VISIBLE}', visible_sql)
 
     # exclude given courses
     exclude_ids = [r.get('id') for r in exclude if r.get('id', '') and r.get('type', '') == u'c']
+    exclude_sql = ''
     if exclude_ids:
-        c = c.exclude(vle_course_id__in=exclude_ids)
-
-    # return a list of courses and a (total) count
-    return [
-        {
-            u'name': u''.join([course.name, u' (', _('Module'), u')']),
-            u'id': course.vle_course_id,
-            u'type': u'c'
+        exclude_sql = 'AND c.vle_course_id NOT IN (%s)' % ','.join(['%s'] * len(exclude_ids))
+        params += exclude_ids
+    sql = sql.replace('{EXCLUDE}', exclude_sql)
+
+    return sql, params
+
+
+def _search_tokens(q, kind, columns):
+    """
+    gets an SQL clause (and its params) matching the rows of the given kind that have, for each token of the given
+    query, an indexed token (see RecipientToken) that begins with it
+    columns is a list of pairs of (searched table column, RecipientToken column) that identify a row
+    """
+    clauses, params = [], []
+    for token in sorted(tokenise(q)):
+        clauses.append('(%s) IN (SELECT %s FROM messaging_recipienttoken rt WHERE rt.kind = %%s AND rt.token %s)' % (
+            ', '.join([column[0] for column in columns]),
+            ', '.join(['rt.%s' % column[1] for column in columns]),
+            _like(),
+        ))
+        params += [kind, '%s%%' % connection.ops.prep_for_like_query(token)]
+    return '(%s)' % (' AND '.join(clauses) if clauses else '1 = 1'), params
+
+
+def _relevance(q, columns):
+    """
+    gets an SQL expression (and its params) that ranks a row by how relevant it is to the given query
+    0 if any of the given columns is the query, 1 if any begins with it, otherwise 2 (i.e. some word of a column begins
+    with each word of the query)
+    """
+    q = q.strip().lower()
+    if not q:
+        return '0', []
+    columns = ['LOWER(%s)' % column for column in columns]
+    sql = 'CASE WHEN %s THEN 0 WHEN %s THEN 1 ELSE 2 END' % (
+        ' OR '.join(['%s = %%s' % column for column in columns]),
+        ' OR '.join([' '.join([column, _like()]) for column in columns]),
+    )
+    params = [q] * len(columns) + ['%s%%' % connection.ops.prep_for_like_query(q)] * len(columns)
+    return sql, params
+
+
+def _like():
+    """
+    gets a LIKE operator, like Django's startswith lookup but without the BINARY (on MySQL) that would stop an index
+    being used (so the operands must already be normalised)
+    """
+    return "LIKE %s ESCAPE '\\'" if connection.vendor == 'sqlite' else 'LIKE %s'
+
+
+def _concat(*expressions):
+    """
+    gets an SQL expression that concatenates the given SQL expressions
+    """
+    if connection.vendor == 'mysql':
+        return 'CONCAT(%s)' % ', '.join(expressions)
+    return '(%s)' % ' || '.join(expressions)
+
+
+def get_visibility(user):
+    """
+    gets what is visible to the given (non super) user, as a dictionary of
+    'user_ids': a sorted array of the ids of visible (other) users (see _get_visible_user_ids and _get_visible_tutor_ids)
+    'course_ids': a set of the ids of the user's courses
+    'groups': a set of (course id, group id) pairs of the user's groups
+    this is cached per user, so that it's reused across a typing session, and invalidated (by signals) whenever course
+    or group memberships change (see invalidate_visibility)
+    """
+    key = _get_visibility_cache_key(user.id)
+    visibility = cache.get(key)
+
+    # the user's date joined is stored too, so that a recycled user id can't be given another user's visibility
+    if visibility is None or visibility['date_joined'] != user.date_joined:
+        visibility = {
+            'date_joined': user.date_joined,
+            'user_ids': array('l', sorted(set(_get_visible_user_ids(user) + _get_visible_tutor_ids(user)))),
+            'course_ids': frozenset(CourseMember.objects.filter(user=user).values_list('vle_course_id', flat=True)),
+            'groups': frozenset(GroupMember.objects.filter(user=user).values_list('vle_course_id', 'vle_group_id')),
         }
-        for course in c
-    ], c.count()
+        timeout = getattr(settings, 'MESSAGING_VISIBILITY_CACHE_TIMEOUT', 3600)
+        cache.set(key, visibility, timeout)
+    return visibility
+
+
+def invalidate_visibility(user_ids):
+    """
+    invalidates the cached visibility (and cached searches, see search_cache) of each of the given users
+    """
+    cache.delete_many([_get_visibility_cache_key(user_id) for user_id in user_ids])
+    search_cache.invalidate(user_ids)
+
+
+def _get_visibility_cache_key(user_id):
+    return 'messaging.search.visibility.%d' % user_id
 
 
 def _get_visible_user_ids(user):
@@ -173,18 +436,46 @@ def _get_visible_tutor_ids(user):
     """
 
     # if the given user isn't a tutor in at least one course, they can't see other tutors
-    if not CourseMember.objects.filter(user=user, is_tutor=True).exists():
+    tutor_ids = get_tutor_ids()
+    if not _contains(tutor_ids, user.id):
         return []
 
     # otherwise, return a list of all (other) user ids who are tutors in at least one course
-    cursor = connection.cursor()
-    sql = """
-        SELECT DISTINCT cm.user_id
-        FROM vle_coursemember cm
-        WHERE cm.user_id != %s
-            AND cm.is_tutor = %s
-        ORDER BY 1
+    return [tutor_id for tutor_id in tutor_ids if tutor_id != user.id]
+
+
+def get_tutor_ids():
+    """
+    gets a sorted array of the ids of all users who are tutors in at least one course
+    this is cached (for everyone), and invalidated (by signals) whenever a tutor's course membership changes (see
+    invalidate_tutor_ids), though bulk changes (which don't send signals) are only picked up when it times out
+    """
+    tutor_ids = cache.get(tutor_ids_key)
+    if tutor_ids is None:
+        cursor = connection.cursor()
+        sql = """
+            SELECT DISTINCT cm.user_id
+            FROM vle_coursemember cm
+            WHERE cm.is_tutor = %s
+            ORDER BY 1
+        """
+        cursor.execute(sql, [True])
+        tutor_ids = array('l', [row[0] for row in cursor.fetchall()])
+        timeout = getattr(settings, 'MESSAGING_VISIBILITY_CACHE_TIMEOUT', 3600)
+        cache.set(tutor_ids_key, tutor_ids, timeout)
+    return tutor_ids
+
+
+def invalidate_tutor_ids():
+    """
+    invalidates the cached ids of all tutors
     """
-    cursor.execute(sql, [user.id, True])
+    cache.delete(tutor_ids_key)
 
-    return list(map(lambda t: t[0], cursor.fetchall()))
+
+def _contains(ids, _id):
+    """
+    whether the given sorted array of ids contains the given id
+    """
+    i = bisect_left(ids, _id)
+    return i < len(ids) and ids[i] == _id
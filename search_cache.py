@@ -0,0 +1,164 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# eviction policies
+LRU = 'lru'
+FIFO = 'fifo'
+
+# the (per process) cache, and a lock around getting and using it
+_result_cache = None
+_lock = threading.Lock()
+
+
+class ResultCache(object):
+    """
+    a bounded, short lived cache of search results, so that paging through the results of the same search doesn't redo
+    the search
+    an entry maps a key (see get_key) to the ordered rows of the search (or the first so many of them) and its total
+    count
+    when the cache is full, the least recently used entry (LRU) or the oldest entry (FIFO) is evicted
+    """
+
+    def __init__(self, size=1000, timeout=30, eviction=LRU):
+        if eviction not in (LRU, FIFO):
+            raise ImproperlyConfigured('unknown search result cache eviction policy %r' % eviction)
+        self.size = size
+        self.timeout = timeout
+        self.eviction = eviction
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.overflows = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """
+        gets the entry for the given key, or None if there isn't one (or it has expired)
+        """
+        item = self.entries.get(key)
+        if item is not None and time.time() - item[0] >= self.timeout:
+            del self.entries[key]
+            self.expirations += 1
+            item = None
+        if item is None:
+            self.misses += 1
+            return None
+        if self.eviction == LRU:
+            # re-insert the entry, so that it's the most recently used
+            del self.entries[key]
+            self.entries[key] = item
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, entry):
+        """
+        sets the entry for the given key, evicting other entries if the cache is full
+        """
+        self.entries.pop(key, None)
+        while self.entries and len(self.entries) >= self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        if self.size > 0:
+            self.entries[key] = (time.time(), entry)
+
+    def invalidate(self, user_ids):
+        """
+        removes the entries of the given users
+        """
+        user_ids = set(user_ids)
+        for key in [key for key in self.entries if key[0] in user_ids]:
+            del self.entries[key]
+
+    def stats(self):
+        """
+        gets a dictionary of the cache's metrics
+        a page that is beyond the cached rows of an entry counts as an overflow (as well as a hit)
+        """
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'overflows': self.overflows,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+        }
+
+
+def get_key(user, q, exclude):
+    """
+    gets the cache key of a search, from the searching user's id, the normalised query (see search._relevance) and the
+    (type, id) pairs of the excluded recipients (in any order)
+    """
+    exclude = frozenset((r.get('type', ''), str(r.get('id'))) for r in exclude if r.get('id', ''))
+    return user.id, q.strip().lower(), exclude
+
+
+def get_entry(key):
+    """
+    gets the cached entry of a search (see ResultCache.get)
+    """
+    with _lock:
+        return _get_result_cache().get(key)
+
+
+def set_entry(key, entry):
+    """
+    caches the entry of a search (see ResultCache.set)
+    """
+    with _lock:
+        _get_result_cache().set(key, entry)
+
+
+def record_overflow():
+    """
+    records that a page was beyond the cached rows of a search
+    """
+    with _lock:
+        _get_result_cache().overflows += 1
+
+
+def invalidate(user_ids):
+    """
+    removes the cached searches of the given users (in this process, other processes' entries expiring in time)
+    """
+    with _lock:
+        if _result_cache is not None:
+            _result_cache.invalidate(user_ids)
+
+
+def stats():
+    """
+    gets the metrics of this process's cache (see ResultCache.stats)
+    """
+    with _lock:
+        return _get_result_cache().stats()
+
+
+def clear():
+    """
+    empties this process's cache and resets its metrics
+    """
+    global _result_cache
+    with _lock:
+        _result_cache = None
+
+
+def _get_result_cache():
+    """
+    gets this process's cache, (re)creating it if it doesn't exist or its settings have changed
+    """
+    global _result_cache
+    size = getattr(settings, 'MESSAGING_SEARCH_RESULT_CACHE_SIZE', 1000)
+    timeout = getattr(settings, 'MESSAGING_SEARCH_RESULT_CACHE_TIMEOUT', 30)
+    eviction = getattr(settings, 'MESSAGING_SEARCH_RESULT_CACHE_EVICTION', LRU)
+    if _result_cache is None or (_result_cache.size, _result_cache.timeout, _result_cache.eviction) != (
+            size, timeout, eviction):
+        _result_cache = ResultCache(size=size, timeout=timeout, eviction=eviction)
+    return _result_cache
@@ -0,0 +1,86 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from vle.models import CourseMember, GroupMember, CourseKVStore, GroupKVStore
+from .models import RecipientToken
+from .search import invalidate_visibility, get_tutor_ids, invalidate_tutor_ids
+from . import autocomplete
+
+
+@receiver(post_save, sender=CourseMember)
+def course_member_saved(sender, instance, created, **kwargs):
+    """
+    a course member changes what's visible to every member of the course (and, if a tutor, to every tutor)
+    an existing course member may have stopped being a tutor, so changing one also invalidates every tutor
+    """
+    _invalidate_course_member_visibility(instance, tutors=instance.is_tutor or not created)
+
+
+@receiver(post_delete, sender=CourseMember)
+def course_member_deleted(sender, instance, **kwargs):
+    _invalidate_course_member_visibility(instance, tutors=instance.is_tutor)
+
+
+@receiver([post_save, post_delete], sender=GroupMember)
+def group_member_changed(sender, instance, **kwargs):
+    """
+    a group member only changes what's visible to that member
+    """
+    invalidate_visibility([instance.user_id])
+
+
+def _invalidate_course_member_visibility(course_member, tutors):
+    user_ids = set(CourseMember.objects.filter(vle_course_id=course_member.vle_course_id).values_list('user_id', flat=True))
+    if tutors:
+        # a course member who has just stopped being a tutor is no longer in the tutors, but is added below
+        user_ids.update(get_tutor_ids())
+        invalidate_tutor_ids()
+    user_ids.add(course_member.user_id)
+    invalidate_visibility(user_ids)
+
+
+@receiver(post_save, sender=get_user_model())
+def user_saved(sender, instance, raw=False, update_fields=None, **kwargs):
+    """
+    keeps the recipient index (and any in-process index) in sync with users
+    saving e.g. just a user's last login doesn't change what's indexed
+    """
+    if raw or (update_fields is not None and not set(update_fields) & {'first_name', 'last_name', 'username', 'email'}):
+        return
+    RecipientToken.index_user(instance)
+    _record_change((RecipientToken.USER, instance.id, None, None))
+
+
+@receiver(post_delete, sender=get_user_model())
+def user_deleted(sender, instance, **kwargs):
+    """
+    a deleted user's tokens are deleted along with it, but any in-process index needs to know
+    """
+    _record_change((RecipientToken.USER, instance.id, None, None))
+
+
+@receiver([post_save, post_delete], sender=GroupKVStore)
+def group_changed(sender, instance, raw=False, **kwargs):
+    """
+    keeps the recipient index (and any in-process index) in sync with groups
+    """
+    if not raw:
+        RecipientToken.index_group(instance.vle_course_id, instance.vle_group_id)
+        _record_change((RecipientToken.GROUP, None, instance.vle_course_id, instance.vle_group_id))
+
+
+@receiver([post_save, post_delete], sender=CourseKVStore)
+def course_changed(sender, instance, raw=False, **kwargs):
+    """
+    keeps the recipient index (and any in-process index) in sync with courses
+    """
+    if not raw:
+        RecipientToken.index_course(instance.vle_course_id)
+        _record_change((RecipientToken.COURSE, None, instance.vle_course_id, None))
+
+
+def _record_change(entity):
+    if getattr(settings, 'MESSAGING_SEARCH_IN_PROCESS_INDEX', False):
+        autocomplete.record_change(entity)
@@ -0,0 +1,265 @@
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from mock import patch
+
+from messaging.models import Message, MessageAttachment, MessageBody, MessageItem, MessageTargetUser
+from messaging.models import ArchivedMessage, ArchivedMessageItem, ArchivedMessageTargetUser
+from messaging.models import RecipientToken
+from vle.models import CourseKVStore, GroupKVStore
+from messaging.management.commands.messaging_archive import archive_models
+
+
+class BackfillBodyHtmlTestCase(TestCase):
+
+    def test_backfill(self):
+        m1 = Message.objects.create(subject='foo', body='one\ntwo')
+        m2 = Message.objects.create(subject='bar', body='')
+        n = Message.objects.create(subject='woo', body='three\nfour', is_notification=True)
+        call_command('messaging_backfill_body_html', batch_size=1, stdout=StringIO())
+        self.assertEqual('one<br />two', Message.objects.get(pk=m1.pk).body_html)
+        self.assertEqual('', Message.objects.get(pk=m2.pk).body_html)
+        self.assertEqual('', Message.objects.get(pk=n.pk).body_html)
+
+
+class MigrateThreadsTestCase(TestCase):
+
+    def test_backfill_paths(self):
+        m1 = Message.objects.create(subject='foo')
+        m2 = Message.objects.create(subject='foo', parent=m1)
+        m3 = Message.objects.create(subject='foo', parent=m2)
+        Message.objects.all().update(path='')
+        call_command('messaging_migrate_threads', batch_size=1, stdout=StringIO())
+        self.assertEqual('', Message.objects.get(pk=m1.pk).path)
+        self.assertEqual('%d/' % m1.pk, Message.objects.get(pk=m2.pk).path)
+        self.assertEqual('%d/%d/' % (m1.pk, m2.pk), Message.objects.get(pk=m3.pk).path)
+
+    def test_backfill_paths_of_reply_to_old_reply(self):
+        # a reply to an old reply (whose path hasn't been backfilled) is missing the old reply's ancestors
+        m1 = Message.objects.create(subject='foo')
+        m2 = Message.objects.create(subject='foo', parent=m1)
+        Message.objects.all().update(path='')
+        m3 = Message.objects.create(subject='foo', parent=Message.objects.get(pk=m2.pk))
+        self.assertEqual('%d/' % m2.pk, Message.objects.get(pk=m3.pk).path)
+        out = StringIO()
+        call_command('messaging_migrate_threads', stdout=out)
+        self.assertIn('set the path of 2 messages', out.getvalue())
+        self.assertEqual('%d/%d/' % (m1.pk, m2.pk), Message.objects.get(pk=m3.pk).path)
+        with override_settings(MESSAGING_THREAD_MODEL='path'):
+            ancestors = Message.objects.get(pk=m3.pk).get_thread_ancestors()
+        self.assertListEqual([m3.pk, m2.pk, m1.pk], [m.pk for m in ancestors])
+
+    def test_rebuild_trees(self):
+        with override_settings(MESSAGING_THREAD_MODEL='path'):
+            m1 = Message.objects.create(subject='foo')
+            m2 = Message.objects.create(subject='foo', parent=m1)
+            m3 = Message.objects.create(subject='foo', parent=m2)
+        call_command('messaging_migrate_threads', rebuild_trees=True, stdout=StringIO())
+        self.assertEqual(0, Message.objects.filter(lft=0).count())
+        m3 = Message.objects.get(pk=m3.pk)
+        self.assertEqual(m1.tree_id, m3.tree_id)
+        self.assertListEqual([m3.pk, m2.pk, m1.pk], list(map(lambda m: m.pk, m3.get_ancestors(ascending=True, include_self=True))))
+
+
+class PurgeTestCase(TestCase):
+
+    def setUp(self):
+        self.users = {}
+        for first_name in [u'Cersei', u'Jaime']:
+            self.users[first_name] = get_user_model().objects.create_user(
+                username='%s.lannister' % first_name.lower(),
+                email='%s.lannister@into.uk.com' % first_name.lower(),
+                first_name=first_name,
+                last_name='Lannister',
+                password='Wibble123!'
+            )
+        self.long_ago = timezone.now() - timedelta(days=100)
+
+    def _send(self, parent=None):
+        recipients = [
+            {
+                'id': self.users['Jaime'].id,
+                'type': u'u'
+            }
+        ]
+        m = Message.send_message(sender=self.users['Cersei'], recipients=recipients, subject='foo', body='', parent=parent)
+        Message.objects.filter(pk=m.pk).update(sent=self.long_ago)
+        return m
+
+    def test_purge(self):
+        # a thread whose items were all deleted long ago
+        m1 = self._send()
+        m2 = self._send(parent=m1)
+        self.assertTrue(MessageTargetUser.objects.filter(message=m2).exists())
+        MessageItem.objects.filter(message__tree_id=m1.tree_id).update(deleted=self.long_ago)
+
+        # a thread with one item deleted long ago and one item deleted recently
+        m3 = self._send()
+        MessageItem.objects.filter(message=m3, user=self.users['Jaime']).update(deleted=self.long_ago)
+        MessageItem.objects.filter(message=m3, user=self.users['Cersei']).update(deleted=timezone.now())
+
+        # a recent thread with no items
+        m4 = Message.objects.create(user=self.users['Cersei'], subject='foo')
+
+        call_command('messaging_purge', days=30, batch_size=1, sleep=0, stdout=StringIO())
+
+        # only message items deleted long ago are purged
+        self.assertEqual(0, MessageItem.objects.filter(message__tree_id=m1.tree_id).count())
+        self.assertEqual(1, MessageItem.objects.filter(message=m3).count())
+
+        # only the orphaned old thread is purged, along with its targets
+        self.assertFalse(Message.objects.filter(pk__in=[m1.pk, m2.pk]).exists())
+        self.assertEqual(0, MessageTargetUser.objects.filter(message_id__in=[m1.pk, m2.pk]).count())
+        self.assertTrue(Message.objects.filter(pk=m3.pk).exists())
+        self.assertTrue(Message.objects.filter(pk=m4.pk).exists())
+
+    @patch('django.core.files.storage.FileSystemStorage.delete')
+    def test_purge_attachment_files(self, mock_delete):
+        m = self._send()
+        MessageAttachment.objects.create(message=m, file='2015/01/01/foo.txt')
+        MessageItem.objects.filter(message=m).delete()
+
+        # the file is kept when deleting the rows fails
+        with patch('django.db.models.query.QuerySet.delete', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                call_command('messaging_purge', days=30, sleep=0, stdout=StringIO())
+        self.assertTrue(MessageAttachment.objects.filter(message=m).exists())
+        self.assertFalse(mock_delete.called)
+
+        # otherwise it's deleted after the rows
+        call_command('messaging_purge', days=30, sleep=0, stdout=StringIO())
+        self.assertFalse(MessageAttachment.objects.filter(message=m).exists())
+        mock_delete.assert_called_once_with('2015/01/01/foo.txt')
+
+
+class ArchiveTestCase(TestCase):
+
+    def setUp(self):
+        self.users = {}
+        for first_name in [u'Cersei', u'Jaime']:
+            self.users[first_name] = get_user_model().objects.create_user(
+                username='%s.lannister' % first_name.lower(),
+                email='%s.lannister@into.uk.com' % first_name.lower(),
+                first_name=first_name,
+                last_name='Lannister',
+                password='Wibble123!'
+            )
+
+    def _send(self, parent=None, days_ago=0):
+        recipients = [
+            {
+                'id': self.users['Jaime'].id,
+                'type': u'u'
+            }
+        ]
+        m = Message.send_message(sender=self.users['Cersei'], recipients=recipients, subject='foo', body='', parent=parent)
+        Message.objects.filter(pk=m.pk).update(sent=timezone.now() - timedelta(days=days_ago))
+        return m
+
+    def test_archive_tables_have_the_same_columns(self):
+        for (model, archive_model) in archive_models:
+            columns = set(f.column for f in model._meta.concrete_fields)
+            archive_columns = set(f.column for f in archive_model._meta.concrete_fields)
+            self.assertEqual(columns, archive_columns)
+
+    def test_archive(self):
+        # an old thread
+        m1 = self._send(days_ago=400)
+        m2 = self._send(parent=m1, days_ago=399)
+
+        # an old thread with a recent reply
+        m3 = self._send(days_ago=400)
+        m4 = self._send(parent=m3)
+
+        call_command('messaging_archive', days=365, batch_size=1, sleep=0, stdout=StringIO())
+
+        # only the old thread is archived, along with its items and targets
+        self.assertFalse(Message.objects.filter(pk__in=[m1.pk, m2.pk]).exists())
+        self.assertEqual(0, MessageItem.objects.filter(message_id__in=[m1.pk, m2.pk]).count())
+        self.assertEqual(2, ArchivedMessage.objects.filter(pk__in=[m1.pk, m2.pk], tree_id=m1.tree_id).count())
+        self.assertEqual(4, ArchivedMessageItem.objects.filter(message_id__in=[m1.pk, m2.pk]).count())
+        self.assertEqual(2, ArchivedMessageTargetUser.objects.filter(message_id__in=[m1.pk, m2.pk]).count())
+        self.assertEqual(m1.pk, ArchivedMessage.objects.get(pk=m2.pk).parent_id)
+        self.assertEqual(2, Message.objects.filter(pk__in=[m3.pk, m4.pk]).count())
+        self.assertFalse(ArchivedMessage.objects.filter(pk__in=[m3.pk, m4.pk]).exists())
+
+        # an archived thread can still be read
+        mi = ArchivedMessageItem.objects.get(message=m2, user=self.users['Jaime'])
+        (thread, total) = mi.get_thread()
+        self.assertEqual(2, total)
+        self.assertEqual([m2.pk, m1.pk], [x.message_id for x in thread])
+
+
+class RebuildRecipientIndexTestCase(TestCase):
+
+    def test_rebuild(self):
+        user = get_user_model().objects.create_user(
+            username='tl',
+            email='tl@into.uk.com',
+            first_name='Tywin',
+            last_name='Lannister',
+            password='Wibble123!'
+        )
+        CourseKVStore.objects.create(vle_course_id='c001', name='Course One (Maths)')
+        GroupKVStore.objects.create(vle_course_id='c001', vle_group_id='g001', name='Group One')
+        expected = set(RecipientToken.objects.values_list('token', 'kind', 'user_id', 'vle_course_id', 'vle_group_id'))
+
+        # a bulk update doesn't send signals, so leaves the index stale
+        get_user_model().objects.filter(pk=user.pk).update(first_name='Tytos')
+        RecipientToken.objects.filter(kind=RecipientToken.GROUP).delete()
+
+        call_command('messaging_rebuild_recipient_index', batch_size=2, stdout=StringIO())
+        tokens = set(RecipientToken.objects.values_list('token', 'kind', 'user_id', 'vle_course_id', 'vle_group_id'))
+        self.assertSetEqual(expected - {('tywin', RecipientToken.USER, user.id, '', '')} | {('tytos', RecipientToken.USER, user.id, '', '')}, tokens)
+
+
+class ExpireNotificationsTestCase(TestCase):
+
+    def setUp(self):
+        self.users = {}
+        for first_name in [u'Cersei', u'Jaime']:
+            self.users[first_name] = get_user_model().objects.create_user(
+                username='%s.lannister' % first_name.lower(),
+                email='%s.lannister@into.uk.com' % first_name.lower(),
+                first_name=first_name,
+                last_name='Lannister',
+                password='Wibble123!'
+            )
+        self.usernames = [u.username for u in self.users.values()]
+
+    def test_expire_notifications(self):
+        now = timezone.now()
+        n1 = Message.send_notification(self.usernames, 'http://foobar.com', 'expired', '', expires=now - timedelta(days=1))
+        n2 = Message.send_notification(self.usernames, 'http://foobar.com', 'expired too', '', expires=now - timedelta(seconds=1))
+        n3 = Message.send_notification(self.usernames, 'http://foobar.com', 'expires tomorrow', '', expires=now + timedelta(days=1))
+        n4 = Message.send_notification(self.usernames, 'http://foobar.com', 'never expires', '')
+
+        # expired notifications aren't shown, before they're deleted
+        (notifications, total) = MessageItem.get_notifications(self.users['Cersei'])
+        self.assertEqual(2, total)
+        self.assertListEqual([n4.pk, n3.pk], [mi.message_id for mi in notifications])
+
+        call_command('messaging_expire_notifications', batch_size=1, sleep=0, stdout=StringIO())
+
+        # only expired notifications (and their items) are deleted
+        self.assertFalse(Message.objects.filter(pk__in=[n1.pk, n2.pk]).exists())
+        self.assertEqual(0, MessageItem.objects.filter(message_id__in=[n1.pk, n2.pk]).count())
+        self.assertEqual(4, MessageItem.objects.filter(message_id__in=[n3.pk, n4.pk]).count())
+
+    @override_settings(MESSAGING_DEDUPLICATE_NOTIFICATION_BODIES=True)
+    def test_expire_notifications_deletes_unused_bodies(self):
+        now = timezone.now()
+        Message.send_notification(self.usernames, 'http://foobar.com', 'expired', 'only expired', expires=now - timedelta(days=1))
+        Message.send_notification(self.usernames, 'http://foobar.com', 'expired', 'shared', expires=now - timedelta(days=1))
+        Message.send_notification(self.usernames, 'http://foobar.com', 'current', 'shared')
+        self.assertEqual(2, MessageBody.objects.count())
+
+        call_command('messaging_expire_notifications', batch_size=1, sleep=0, stdout=StringIO())
+        self.assertListEqual(['shared'], list(MessageBody.objects.values_list('body', flat=True)))
@@ -1,9 +1,11 @@
 # -*- coding: UTF-8 -*-
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from django.contrib.auth import get_user_model
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import override_settings, CaptureQueriesContext
 from django.utils import timezone
 from django.utils.timezone import utc
 from django.utils.six import iteritems
@@ -13,7 +15,7 @@ from mock import patch, ANY
 
 from messaging.models import Message, MessageAttachment, MessageItem
 from messaging.models import MessageTargetUser, MessageTargetCourse, MessageTargetGroup
-from messaging.models import date_format, delimiter
+from messaging.models import date_format, delimiter, format_sent_display, SentDisplayFormatter
 from vle.models import CourseMember, GroupMember, expand_user_group_course_ids_to_user_ids
 
 
@@ -102,6 +104,28 @@ class ModelsTestCase(TestCase):
         self.assertEqual('c002', message_target_group[1].vle_course_id)
         self.assertEqual('g002', message_target_group[1].vle_group_id)
 
+    def test_send_message_renders_body_html(self):
+        recipients = [
+            {
+                'id': self.users['Jaime'].id,
+                'type': u'u'
+            }
+        ]
+        message = Message.send_message(sender=self.users['Cersei'], recipients=recipients, subject='Tyrion', body='<b>Dead</b>\nNow')
+        self.assertEqual('&lt;b&gt;Dead&lt;/b&gt;<br />Now', Message.objects.get(pk=message.pk).body_html)
+
+    def test_get_body_html_renders_when_not_backfilled(self):
+        m = Message.objects.create(subject='foo', body='one\ntwo')
+        self.assertEqual('', m.body_html)
+        self.assertEqual('one<br />two', m.get_body_html())
+
+    @override_settings(MESSAGING_DEDUPLICATE_NOTIFICATION_BODIES=True)
+    def test_get_body_html_renders_deduplicated_body(self):
+        m = Message.objects.create(subject='foo', body='one\ntwo', is_notification=True)
+        m = Message.objects.get(pk=m.pk)
+        self.assertEqual('', m.body)
+        self.assertEqual('one<br />two', m.get_body_html())
+
     @patch('messaging.models.send_mass_mail')
     def test_email_thread(self, mock_send_mass_mail):
         # create a message
@@ -219,6 +243,32 @@ class ModelsTestCase(TestCase):
         self.assertIsNotNone(m3.deleted)
         self.assertGreaterEqual(m3.deleted, now)
 
+    def test_mark_all_read_issues_one_update(self):
+        """
+        tests that marking many message items as read issues exactly one query
+        """
+        messages = list(map(lambda i: Message.objects.create(subject='foo %d' % i), range(0, 10)))
+        message_items = list(map(lambda m: MessageItem.objects.create(user=self.users['Cersei'], message=m), messages))
+        with self.assertNumQueries(1):
+            count = MessageItem.mark_all_read(message_items)
+        self.assertEqual(10, count)
+        self.assertEqual(0, MessageItem.objects.filter(user=self.users['Cersei'], read=None).count())
+
+    def test_mark_all_deleted_given_queryset(self):
+        """
+        tests that marking a queryset of message items as deleted updates it without evaluating it
+        """
+        now = timezone.now()
+        messages = list(map(lambda i: Message.objects.create(subject='foo %d' % i), range(0, 3)))
+        MessageItem.objects.create(user=self.users['Cersei'], message=messages[0])
+        MessageItem.objects.create(user=self.users['Cersei'], message=messages[1], deleted=now)
+        MessageItem.objects.create(user=self.users['Jaime'], message=messages[2])
+        with self.assertNumQueries(1):
+            count = MessageItem.mark_all_deleted(MessageItem.objects.filter(user=self.users['Cersei']))
+        self.assertEqual(1, count)
+        self.assertEqual(now, MessageItem.objects.get(message=messages[1]).deleted)
+        self.assertIsNone(MessageItem.objects.get(message=messages[2]).deleted)
+
     def test_message_instance_str(self):
         m = Message.objects.create(subject='foo')
         self.assertEqual('(Message) subject "foo" sent @ %s' % m.sent.strftime(date_format), str(m))
@@ -268,6 +318,34 @@ class ModelsTestCase(TestCase):
         m = Message.objects.create(subject=u'Mucho dinero £££')
         self.assertEqual(type(m.__str__()), str)
 
+    def test_reply_path(self):
+        m1 = Message.objects.create(user=self.users['Cersei'], subject='foo')
+        m2 = Message.objects.create(user=self.users['Jaime'], subject='foo', parent=m1)
+        m3 = Message.objects.create(user=self.users['Cersei'], subject='foo', parent=m2)
+        self.assertEqual('', m1.path)
+        self.assertEqual('%d/' % m1.pk, m2.path)
+        self.assertEqual('%d/%d/' % (m1.pk, m2.pk), m3.path)
+        self.assertListEqual([m3, m2, m1], list(m3.get_thread_ancestors()))
+
+    @override_settings(MESSAGING_THREAD_MODEL='path')
+    def test_reply_with_path_thread_model(self):
+        m1 = Message.objects.create(user=self.users['Cersei'], subject='foo')
+        m2 = Message.objects.create(user=self.users['Jaime'], subject='foo', parent=m1)
+        m3 = Message.objects.create(user=self.users['Cersei'], subject='foo', parent=m2)
+        m4 = Message.objects.create(user=self.users['Tywin'], subject='foo', parent=m1)
+
+        # replies are in the same tree at the right level, but the tree isn't renumbered
+        for (m, level) in [(m2, 1), (m3, 2), (m4, 1)]:
+            m = Message.objects.get(pk=m.pk)
+            self.assertEqual(m1.tree_id, m.tree_id)
+            self.assertEqual(level, m.level)
+            self.assertEqual(0, m.lft)
+        self.assertEqual(2, Message.objects.get(pk=m1.pk).rght)
+
+        # ancestors come from the path
+        self.assertListEqual([m3, m2, m1], Message.objects.get(pk=m3.pk).get_thread_ancestors())
+        self.assertListEqual([m4, m1], Message.objects.get(pk=m4.pk).get_thread_ancestors())
+
 
 class InboxTestCase(TestCase):
     def setUp(self):
@@ -346,6 +424,32 @@ class InboxTestCase(TestCase):
         (inbox, count) = MessageItem.get_inbox(self.users['Cersei'])
         self.assertEqual(0, count)
 
+    def test_mark_thread_deleted(self):
+        # create another thread
+        recipients = [
+            {
+                'id': self.users['Cersei'].id,
+                'type': u'u'
+            }
+        ]
+        thread2 = Message.send_message(sender=self.users['Tywin'], recipients=recipients, subject='Loras Tyrell', body='Marry him!')
+
+        # delete one message item in the thread up front
+        mi = MessageItem.objects.get(user=self.users['Cersei'], message=self.thread)
+        mi.deleted = timezone.now()
+        mi.save()
+
+        # mark the rest of the thread deleted in one UPDATE
+        with CaptureQueriesContext(connection) as queries:
+            count = MessageItem.mark_thread_deleted(self.users['Cersei'], self.thread.tree_id)
+        self.assertEqual(1, len([q for q in queries.captured_queries if q['sql'].startswith('UPDATE')]))
+        self.assertEqual(3, count)
+        self.assertEqual(4, MessageItem.objects.filter(user=self.users['Cersei'], message__tree_id=self.thread.tree_id, deleted__isnull=False).count())
+
+        # other users and other threads are untouched
+        self.assertEqual(0, MessageItem.objects.filter(user=self.users['Jaime'], deleted__isnull=False).count())
+        self.assertIsNone(MessageItem.objects.get(user=self.users['Cersei'], message=thread2).deleted)
+
     def test_get_undeleted_message_item_count_for_message_trees(self):
         # create another thread
         recipients = [
@@ -588,3 +692,63 @@ class ThreadTestCase(TestCase):
         self.assertEqual(top_level_mi, mi)
         self.assertEqual(self.sand_snakes['Obara'], mi.user)
         self.assertIsNone(mi.deleted)
+
+    def test_keyset_pagination(self):
+        # get Obara's message item
+        top_level_mi = MessageItem.objects.get(user=self.sand_snakes['Obara'], message=self.thread)
+
+        # have the Sand Snakes reply to it three times
+        replies = []
+        for hour in [10, 11, 12]:
+            m = Message.send_message(sender=self.sand_snakes['Tyene'], recipients=self.sand_snake_recipients, subject='Justice for Elia', body='', parent=self.thread)
+            m.sent = datetime(year=2014, month=7, day=28, hour=hour, minute=0, second=0).replace(tzinfo=utc)
+            m.save()
+            replies.append(MessageItem.objects.get(user=self.sand_snakes['Obara'], message=m))
+
+        # get the first page (newest first)
+        (t, count) = top_level_mi.get_thread(limit=2)
+        self.assertEqual(4, count)
+        self.assertListEqual([replies[2].id, replies[1].id], list(map(lambda mi: mi.id, t)))
+
+        # get the next page
+        (t, count) = top_level_mi.get_thread(limit=2, before=replies[1].id)
+        self.assertEqual(4, count)
+        self.assertListEqual([replies[0].id, top_level_mi.id], list(map(lambda mi: mi.id, t)))
+
+        # get items newer than the oldest reply (still newest first)
+        (t, count) = top_level_mi.get_thread(since=replies[0].id)
+        self.assertEqual(4, count)
+        self.assertListEqual([replies[2].id, replies[1].id], list(map(lambda mi: mi.id, t)))
+
+        # get at most one item newer than the oldest reply (the one immediately after it)
+        (t, count) = top_level_mi.get_thread(limit=1, since=replies[0].id)
+        self.assertListEqual([replies[1].id], list(map(lambda mi: mi.id, t)))
+
+    def test_cursor_must_belong_to_user(self):
+        top_level_mi = MessageItem.objects.get(user=self.sand_snakes['Obara'], message=self.thread)
+        other_mi = MessageItem.objects.get(user=self.sand_snakes['Tyene'], message=self.thread)
+        with self.assertRaises(MessageItem.DoesNotExist):
+            top_level_mi.get_thread(limit=2, before=other_mi.id)
+
+
+class SentDisplayFormatterTestCase(TestCase):
+
+    def _sents(self):
+        now = timezone.now()
+        return [now, now - timedelta(minutes=5), now - timedelta(days=1), now - timedelta(days=1, hours=1), now - timedelta(days=40)]
+
+    def test_same_as_format_sent_display(self):
+        for tz in ['UTC', 'Europe/London', 'Asia/Kolkata', 'America/Los_Angeles']:
+            with timezone.override(tz):
+                sents = self._sents()
+                expected = [format_sent_display(sent) for sent in sents]
+                formatter = SentDisplayFormatter()
+                self.assertListEqual(expected, [formatter.format(sent) for sent in sents])
+                self.assertListEqual(expected, formatter.format_all(sents))
+
+    def test_today_is_got_once(self):
+        formatter = SentDisplayFormatter()
+        sents = self._sents()
+        with patch('django.utils.timezone.now') as mock_now:
+            formatter.format_all(sents)
+        self.assertFalse(mock_now.called)
@@ -1,8 +1,11 @@
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.test import TestCase
+from django.test.utils import override_settings
 
-from messaging.search import search, _get_visible_user_ids, _get_visible_tutor_ids
-from messaging.models import delimiter
+from messaging import autocomplete, search_cache
+from messaging.search import search, get_visibility, get_tutor_ids, _get_visible_user_ids, _get_visible_tutor_ids
+from messaging.models import delimiter, tokenise, RecipientToken
 from vle.models import CourseMember, GroupMember, CourseKVStore, GroupKVStore
 
 
@@ -393,6 +396,41 @@ class SearchGroupsTestCase(TestCase):
             'type': u'g'
         }, groups[0])
 
+    def _create_catalogue(self, courses=50, groups_per_course=4):
+        for i in range(0, courses):
+            CourseKVStore.objects.create(vle_course_id='cat%03d' % i, name='Catalogue Course %03d' % i)
+            for j in range(0, groups_per_course):
+                GroupKVStore.objects.create(vle_course_id='cat%03d' % i, vle_group_id='g%03d' % j, name='Catalogue Group %03d' % j)
+
+    def test_search_query_count_for_large_catalogue(self):
+        self._create_catalogue()
+        with self.assertNumQueries(1):
+            (groups, count, _) = search(q='catalogue group', user=self.admin, per_page=5, page=1)
+        self.assertEqual(200, count)
+        self.assertListEqual([
+            'Catalogue Course 001 - Catalogue Group 000 (Group)',
+            'Catalogue Course 001 - Catalogue Group 001 (Group)',
+            'Catalogue Course 001 - Catalogue Group 002 (Group)',
+            'Catalogue Course 001 - Catalogue Group 003 (Group)',
+            'Catalogue Course 002 - Catalogue Group 000 (Group)',
+        ], [g['name'] for g in groups])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'groups'}})
+    def test_search_query_count_for_large_catalogue_with_visibility(self):
+        cache.clear()
+        self._create_catalogue()
+        GroupMember.objects.bulk_create([
+            GroupMember(user=self.user, vle_course_id='cat%03d' % i, vle_group_id='g000')
+            for i in range(0, 50)
+        ])
+
+        # the first search caches the user's visibility, after which each search is a single query
+        search(q='catalogue', user=self.user)
+        with self.assertNumQueries(1):
+            (groups, count, _) = search(q='catalogue', user=self.user, per_page=5)
+        self.assertEqual(50, count)
+        self.assertEqual('Catalogue Course 000 - Catalogue Group 000 (Group)', groups[0]['name'])
+
 
 class SearchCoursesTestCase(TestCase):
 
@@ -515,6 +553,367 @@ class SearchCoursesTestCase(TestCase):
         self.assertEqual(0, count)
 
 
+class SearchPaginationTestCase(TestCase):
+
+    password = 'Wibble123!'
+
+    def setUp(self):
+        # some Starks, a course and a group (whose names interleave)
+        for first_name in [u'Arya', u'Bran', u'Rickon', u'Sansa']:
+            get_user_model().objects.create_user(
+                username='%s.stark' % first_name,
+                email='%s.stark@into.uk.com' % first_name,
+                first_name=first_name,
+                last_name='Stark',
+                password=self.password,
+            )
+        CourseKVStore.objects.create(vle_course_id='c001', name='Bran Stark Studies')
+        GroupKVStore.objects.create(vle_course_id='c001', vle_group_id='g001', name='Stark Group')
+
+        # a super user
+        self.admin = get_user_model().objects.create_superuser(
+            username='admin',
+            email='admin@into.uk.com',
+            first_name='Admin',
+            last_name='User',
+            password=self.password,
+        )
+
+    def test_pages_are_sorted_by_relevance_then_type_then_name(self):
+        names = []
+        for page in range(0, 3):
+            (results, count, _) = search(q='stark', user=self.admin, per_page=2, page=page)
+            self.assertEqual(6, count)
+            names += [r['name'] for r in results]
+        self.assertListEqual([
+            'Arya Stark',  # last name is 'stark'
+            'Bran Stark',
+            'Rickon Stark',
+            'Sansa Stark',
+            'Bran Stark Studies - Stark Group (Group)',  # name begins with 'stark'
+            'Bran Stark Studies (Module)',  # a word of the name begins with 'stark'
+        ], names)
+
+    def test_exact_match_first(self):
+        (results, count, _) = search(q='Bran', user=self.admin)
+        self.assertListEqual([
+            'Bran Stark',
+            'Bran Stark Studies (Module)',
+        ], [r['name'] for r in results])
+        (results, count, _) = search(q='bran stark', user=self.admin)
+        self.assertEqual('Bran Stark', results[0]['name'])
+
+    def test_page_beyond_the_last_still_has_total(self):
+        (results, count, _) = search(q='stark', user=self.admin, per_page=2, page=5)
+        self.assertListEqual([], results)
+        self.assertEqual(6, count)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'visibility'}})
+class VisibilityCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+        # some Lannisters, two of whom are in course 001
+        self.users = {}
+        for first_name in [u'Cersei', u'Tyrion', u'Tywin']:
+            self.users[first_name] = get_user_model().objects.create_user(
+                username='%s.lannister' % first_name,
+                email='%s.lannister@into.uk.com' % first_name,
+                first_name=first_name,
+                last_name='Lannister',
+                password='Wibble123!'
+            )
+        CourseMember.objects.create(user=self.users['Tyrion'], vle_course_id='001', is_tutor=True)
+        CourseMember.objects.create(user=self.users['Tywin'], vle_course_id='001')
+
+    def test_visibility_is_cached(self):
+        visibility = get_visibility(self.users['Tyrion'])
+        with self.assertNumQueries(0):
+            self.assertEqual(visibility, get_visibility(self.users['Tyrion']))
+        self.assertListEqual([self.users['Tywin'].id], list(visibility['user_ids']))
+        self.assertEqual(frozenset(['001']), visibility['course_ids'])
+        self.assertEqual(frozenset(), visibility['groups'])
+
+    def test_invalidated_by_course_members(self):
+        get_visibility(self.users['Tywin'])
+        CourseMember.objects.create(user=self.users['Cersei'], vle_course_id='001')
+        self.assertListEqual(sorted([
+            self.users['Cersei'].id,
+            self.users['Tyrion'].id,
+        ]), list(get_visibility(self.users['Tywin'])['user_ids']))
+        CourseMember.objects.filter(user=self.users['Cersei']).delete()
+        self.assertListEqual([self.users['Tyrion'].id], list(get_visibility(self.users['Tywin'])['user_ids']))
+
+    def test_invalidated_by_tutors(self):
+        get_visibility(self.users['Tyrion'])
+        CourseMember.objects.create(user=self.users['Cersei'], vle_course_id='002', is_tutor=True)
+        self.assertIn(self.users['Cersei'].id, get_visibility(self.users['Tyrion'])['user_ids'])
+
+    def test_invalidated_by_group_members(self):
+        get_visibility(self.users['Tyrion'])
+        GroupMember.objects.create(user=self.users['Tyrion'], vle_course_id='001', vle_group_id='g001')
+        self.assertEqual(frozenset([('001', 'g001')]), get_visibility(self.users['Tyrion'])['groups'])
+
+    def test_tutor_ids_are_cached(self):
+        self.assertListEqual([self.users['Tyrion'].id], list(get_tutor_ids()))
+        with self.assertNumQueries(0):
+            self.assertListEqual([], _get_visible_tutor_ids(self.users['Tywin']))
+            self.assertListEqual([], _get_visible_tutor_ids(self.users['Tyrion']))
+
+    def test_tutor_ids_invalidated_by_tutors(self):
+        get_tutor_ids()
+        course_member = CourseMember.objects.create(user=self.users['Cersei'], vle_course_id='002', is_tutor=True)
+        self.assertListEqual(sorted([self.users['Cersei'].id, self.users['Tyrion'].id]), list(get_tutor_ids()))
+        course_member.is_tutor = False
+        course_member.save()
+        self.assertListEqual([self.users['Tyrion'].id], list(get_tutor_ids()))
+        self.assertListEqual([self.users['Tywin'].id], list(get_visibility(self.users['Tyrion'])['user_ids']))
+
+    @override_settings(MESSAGING_SEARCH_VISIBLE_USER_IDS_MAX=0)
+    def test_visibility_resolved_within_query(self):
+        CourseMember.objects.create(user=self.users['Cersei'], vle_course_id='002', is_tutor=True)
+        (users, count, _) = search(q='lannister', user=self.users['Tyrion'])
+        self.assertListEqual(['Cersei Lannister', 'Tywin Lannister'], [u['name'] for u in users])
+        (users, count, _) = search(q='lannister', user=self.users['Tywin'])
+        self.assertListEqual(['Tyrion Lannister'], [u['name'] for u in users])
+
+
+class RecipientIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='tywin.lannister',
+            email='tywin.lannister@into.uk.com',
+            first_name='Tywin',
+            last_name='Lannister',
+            password='Wibble123!'
+        )
+        self.admin = get_user_model().objects.create_superuser(
+            username='admin',
+            email='admin@into.uk.com',
+            first_name='Admin',
+            last_name='User',
+            password='Wibble123!',
+        )
+
+    def test_tokenise(self):
+        self.assertSetEqual({'tywin', 'lannister', 'into', 'uk', 'com'}, tokenise('Tywin.Lannister@INTO.uk.com'))
+        self.assertSetEqual({'course', 'one', 'maths'}, tokenise('Course One (Maths)', ''))
+
+    def test_search_by_token_prefixes(self):
+        for q in ['tyw', 'LANN', 'tywin.lann', 'lannister@into', 'lann tyw']:
+            (users, count, _) = search(q=q, user=self.admin)
+            self.assertEqual(1, count, q)
+            self.assertEqual(self.user.id, users[0]['id'])
+        (users, count, _) = search(q='ywin', user=self.admin)
+        self.assertEqual(0, count)
+
+    def test_index_kept_in_sync(self):
+        # users
+        self.user.first_name = 'Tytos'
+        self.user.username = 'tytos.lannister'
+        self.user.email = 'tytos.lannister@into.uk.com'
+        self.user.save()
+        self.assertEqual(0, search(q='tywin', user=self.admin)[1])
+        self.assertEqual(1, search(q='tytos', user=self.admin)[1])
+        self.user.delete()
+        self.assertFalse(RecipientToken.objects.filter(kind=RecipientToken.USER, token='tytos').exists())
+
+        # groups and courses
+        course = CourseKVStore.objects.create(vle_course_id='c001', name='Course One (Maths)')
+        group = GroupKVStore.objects.create(vle_course_id='c001', vle_group_id='g001', name='Group One')
+        self.assertEqual(2, search(q='one', user=self.admin)[1])
+        group.delete()
+        course.name = 'Course One (Physics)'
+        course.save()
+        self.assertEqual(0, search(q='maths', user=self.admin)[1])
+        self.assertEqual(1, search(q='physics', user=self.admin)[1])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'autocomplete'}})
+class InProcessIndexTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        autocomplete._index = None
+
+        # some Lannisters, some courses and some groups
+        for first_name in [u'Cersei', u'Jaime', u'Tyrion', u'Tywin']:
+            get_user_model().objects.create_user(
+                username='%s.lannister' % first_name,
+                email='%s.lannister@into.uk.com' % first_name,
+                first_name=first_name,
+                last_name='Lannister',
+                password='Wibble123!'
+            )
+        CourseKVStore.objects.create(vle_course_id='c001', name='Course One (Maths)')
+        CourseKVStore.objects.create(vle_course_id='c002', name='Course Two (Lannister Studies)')
+        GroupKVStore.objects.create(vle_course_id='c001', vle_group_id='g001', name='Group One')
+        GroupKVStore.objects.create(vle_course_id='c002', vle_group_id='g001', name='Group One')
+
+        # a super user
+        self.admin = get_user_model().objects.create_superuser(
+            username='admin',
+            email='admin@into.uk.com',
+            first_name='Admin',
+            last_name='User',
+            password='Wibble123!',
+        )
+        self.exclude = [{'id': 'c001', 'type': u'c'}]
+
+    def _search_both_ways(self, q, **kwargs):
+        with self.settings(MESSAGING_SEARCH_IN_PROCESS_INDEX=True):
+            in_process = search(q=q, user=self.admin, **kwargs)
+        self.assertEqual(search(q=q, user=self.admin, **kwargs), in_process)
+        return in_process
+
+    def test_same_results_as_database(self):
+        for q in ['', 'ty', 'lannister', 'one', 'c00', 'group o', 'admin', 'nobody']:
+            self._search_both_ways(q)
+            self._search_both_ways(q, exclude=self.exclude, per_page=2, page=1)
+
+        # a course with more than one row is one result, named by its greatest name but found by any of its names
+        with self.settings(MESSAGING_SEARCH_IN_PROCESS_INDEX=True):
+            CourseKVStore.objects.create(vle_course_id='c002', name='Course Two (Westerlands)')
+        for q in ['', 'two', 'lannister', 'westerlands', 'c002']:
+            self._search_both_ways(q)
+        (results, count, _) = self._search_both_ways('lannister studies')
+        self.assertEqual(1, count)
+        self.assertEqual('Course Two (Westerlands) (Module)', results[0]['name'])
+
+    def test_answered_in_process(self):
+        self._search_both_ways('lannister')
+        with self.settings(MESSAGING_SEARCH_IN_PROCESS_INDEX=True):
+            with self.assertNumQueries(0):
+                (results, count, _) = search(q='lannister', user=self.admin)
+        self.assertEqual(5, count)
+
+    def test_refreshed_incrementally(self):
+        with self.settings(MESSAGING_SEARCH_IN_PROCESS_INDEX=True):
+            search(q='', user=self.admin)
+            index = autocomplete._index
+            get_user_model().objects.filter(username='Tywin.lannister').get().delete()
+            course = CourseKVStore.objects.get(vle_course_id='c001')
+            course.name = 'Course One (Physics)'
+            course.save()
+        self.assertEqual(1, self._search_both_ways('physics')[1])
+        self.assertEqual(4, self._search_both_ways('lannister')[1])
+        self._search_both_ways('one')
+
+        # the index was replaced by a refreshed copy (rather than rebuilt), leaving the index in use as it was
+        self.assertIsNot(index, autocomplete._index)
+        self.assertEqual(index.built, autocomplete._index.built)
+        self.assertEqual(set(), index.match('physics'))
+        self.assertEqual(5, len(index.match('lannister')))
+
+    def test_index_in_use_while_being_refreshed(self):
+        with self.settings(MESSAGING_SEARCH_IN_PROCESS_INDEX=True):
+            search(q='', user=self.admin)
+            index = autocomplete._index
+
+            # while another thread brings the index up to date, searches use the index as it is (without waiting)
+            with autocomplete._lock:
+                with self.assertNumQueries(0):
+                    self.assertIs(index, autocomplete.get_index())
+
+
+class ResultCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        search_cache.clear()
+
+        # some Lannisters, all in course 001
+        for first_name in [u'Cersei', u'Jaime', u'Kevan', u'Lancel', u'Tyrion', u'Tywin']:
+            u = get_user_model().objects.create_user(
+                username='%s.lannister' % first_name,
+                email='%s.lannister@into.uk.com' % first_name,
+                first_name=first_name,
+                last_name='Lannister',
+                password='Wibble123!'
+            )
+            CourseMember.objects.create(user=u, vle_course_id='001')
+        self.user = get_user_model().objects.get(username='Tyrion.lannister')
+
+        # a super user
+        self.admin = get_user_model().objects.create_superuser(
+            username='admin',
+            email='admin@into.uk.com',
+            first_name='Admin',
+            last_name='User',
+            password='Wibble123!'
+        )
+
+    def tearDown(self):
+        search_cache.clear()
+
+    def _search_cached(self, **kwargs):
+        with self.settings(MESSAGING_SEARCH_RESULT_CACHE=True):
+            return search(**kwargs)
+
+    def test_pages_served_from_cache(self):
+        with self.assertNumQueries(1):
+            first = self._search_cached(q='lannister', user=self.admin, per_page=2, page=0)
+        with self.assertNumQueries(0):
+            pages = [self._search_cached(q='lannister', user=self.admin, per_page=2, page=page) for page in range(1, 4)]
+        self.assertEqual(search(q='lannister', user=self.admin, per_page=2, page=0), first)
+        for page in range(1, 4):
+            self.assertEqual(search(q='lannister', user=self.admin, per_page=2, page=page), pages[page - 1])
+        self.assertListEqual([], pages[-1][0])
+        self.assertEqual(6, pages[-1][1])
+        stats = search_cache.stats()
+        self.assertEqual((1, 3, 0.75), (stats['misses'], stats['hits'], stats['hit_rate']))
+
+    def test_key_is_normalised(self):
+        exclude = [{'id': self.user.id, 'type': u'u'}, {'id': '001', 'type': u'c'}]
+        self._search_cached(q='Lannister', exclude=exclude, user=self.admin)
+        with self.assertNumQueries(0):
+            (users, count, _) = self._search_cached(q='  LANNISTER ', exclude=list(reversed(exclude)), user=self.admin)
+        self.assertEqual(5, count)
+        with self.assertNumQueries(1):
+            self._search_cached(q='lannister', user=self.admin)
+
+    def test_page_beyond_cached_results(self):
+        with self.settings(MESSAGING_SEARCH_RESULT_CACHE_MAX_RESULTS=4):
+            self._search_cached(q='lannister', user=self.admin, per_page=2, page=0)
+            with self.assertNumQueries(0):
+                self._search_cached(q='lannister', user=self.admin, per_page=2, page=1)
+            with self.assertNumQueries(1):
+                (users, count, _) = self._search_cached(q='lannister', user=self.admin, per_page=2, page=2)
+            self.assertEqual(1, search_cache.stats()['overflows'])
+        self.assertEqual(search(q='lannister', user=self.admin, per_page=2, page=2), (users, count, 2))
+
+    def test_invalidated_with_visibility(self):
+        self.assertEqual(5, self._search_cached(q='lannister', user=self.user)[1])
+        CourseMember.objects.filter(user__username='Tywin.lannister').delete()
+        self.assertEqual(4, self._search_cached(q='lannister', user=self.user)[1])
+
+    def test_evicts_least_recently_used(self):
+        result_cache = search_cache.ResultCache(size=2, eviction=search_cache.LRU)
+        result_cache.set('a', 1)
+        result_cache.set('b', 2)
+        self.assertEqual(1, result_cache.get('a'))
+        result_cache.set('c', 3)
+        self.assertListEqual(['a', 'c'], list(result_cache.entries))
+        self.assertEqual(1, result_cache.stats()['evictions'])
+
+    def test_evicts_oldest(self):
+        result_cache = search_cache.ResultCache(size=2, eviction=search_cache.FIFO)
+        result_cache.set('a', 1)
+        result_cache.set('b', 2)
+        self.assertEqual(1, result_cache.get('a'))
+        result_cache.set('c', 3)
+        self.assertListEqual(['b', 'c'], list(result_cache.entries))
+
+    def test_expires(self):
+        result_cache = search_cache.ResultCache(timeout=0)
+        result_cache.set('a', 1)
+        self.assertIsNone(result_cache.get('a'))
+        self.assertDictContainsSubset({'size': 0, 'misses': 1, 'expirations': 1}, result_cache.stats())
+
+
 class GetVisibleUserIdsTestCase(TestCase):
 
     course001 = '001'
@@ -1,26 +1,30 @@
 import base64
 import copy
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth import get_user_model
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.test import TestCase
-from django.test.utils import override_settings
+from django.test.utils import override_settings, CaptureQueriesContext
 from django.utils import timezone
 from django.utils.translation import gettext as _
 from django.utils.timezone import utc
 from django.utils.six import iteritems
 from django.utils.encoding import force_str
+from django.utils.six import StringIO
 
 import pytest
 from mock import patch, ANY
 
-from messaging.models import Message, MessageItem
+from messaging.models import Message, MessageBody, MessageItem, ArchivedMessageItem
 from messaging.models import MessageTargetUser, MessageTargetGroup, MessageTargetCourse
 from messaging.models import delimiter
-from vle.models import CourseMember, GroupKVStore, CourseKVStore
+from vle.models import CourseMember, GroupMember, GroupKVStore, CourseKVStore
 
 
 def _get_auth_headers():
@@ -500,6 +504,93 @@ class SendNotificationTestCase(TestCase):
         # count the number of MessageItems
         self.assertEqual(0, MessageItem.objects.filter(message=notification).count())
 
+    def test_send_notification_collapse_key(self):
+        def send(usernames, subject):
+            post_data = {
+                'usernames': usernames,
+                'url': self.url,
+                'subject': subject,
+                'body': self.body,
+                'collapse_key': 'assignment-1-submissions',
+            }
+            response = self.client.post(reverse('messaging_api:send_notification'), content_type='application/json', data=json.dumps(post_data), **self.auth_headers)
+            self.assertEqual(200, response.status_code)
+
+        # Cersei reads (and Jaime deletes) the first notification
+        send(['cersei.lannister', 'jaime.lannister'], '3 new submissions')
+        items = dict((mi.user.username, mi.id) for mi in MessageItem.objects.select_related('user'))
+        MessageItem.objects.filter(user=self.users['Cersei']).update(read=timezone.now())
+        MessageItem.objects.filter(user=self.users['Jaime']).update(deleted=timezone.now())
+
+        # the second notification replaces the first for Cersei and Jaime (and is new for Tyrion)
+        send(['cersei.lannister', 'jaime.lannister', 'tyrion.lannister'], '4 new submissions')
+        notification = Message.objects.get(is_notification=True)
+        self.assertEqual('4 new submissions', notification.subject)
+        self.assertEqual(3, MessageItem.objects.filter(message=notification, read=None, deleted=None).count())
+        for username in ['cersei.lannister', 'jaime.lannister']:
+            self.assertEqual(items[username], MessageItem.objects.get(user__username=username).id)
+
+        # the third notification replaces the second for Tyrion only, so the second is kept for Cersei and Jaime
+        send(['tyrion.lannister'], '5 new submissions')
+        self.assertListEqual(['4 new submissions', '5 new submissions'], list(Message.objects.order_by('subject').values_list('subject', flat=True)))
+        self.assertEqual(3, MessageItem.objects.count())
+
+        # a notification without a collapse key is always added
+        Message.send_notification(['tyrion.lannister'], self.url, '6 new submissions', self.body)
+        self.assertEqual(2, MessageItem.objects.filter(user=self.users['Tyrion']).count())
+
+    def test_send_notification_to_courses_and_groups(self):
+        CourseMember.objects.create(user=self.users['Cersei'], vle_course_id='c001')
+        CourseMember.objects.create(user=self.users['Jaime'], vle_course_id='c001')
+        GroupMember.objects.create(user=self.users['Tyrion'], vle_course_id='c002', vle_group_id='g001')
+
+        # make a request
+        post_data = {
+            'usernames': ['jaime.lannister', 'tywin.lannister', 'does.not.exist'],
+            'course_ids': ['c001'],
+            'group_ids': [delimiter.join(['c002', 'g001'])],
+            'url': self.url,
+            'subject': self.subject,
+            'body': self.body,
+        }
+        response = self.client.post(reverse('messaging_api:send_notification'), content_type='application/json', data=json.dumps(post_data), **self.auth_headers)
+        self.assertEqual(200, response.status_code)
+
+        # one message item per user, whether given by username, course or group
+        notification = Message.objects.get(is_notification=True)
+        self.assertSetEqual(
+            set([self.users[first_name].id for first_name in [u'Cersei', u'Jaime', u'Tyrion', u'Tywin']]),
+            set(MessageItem.objects.filter(message=notification).values_list('user_id', flat=True))
+        )
+        self.assertEqual(4, MessageItem.objects.count())
+
+        # the courses and groups are recorded as targets
+        self.assertListEqual(['c001'], list(MessageTargetCourse.objects.filter(message=notification).values_list('vle_course_id', flat=True)))
+        self.assertListEqual([('c002', 'g001')], list(MessageTargetGroup.objects.filter(message=notification).values_list('vle_course_id', 'vle_group_id')))
+
+    def test_send_notification_expires(self):
+        post_data = {
+            'usernames': ['cersei.lannister'],
+            'url': self.url,
+            'subject': self.subject,
+            'body': self.body,
+            'expires': '2015-06-01T12:00:00Z',
+        }
+        response = self.client.post(reverse('messaging_api:send_notification'), content_type='application/json', data=json.dumps(post_data), **self.auth_headers)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(datetime(2015, 6, 1, 12, 0, 0, tzinfo=utc), Message.objects.get(is_notification=True).expires)
+
+        # an expired notification isn't counted as unread
+        self.assertTrue(self.client.login(username='cersei.lannister', password=self.password))
+        response = self.client.get(''.join([reverse('messaging_api:get_unread_count'), '?n']), content_type='application/json')
+        self.assertEqual(0, json.loads(force_str(response.content))['count'])
+
+        # an invalid expiry is rejected
+        post_data['expires'] = 'next week'
+        response = self.client.post(reverse('messaging_api:send_notification'), content_type='application/json', data=json.dumps(post_data), **self.auth_headers)
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(1, Message.objects.filter(is_notification=True).count())
+
 
 class GetNotificationsTestCase(TestCase):
 
@@ -591,6 +682,65 @@ class GetNotificationsTestCase(TestCase):
         self.assertEqual(2, len(data['notifications']))
         self.assertEqual(12, data['total'])
 
+    def test_get_notification_pagination_by_cursor(self):
+        self.login('cersei.lannister')
+
+        # send some notifications
+        l = [('Subject %d' % i, 'Body %d' % i) for i in range(1, 13)]
+        list(map(lambda p: Message.send_notification(usernames=[self.users['Cersei'].username], url='http://foobar.com', subject=p[0], body=p[1]), l))
+
+        # page through (at 5 items per page), each page following on from the last item of the previous page
+        ids, url = [], ''.join([reverse('messaging_api:get_notifications'), '?more&per_page=5'])
+        for (length, more) in [(5, True), (5, True), (2, False)]:
+            before = '&before=%d' % ids[-1] if ids else ''
+            response = self.client.get(''.join([url, before]), content_type='application/json')
+            data = json.loads(force_str(response.content))
+            self.assertEqual(2, len(data))
+            self.assertEqual(length, len(data['notifications']))
+            self.assertEqual(more, data['more'])
+            ids.extend([n['id'] for n in data['notifications']])
+
+        # the pages are the same as paging by offset
+        self.assertListEqual([mi.id for mi in MessageItem.get_notifications(self.users['Cersei'])[0]], ids)
+
+    def test_get_notification_pagination_by_unknown_cursor(self):
+        self.login('cersei.lannister')
+        response = self.client.get(''.join([reverse('messaging_api:get_notifications'), '?more&before=1']), content_type='application/json')
+        self.assertEqual(404, response.status_code)
+
+    @override_settings(MESSAGING_DEDUPLICATE_NOTIFICATION_BODIES=True)
+    def test_get_notifications_with_deduplicated_bodies(self):
+        self.login('cersei.lannister')
+
+        # send some notifications, most of which have the same body
+        l = [('Subject %d' % i, 'Please review your vocabulary cards.') for i in range(1, 4)] + [('Subject 4', 'Something else.')]
+        list(map(lambda p: Message.send_notification(usernames=[self.users['Cersei'].username], url='http://foobar.com', subject=p[0], body=p[1]), l))
+
+        # each body is stored once
+        self.assertEqual(2, MessageBody.objects.count())
+        self.assertEqual(0, Message.objects.exclude(body='').count())
+
+        # bodies are returned as usual, still with one query per page
+        response = self.client.get(reverse('messaging_api:get_notifications'), content_type='application/json')
+        data = json.loads(force_str(response.content))
+        self.assertListEqual(list(reversed([p[1] for p in l])), [n['body'] for n in data['notifications']])
+        with self.assertNumQueries(1):
+            notifications = MessageItem.get_notifications_page(self.users['Cersei'], 5)
+            self.assertListEqual(list(reversed([p[1] for p in l])), [mi.message.get_body() for mi in notifications])
+
+    def test_get_notifications_page_query_count(self):
+        l = [('Subject %d' % i, 'Body %d' % i) for i in range(1, 13)]
+        list(map(lambda p: Message.send_notification(usernames=[self.users['Cersei'].username], url='http://foobar.com', subject=p[0], body=p[1]), l))
+
+        # each page is a single query (plus one for the cursor), including the messages
+        with self.assertNumQueries(1):
+            notifications = MessageItem.get_notifications_page(self.users['Cersei'], 5)
+            self.assertListEqual(['Subject 12', 'Subject 11', 'Subject 10', 'Subject 9', 'Subject 8'], [mi.message.subject for mi in notifications])
+            list(map(lambda mi: mi.message.get_sent_display(), notifications))
+        with self.assertNumQueries(2):
+            notifications = MessageItem.get_notifications_page(self.users['Cersei'], 5, before=notifications[-1].id)
+            self.assertListEqual(['Subject 7', 'Subject 6', 'Subject 5', 'Subject 4', 'Subject 3'], [mi.message.subject for mi in notifications])
+
 
 class MarkNotificationReadTestCase(TestCase):
 
@@ -634,6 +784,48 @@ class MarkNotificationReadTestCase(TestCase):
         self.assertIsNotNone(mi.read)
         self.assertGreaterEqual(mi.read, t0)
 
+    def _send_notifications(self, usernames):
+        l = [('Subject %d' % i, 'Body %d' % i) for i in range(1, 6)]
+        list(map(lambda p: Message.send_notification(usernames=usernames, url='http://foobar.com', subject=p[0], body=p[1]), l))
+        return list(MessageItem.get_notifications(self.users['Cersei'])[0])
+
+    def test_mark_all_notifications_read(self):
+        self.login('cersei.lannister')
+        jaime = get_user_model().objects.create_user(username='jaime.lannister', email='jaime.lannister@into.uk.com', password=self.password)
+        notifications = self._send_notifications(['cersei.lannister', 'jaime.lannister'])
+        MessageItem.objects.filter(pk=notifications[0].pk).update(read=timezone.now())
+
+        # make a request (marking everything read takes one UPDATE)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('messaging_api:mark_all_notifications_read'), content_type='application/json')
+        self.assertEqual(1, len([q for q in queries.captured_queries if q['sql'].startswith('UPDATE')]))
+        self.assertEqual(200, response.status_code)
+        data = json.loads(force_str(response.content))
+        self.assertEqual(4, data['count'])
+        self.assertEqual(0, data['unread'])
+
+        # only Cersei's notifications are marked as read
+        self.assertEqual(0, MessageItem.objects.filter(user=self.users['Cersei'], read=None).count())
+        self.assertEqual(5, MessageItem.objects.filter(user=jaime, read=None).count())
+
+    def test_mark_all_notifications_read_upto(self):
+        self.login('cersei.lannister')
+        notifications = self._send_notifications(['cersei.lannister'])
+
+        # mark the notifications up to (and including) the third newest
+        post_data = {'upto': notifications[2].id}
+        response = self.client.post(reverse('messaging_api:mark_all_notifications_read'), content_type='application/json', data=json.dumps(post_data))
+        self.assertEqual(200, response.status_code)
+        data = json.loads(force_str(response.content))
+        self.assertEqual(3, data['count'])
+        self.assertEqual(2, data['unread'])
+        self.assertListEqual([notifications[0].id, notifications[1].id], list(MessageItem.objects.filter(read=None).order_by('-id').values_list('id', flat=True)))
+
+        # a cursor that isn't one of the user's notifications is not found
+        post_data = {'upto': notifications[-1].id + 100}
+        response = self.client.post(reverse('messaging_api:mark_all_notifications_read'), content_type='application/json', data=json.dumps(post_data))
+        self.assertEqual(404, response.status_code)
+
 
 class GetInboxTestCase(TestCase):
 
@@ -731,6 +923,49 @@ class GetInboxTestCase(TestCase):
         self.assertEqual(2, len(data['messages']))
         self.assertEqual(12, data['total'])
 
+    def test_get_inbox_archived(self):
+        self.login('cersei.lannister')
+
+        # send two messages and archive the first (by making it old)
+        m1 = Message.send_message(sender=self.users['Tywin'], recipients=self.recipients, subject='Old', body='Old')
+        Message.send_message(sender=self.users['Tywin'], recipients=self.recipients, subject='New', body='New')
+        Message.objects.filter(pk=m1.pk).update(sent=timezone.now() - timedelta(days=400))
+        call_command('messaging_archive', days=365, sleep=0, stdout=StringIO())
+        self.assertFalse(Message.objects.filter(pk=m1.pk).exists())
+
+        # the archive isn't consulted unless asked to
+        response = self.client.get(reverse('messaging_api:get_inbox'), content_type='application/json')
+        data = json.loads(force_str(response.content))
+        self.assertEqual(1, data['total'])
+        self.assertEqual('New', data['messages'][0]['subject'])
+
+        # including archived threads
+        response = self.client.get(''.join([reverse('messaging_api:get_inbox'), '?archived=1']), content_type='application/json')
+        data = json.loads(force_str(response.content))
+        self.assertEqual(2, data['total'])
+        self.assertEqual(['New', 'Old'], [x['subject'] for x in data['messages']])
+        self.assertEqual([False, True], [x['archived'] for x in data['messages']])
+        self.assertEqual([1, 0], [x['unread'] for x in data['messages']])
+
+        # both inboxes are sorted and paginated as one
+        response = self.client.get(''.join([reverse('messaging_api:get_inbox'), '?archived=1&sort_dir=asc&per_page=1&page=1']), content_type='application/json')
+        data = json.loads(force_str(response.content))
+        self.assertEqual(2, data['total'])
+        self.assertEqual(['New'], [x['subject'] for x in data['messages']])
+        response = self.client.get(''.join([reverse('messaging_api:get_inbox'), '?archived=1&per_page=1&page=1']), content_type='application/json')
+        data = json.loads(force_str(response.content))
+        self.assertEqual(['Old'], [x['subject'] for x in data['messages']])
+        self.assertEqual([0], [x['unread'] for x in data['messages']])
+        miid = data['messages'][0]['id']
+
+        # an archived thread is only found in the archive, and isn't marked as read (so it counts as read in the inbox)
+        response = self.client.get(''.join([reverse('messaging_api:get_thread'), '?archived=1&miid=', str(miid)]), content_type='application/json')
+        self.assertEqual(200, response.status_code)
+        data = json.loads(force_str(response.content))
+        self.assertEqual('Old', data['subject'])
+        self.assertEqual(1, len(data['messages']))
+        self.assertIsNone(ArchivedMessageItem.objects.get(pk=miid).read)
+
 
 class GetUnreadCountTestCase(TestCase):
 
@@ -931,6 +1166,45 @@ class GetThreadTestCase(TestCase):
         read_states = list(map(lambda mi: mi.read >= before, message_items))
         self.assertTrue(all(read_states))
 
+    def test_paginated_thread(self):
+        self.login(self.sand_snakes['Obara'])
+
+        # get Obara's message item
+        top_level_mi = MessageItem.objects.get(user=self.sand_snakes['Obara'], message=self.thread)
+
+        # have two of the other Sand Snakes reply to it
+        m1 = Message.send_message(sender=self.sand_snakes['Tyene'], recipients=self.sand_snake_recipients, subject='Justice for Elia', body='', parent=self.thread)
+        m1.sent = datetime(year=2014, month=7, day=28, hour=10, minute=0, second=0).replace(tzinfo=utc)
+        m1.save()
+        m2 = Message.send_message(sender=self.sand_snakes['Nymeria'], recipients=self.sand_snake_recipients, subject='Justice for Elia', body='', parent=self.thread)
+        m2.sent = datetime(year=2014, month=7, day=28, hour=10, minute=30, second=0).replace(tzinfo=utc)
+        m2.save()
+        mi1 = MessageItem.objects.get(user=self.sand_snakes['Obara'], message=m1)
+        mi2 = MessageItem.objects.get(user=self.sand_snakes['Obara'], message=m2)
+
+        # make a request for the first page (at 2 items per page)
+        response = self.client.get(''.join([reverse('messaging_api:get_thread'), '?miid=', str(top_level_mi.id), '&per_page=2']), content_type='application/json')
+        data = json.loads(force_str(response.content))
+        self.assertEqual(3, data['total'])
+        self.assertTrue(data['more'])
+        self.assertListEqual([mi2.id, mi1.id], list(map(lambda x: x['id'], data['messages'])))
+
+        # only the message items on the first page are marked as read
+        self.assertIsNone(MessageItem.objects.get(pk=top_level_mi.id).read)
+        self.assertIsNotNone(MessageItem.objects.get(pk=mi1.id).read)
+
+        # make a request for the second page
+        response = self.client.get(''.join([reverse('messaging_api:get_thread'), '?miid=', str(top_level_mi.id), '&per_page=2&before=', str(mi1.id)]), content_type='application/json')
+        data = json.loads(force_str(response.content))
+        self.assertFalse(data['more'])
+        self.assertListEqual([top_level_mi.id], list(map(lambda x: x['id'], data['messages'])))
+
+        # make a request for anything newer than the newest message item
+        response = self.client.get(''.join([reverse('messaging_api:get_thread'), '?miid=', str(top_level_mi.id), '&per_page=2&since=', str(mi2.id)]), content_type='application/json')
+        data = json.loads(force_str(response.content))
+        self.assertFalse(data['more'])
+        self.assertEqual(0, len(data['messages']))
+
 
 class GetReplyInfoTestCase(TestCase):
 
@@ -1114,6 +1388,39 @@ class GetReplyInfoTestCase(TestCase):
         self.assertEqual(self.message.subject, data['subject'])
         self.assertEqual(self.message.body, data['body'])
 
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'reply-info'}})
+    def test_get_target_recipients_query_count(self):
+        cache.clear()
+
+        # send a message to many groups and courses
+        recipients = list(self.user_recipients)
+        for i in range(0, 30):
+            course_id = u'c%03d' % i
+            GroupKVStore.objects.create(vle_course_id=course_id, vle_group_id=self.group001, name=u'Group %d' % i)
+            CourseKVStore.objects.create(vle_course_id=course_id, name=u'Course %d' % i)
+            recipients.append({u'id': delimiter.join([course_id, self.group001]), u'type': u'g'})
+            recipients.append({u'id': course_id, u'type': u'c'})
+        message = Message.send_message(sender=self.oberyn, recipients=recipients, subject='Justice for Elia', body='')
+
+        # one query per type of target and per type of name lookup
+        with self.assertNumQueries(6):
+            targets = message.get_target_recipients()
+        self.assertEqual(len(self.user_recipients) + 60, len(targets))
+        self.assertEqual(u'Group 0', targets[len(self.user_recipients)]['name'])
+        self.assertEqual(u'Course 29', targets[-1]['name'])
+
+        # targets are cached, but their names aren't
+        with self.assertNumQueries(3):
+            self.assertListEqual(targets, message.get_target_recipients())
+
+        # so renamed and deleted groups and courses are seen straight away
+        GroupKVStore.objects.filter(vle_course_id=u'c000').update(name=u'Group Zero')
+        CourseKVStore.objects.filter(vle_course_id=u'c029').delete()
+        targets = message.get_target_recipients()
+        self.assertEqual(len(self.user_recipients) + 59, len(targets))
+        self.assertEqual(u'Group Zero', targets[len(self.user_recipients)]['name'])
+        self.assertEqual(u'Course 28', targets[-1]['name'])
+
 
 class DeleteMessageItemTestCase(TestCase):
 
@@ -1249,6 +1556,116 @@ class DeleteMessageItemTestCase(TestCase):
         self.assertEqual(3, mi.count())
 
 
+class BulkUpdateMessageItemsTestCase(TestCase):
+
+    password = 'Wibble123!'
+
+    def setUp(self):
+        # Oberyn
+        self.oberyn = get_user_model().objects.create_user(
+            username='oberyn.martell',
+            email='oberyn.martell@into.uk.com',
+            first_name='Oberyn',
+            last_name='Martell',
+            password=self.password
+        )
+
+        # the Sand Snakes
+        self.sand_snakes = {}
+        for first_name in [u'Nymeria', u'Tyene', u'Obara']:
+            u = get_user_model().objects.create_user(
+                username='%s.sand' % first_name.lower(),
+                email='%s.sand@into.uk.com' % first_name.lower(),
+                first_name=first_name,
+                last_name='Sand',
+                password=self.password
+            )
+            self.sand_snakes[first_name] = u
+
+        # user recipients
+        user_recipients = list(map(lambda p: {
+            u'id': p[1].id,
+            u'type': u'u'
+        }, iteritems(self.sand_snakes)))
+
+        # create a thread and a separate message
+        self.message = Message.send_message(sender=self.oberyn, recipients=user_recipients, subject='Justice for Elia', body='')
+        self.reply = Message.send_message(sender=self.sand_snakes['Tyene'], recipients=user_recipients, subject='Justice for Elia', body='Reply', parent=self.message)
+        self.other = Message.send_message(sender=self.oberyn, recipients=user_recipients, subject='Poison', body='')
+
+    def login(self, username):
+        login_successful = self.client.login(username=username, password=self.password)
+        self.assertTrue(login_successful)
+
+    def post(self, data):
+        return self.client.post(reverse('messaging_api:bulk_update_message_items'), content_type='application/json', data=json.dumps(data))
+
+    def test_invalid_action(self):
+        self.login(self.sand_snakes['Obara'])
+        mi = MessageItem.objects.get(user=self.sand_snakes['Obara'], message=self.other)
+        response = self.post({'action': 'explode', 'miids': [mi.id]})
+        self.assertEqual(400, response.status_code)
+
+    def test_invalid_ids(self):
+        self.login(self.sand_snakes['Obara'])
+        mi = MessageItem.objects.get(user=self.sand_snakes['Obara'], message=self.other)
+        l = [
+            {'miids': [mi.id, 'abc']}, {'threads': ['']}, {'miids': [None]}, {'miids': 5}, {'miids': str(mi.id)},
+            {'miids': True}, {'miids': [True]}, {'miids': [1.9]}, {'threads': {str(mi.id): mi.id}},
+        ]
+        for data in l:
+            data['action'] = 'read'
+            response = self.post(data)
+            self.assertEqual(400, response.status_code)
+            self.assertEqual('error', json.loads(force_str(response.content))['type'])
+        self.assertIsNone(MessageItem.objects.get(pk=mi.pk).read)
+
+        # ids may be strings of digits
+        response = self.post({'action': 'read', 'miids': [str(mi.id)]})
+        self.assertEqual(200, response.status_code)
+        self.assertIsNotNone(MessageItem.objects.get(pk=mi.pk).read)
+
+    def test_access_denied(self):
+        self.login(self.sand_snakes['Obara'])
+
+        # one of Obara's message items and one of Nymeria's
+        mi1 = MessageItem.objects.get(user=self.sand_snakes['Obara'], message=self.other)
+        mi2 = MessageItem.objects.get(user=self.sand_snakes['Nymeria'], message=self.other)
+
+        # make a request and check it wasn't successful
+        response = self.post({'action': 'read', 'miids': [mi1.id, mi2.id]})
+        self.assertEqual(403, response.status_code)
+
+        # check nothing was updated
+        self.assertEqual(0, MessageItem.objects.filter(user=self.sand_snakes['Obara'], read__isnull=False).count())
+
+    def test_read_unread_and_delete(self):
+        self.login(self.sand_snakes['Obara'])
+        obara = self.sand_snakes['Obara']
+        mi = MessageItem.objects.get(user=obara, message=self.message)
+        other_mi = MessageItem.objects.get(user=obara, message=self.other)
+
+        # mark the thread and the other message as read
+        response = self.post({'action': 'read', 'threads': [mi.id], 'miids': [other_mi.id]})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(3, json.loads(force_str(response.content))['count'])
+        self.assertEqual(0, MessageItem.objects.filter(user=obara, read__isnull=True).count())
+
+        # mark the other message as unread
+        response = self.post({'action': 'unread', 'miids': [other_mi.id]})
+        self.assertEqual(1, json.loads(force_str(response.content))['count'])
+        self.assertIsNone(MessageItem.objects.get(pk=other_mi.id).read)
+
+        # delete the thread
+        response = self.post({'action': 'delete', 'threads': [mi.id]})
+        self.assertEqual(2, json.loads(force_str(response.content))['count'])
+        self.assertEqual(2, MessageItem.objects.filter(user=obara, deleted__isnull=False).count())
+        self.assertIsNone(MessageItem.objects.get(pk=other_mi.id).deleted)
+
+        # check no other user's message items were touched
+        self.assertEqual(0, MessageItem.objects.exclude(user=obara).filter(deleted__isnull=False).count())
+
+
 @pytest.fixture
 def lannisters():
     users = {}
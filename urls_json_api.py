@@ -2,6 +2,7 @@ from django.conf.urls import url
 
 from .views import partial_base, partial, search_recipient, send_message, send_notification, get_notifications
 from .views import mark_notification_read, get_inbox, get_unread_count, get_thread, get_reply_info, delete_message_item
+from .views import bulk_update_message_items, mark_all_notifications_read
 
 urlpatterns = [
     url(r'^partial/$', partial_base, name='partial_base'),
@@ -11,9 +12,11 @@ urlpatterns = [
     url(r'^send/notification/$', send_notification, name='send_notification'),
     url(r'^get/notifications/$', get_notifications, name='get_notifications'),
     url(r'^mark/notification/read/$', mark_notification_read, name='mark_notification_read'),
+    url(r'^mark/notifications/read/$', mark_all_notifications_read, name='mark_all_notifications_read'),
     url(r'^get/inbox/$', get_inbox, name='get_inbox'),
     url(r'^get/unread/count/$', get_unread_count, name='get_unread_count'),
     url(r'^get/thread/$', get_thread, name='get_thread'),
     url(r'^get/reply/info/$', get_reply_info, name='get_reply_info'),
     url(r'^delete/message/item/$', delete_message_item, name='delete_message_item'),
+    url(r'^bulk/update/message/items/$', bulk_update_message_items, name='bulk_update_message_items'),
 ]
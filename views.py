@@ -1,23 +1,21 @@
 import json
+import re
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
 from django.http.response import HttpResponseForbidden, HttpResponseRedirect, HttpResponse, Http404
 from django.shortcuts import render, get_object_or_404
-from django.template.defaultfilters import linebreaksbr
-from django.utils import timezone
-from django.utils.html import escape, strip_tags
+from django.utils import six, timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.html import strip_tags
 from django.utils.translation import gettext as _
 from django.utils.encoding import force_str
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 
-from vle.models import CourseKVStore, GroupKVStore
 from vle.decorators import basic_auth
-from .models import Message, MessageItem
-from .models import MessageTargetUser, MessageTargetGroup, MessageTargetCourse
-from .models import delimiter
+from .models import Message, MessageItem, ArchivedMessageItem, SentDisplayFormatter
 from .search import search
 
 
@@ -138,6 +136,10 @@ def send_notification(request):
     send a new notification to some users given by usernames
     can be invoked from curl on the command line with:
     curl -X POST http://localhost:8000/messaging/send/notification/ -u username:password -d '{"url": "http://foobar.com/blah", "subject": "my subject", "body": "my body"}'
+    an optional 'collapse_key' replaces each user's earlier notification with the same key (see Message.send_notification)
+    an optional 'expires' (an ISO 8601 datetime) stops the notification being shown after then
+    the notification can also be sent to the members of courses and groups, given by 'course_ids' (of vle_course_ids)
+    and 'group_ids' (of 'course::group' ids)
     """
 
     # get the data from the request
@@ -146,9 +148,28 @@ def send_notification(request):
     url = data.get('url', '')
     subject = data.get('subject', '')
     body = data.get('body', '')
+    collapse_key = data.get('collapse_key', '')
+    course_ids = data.get('course_ids', [])
+    group_ids = data.get('group_ids', [])
+
+    # parse the expiry (if given), which is in the current time zone unless it says otherwise
+    expires = None
+    if data.get('expires'):
+        try:
+            expires = parse_datetime(data['expires'])
+        except (TypeError, ValueError):
+            pass
+        if expires is None:
+            return HttpResponse(json.dumps({
+                'errorMessage': _('Invalid expiry'),
+                'type': 'error'
+            }), content_type='application/json', status=400)
+        if timezone.is_naive(expires):
+            expires = timezone.make_aware(expires, timezone.get_current_timezone())
 
     # 'send' (i.e. create) the notifications
-    Message.send_notification(usernames, url, subject, body)
+    Message.send_notification(
+        usernames, url, subject, body, collapse_key=collapse_key, expires=expires, course_ids=course_ids, group_ids=group_ids)
 
     # return JSON response
     return HttpResponse(json.dumps({
@@ -161,39 +182,56 @@ def send_notification(request):
 def get_notifications(request):
     """
     get notifications for the logged in user
+    if 'more' is given, gets one page of notifications older than the message item given by 'before' (if given),
+    along with whether there are more (instead of the total)
     """
 
     # get data from the request
     page = int(request.GET['page']) if 'page' in request.GET else 0
     per_page = int(request.GET['per_page']) if 'per_page' in request.GET else 10
+    before = int(request.GET['before']) if 'before' in request.GET else None
+
+    # get one page of notifications for the logged in user
+    # when paging by cursor, get one more item than asked for to determine whether there are more
+    if 'more' in request.GET:
+        try:
+            notifications = MessageItem.get_notifications_page(request.user, per_page + 1, before=before)
+        except MessageItem.DoesNotExist:
+            return _message_item_not_found()
+        more = len(notifications) > per_page
+        notifications = notifications[:per_page]
+    else:
+        (notifications, total) = MessageItem.get_notifications(request.user)
 
-    # get notifications for the logged in user
-    (notifications, total) = MessageItem.get_notifications(request.user)
-
-    # determine pagination parameters and use these to get one page of inbox items
-    offset = page * per_page
-    limit = offset + per_page
-    notifications = notifications[offset:limit]
+        # determine pagination parameters and use these to get one page of inbox items
+        offset = page * per_page
+        limit = offset + per_page
+        notifications = notifications[offset:limit]
 
-    # convert to a list of dictionaries
+    # convert to a list of dictionaries (formatting every sent datetime at once)
+    notifications = list(notifications)
+    sent = SentDisplayFormatter().format_all([mi.message.sent for mi in notifications])
     notifications = [
         {
             u'id': mi.id,
             u'subject': mi.message.subject,
-            u'body': mi.message.body,
+            u'body': mi.message.get_body(),
             u'url': mi.message.url,
-            u'sent': mi.message.get_sent_display(),
+            u'sent': sent[i],
             u'read': mi.read is not None,
         }
-        for mi in notifications
+        for (i, mi) in enumerate(notifications)
     ]
 
     # return JSON response
-    data = json.dumps({
+    data = {
         'notifications': notifications,
-        'total': total,
-    })
-    return HttpResponse(data, content_type='application/json')
+    }
+    if 'more' in request.GET:
+        data['more'] = more
+    else:
+        data['total'] = total
+    return HttpResponse(json.dumps(data), content_type='application/json')
 
 
 @login_required
@@ -222,11 +260,38 @@ def mark_notification_read(request):
     }), content_type='application/json')
 
 
+@login_required
+@require_http_methods(['POST'])
+def mark_all_notifications_read(request):
+    """
+    marks all of the logged in user's notifications as read, or if 'upto' is given only those no newer than the
+    message item given by 'upto' (e.g. the newest notification the user has seen)
+    """
+
+    # get data from the request
+    data = json.loads(force_str(request.body)) if request.body else {}
+    upto = int(data['upto']) if data.get('upto') is not None else None
+
+    # mark read (in one UPDATE), and count what's still unread
+    try:
+        (count, unread) = MessageItem.mark_all_notifications_read(request.user, upto=upto)
+    except MessageItem.DoesNotExist:
+        return _message_item_not_found()
+
+    # return JSON response
+    return HttpResponse(json.dumps({
+        'successMessage': _('Notifications marked as read successfully!'),
+        'count': count,
+        'unread': unread,
+    }), content_type='application/json')
+
+
 @login_required
 @require_http_methods(['GET'])
 def get_inbox(request):
     """
     get threads that comprise the logged in user's inbox
+    if 'archived' is given, archived threads are included too
     """
 
     # get data from the request
@@ -234,34 +299,43 @@ def get_inbox(request):
     per_page = int(request.GET['per_page']) if 'per_page' in request.GET else 10
     sort_field = request.GET['sort_field'] if 'sort_field' in request.GET else 'date'
     sort_dir = request.GET['sort_dir'] if 'sort_dir' in request.GET else 'desc'
+    include_archived = 'archived' in request.GET
 
-    # get inbox for the logged in user
-    (inbox, total) = MessageItem.get_inbox(request.user, sort_field, sort_dir)
+    # determine pagination parameters and use these to get one page of the logged in user's inbox
+    # (the archive tables are only consulted when asked to, in which case the archived inbox is merged in)
+    (inbox_page, total) = MessageItem.get_inbox_page(
+        request.user, sort_field, sort_dir, offset=page * per_page, limit=per_page, include_archived=include_archived
+    )
 
-    # determine pagination parameters and use these to get one page of inbox items
-    offset = page * per_page
-    limit = offset + per_page
-    inbox_page = inbox[offset:limit]
-
-    # get message tree ids for each thread in the inbox page
-    tree_ids = [mi.message.tree_id for mi in inbox_page]
+    # get message tree ids for each thread in the inbox page (tree ids of hot and archived threads may coincide)
+    tree_ids = [mi.message.tree_id for mi in inbox_page if not isinstance(mi, ArchivedMessageItem)]
+    archived_tree_ids = [mi.message.tree_id for mi in inbox_page if isinstance(mi, ArchivedMessageItem)]
 
     # get counts of undeleted message items and unread message items in each thread in the inbox page
+    # archived threads are read-only (getting one doesn't mark it as read), so archived message items count as read
     undeleted_dict = MessageItem.get_undeleted_message_item_count_for_message_trees(request.user, tree_ids)
     unread_dict = MessageItem.get_unread_message_item_count_for_message_trees(request.user, tree_ids)
-
-    # convert inbox page to a list of dictionaries
-    messages = [
-        {
+    archived_undeleted_dict = MessageItem.get_undeleted_message_item_count_for_message_trees(
+        request.user, archived_tree_ids, archived=True
+    )
+
+    # convert inbox page to a list of dictionaries (formatting every sent datetime at once)
+    sent = SentDisplayFormatter().format_all([mi.message.sent for mi in inbox_page])
+    messages = []
+    for (i, mi) in enumerate(inbox_page):
+        archived = isinstance(mi, ArchivedMessageItem)
+        counts = (archived_undeleted_dict, {}) if archived else (undeleted_dict, unread_dict)
+        message = {
             u'id': mi.id,
             u'sender': ' '.join([mi.message.user.first_name, mi.message.user.last_name]),
             u'subject': mi.message.subject,
-            u'sent': mi.message.get_sent_display(),
-            u'count': 0 if mi.message.tree_id not in undeleted_dict else undeleted_dict[mi.message.tree_id],
-            u'unread': 0 if mi.message.tree_id not in unread_dict else unread_dict[mi.message.tree_id],
+            u'sent': sent[i],
+            u'count': counts[0].get(mi.message.tree_id, 0),
+            u'unread': counts[1].get(mi.message.tree_id, 0),
         }
-        for mi in inbox_page
-    ]
+        if include_archived:
+            message[u'archived'] = archived
+        messages.append(message)
 
     # return JSON response
     data = json.dumps({
@@ -282,7 +356,7 @@ def get_unread_count(request):
     notifications = 'n' in request.GET
 
     # count the number of unread (and undeleted) items
-    count = MessageItem.objects.filter(message__is_notification=notifications, user=request.user, read=None, deleted=None).count()
+    count = MessageItem.get_unread_count(request.user, notifications=notifications)
 
     # return JSON response
     data = json.dumps({
@@ -296,45 +370,65 @@ def get_unread_count(request):
 def get_thread(request):
     """
     given a message item in a thread, gets the entire corresponding thread
+    if 'per_page' is given, gets only one page of the thread, optionally older than the message item given by 'before'
+    or newer than the message item given by 'since'
+    if 'archived' is given, the message item is looked up in the archive (archived threads aren't marked as read)
     """
 
     # get data from the request
     miid = int(request.GET['miid']) if 'miid' in request.GET else 0
+    per_page = int(request.GET['per_page']) if 'per_page' in request.GET else None
+    before = int(request.GET['before']) if 'before' in request.GET else None
+    since = int(request.GET['since']) if 'since' in request.GET else None
+    archived = 'archived' in request.GET
 
     # get MessageItem and Message from miid
-    (mi, m, response) = _get_message_item_and_message(request.user, miid)
+    (mi, m, response) = _get_message_item_and_message(request.user, miid, archived=archived)
     if response:
         return response
 
     # store the original subject
     original_subject = mi.message.subject
 
-    # get thread
-    (thread, total) = mi.get_thread()
-
-    # convert thread to a list of dictionaries
+    # get thread (evaluated once, since it's both serialised and marked as read below)
+    # when paginating, get one more item than asked for to determine whether there are more
+    limit = None if per_page is None else per_page + 1
+    try:
+        (thread, total) = mi.get_thread(limit=limit, before=before, since=since)
+    except (MessageItem.DoesNotExist, ArchivedMessageItem.DoesNotExist):
+        return _message_item_not_found()
+    thread = list(thread)
+    more = limit is not None and len(thread) == limit
+    if more:
+        thread = thread[1:] if since is not None else thread[:-1]
+
+    # convert thread to a list of dictionaries (formatting every sent datetime at once)
+    sent = SentDisplayFormatter().format_all([mi.message.sent for mi in thread])
     messages = [
         {
             u'id': mi.id,
             u'sender': ' '.join([mi.message.user.first_name, mi.message.user.last_name]),
             u'subject': mi.message.subject,
-            u'body': linebreaksbr(escape(mi.message.body)),
-            u'sent': mi.message.get_sent_display(),
+            u'body': mi.message.get_body_html(),
+            u'sent': sent[i],
             u'read': mi.read is not None,
         }
-        for mi in thread
+        for (i, mi) in enumerate(thread)
     ]
 
-    # mark thread as read
-    MessageItem.mark_all_read(thread)
+    # mark thread as read (archived threads are read-only)
+    if not archived:
+        MessageItem.mark_all_read(thread)
 
     # return JSON response
-    data = json.dumps({
+    data = {
         'subject': original_subject,
         'messages': messages,
         'total': total,
-    })
-    return HttpResponse(data, content_type='application/json')
+    }
+    if per_page is not None:
+        data['more'] = more
+    return HttpResponse(json.dumps(data), content_type='application/json')
 
 
 @login_required
@@ -353,38 +447,15 @@ def get_reply_info(request):
     if response:
         return response
 
-    # get list of user, group and course recipients
+    # get list of user, group and course recipients (the sender first, and never the logged in user)
     recipients = [{
         u'name': u' '.join([m.user.first_name, m.user.last_name]),
         u'id': m.user.pk,
         u'type': u'u'
     }]
     recipients.extend([
-        {
-            u'name': u' '.join([tu.user.first_name, tu.user.last_name]),
-            u'id': tu.user.pk,
-            u'type': u'u'
-        }
-        for tu in MessageTargetUser.objects.filter(message=m).order_by('user__id')
-        if tu.user.id != m.user.id and tu.user.id != request.user.id
-    ])
-    recipients.extend([
-        {
-            u'name': GroupKVStore.objects.get(vle_course_id=tg.vle_course_id, vle_group_id=tg.vle_group_id).name,
-            u'id': delimiter.join([tg.vle_course_id, tg.vle_group_id]),
-            u'type': u'g'
-        }
-        for tg in MessageTargetGroup.objects.filter(message=m).order_by('id')
-        if GroupKVStore.objects.filter(vle_course_id=tg.vle_course_id, vle_group_id=tg.vle_group_id).exists()
-    ])
-    recipients.extend([
-        {
-            u'name': CourseKVStore.objects.get(vle_course_id=tc.vle_course_id).name,
-            u'id': tc.vle_course_id,
-            u'type': u'c'
-        }
-        for tc in MessageTargetCourse.objects.filter(message=m).order_by('id')
-        if CourseKVStore.objects.filter(vle_course_id=tc.vle_course_id).exists()
+        r for r in m.get_target_recipients()
+        if r[u'type'] != u'u' or r[u'id'] not in (m.user.id, request.user.id)
     ])
 
     # return JSON response
@@ -392,7 +463,7 @@ def get_reply_info(request):
         'sender': ' '.join([m.user.first_name, m.user.last_name]),
         'recipients': recipients,
         'subject': m.subject,
-        'body': linebreaksbr(escape(m.body))
+        'body': m.get_body_html()
     })
     return HttpResponse(data, content_type='application/json')
 
@@ -415,11 +486,9 @@ def delete_message_item(request):
 
     # mark the message item, or the entire thread, as deleted
     if thread:
-        messages = Message.objects.filter(is_notification=False, tree_id=m.tree_id)
-        message_items = MessageItem.objects.filter(user=request.user, deleted__isnull=True, message__in=messages)
+        MessageItem.mark_thread_deleted(request.user, m.tree_id)
     else:
-        message_items = [mi]
-    MessageItem.mark_all_deleted(message_items)
+        MessageItem.mark_all_deleted([mi])
 
     # determine whether the message is a notification
     entity = 'Notification' if m.is_notification else 'Message'
@@ -430,31 +499,111 @@ def delete_message_item(request):
     }), content_type='application/json')
 
 
-def _get_message_item_and_message(user, miid):
+@login_required
+@require_http_methods(['POST'])
+def bulk_update_message_items(request):
+    """
+    marks many message items as read, unread or deleted at once
+    'miids' are message items to update and 'threads' are message items whose entire threads to update
+    ownership of every given message item is checked with a single query before anything is updated
+    """
+
+    # get the data from the request
+    data = json.loads(force_str(request.body))
+    action = data.get('action', '')
+
+    # ensure the action is valid
+    if action not in ('read', 'unread', 'delete'):
+        return HttpResponse(json.dumps({
+            'errorMessage': _('Invalid action'),
+            'type': 'error'
+        }), content_type='application/json', status=400)
+
+    # ensure the message item ids are lists of integers
+    miids = _get_ids(data.get('miids', []))
+    threads = _get_ids(data.get('threads', []))
+    if miids is None or threads is None:
+        return HttpResponse(json.dumps({
+            'errorMessage': _('Invalid message item ids'),
+            'type': 'error'
+        }), content_type='application/json', status=400)
+
+    # ensure every MessageItem exists and is owned by the logged in user
+    owners = {
+        t[0]: (t[1], t[2])
+        for t in MessageItem.objects.filter(pk__in=miids | threads).values_list('id', 'user_id', 'message__tree_id')
+    }
+    if len(owners) != len(miids | threads):
+        return _message_item_not_found()
+    if any(p[0] != request.user.id for p in owners.values()):
+        return _access_denied()
+
+    # update the message items and the message items in the threads
+    tree_ids = set(owners[miid][1] for miid in threads)
+    count = MessageItem.bulk_mark(request.user, action, message_item_ids=list(miids), tree_ids=list(tree_ids))
+
+    # return JSON response
+    return HttpResponse(json.dumps({
+        'successMessage': _('Messages updated!'),
+        'count': count,
+    }), content_type='application/json')
+
+
+def _get_message_item_and_message(user, miid, archived=False):
     """
     given a user and a MessageItem id, gets a MessageItem and its corresponding Message
+    (or, if archived, an ArchivedMessageItem and its corresponding ArchivedMessage)
     if a MessageItem doesn't exist with the given miid, returns a 404
     if a MessageItem does exist, but is not owned by the given user, returns a 403
     """
 
     # ensure MessageItem exists
+    model = ArchivedMessageItem if archived else MessageItem
     try:
-        mi = MessageItem.objects.get(id=miid)
-    except MessageItem.DoesNotExist:
-        response = HttpResponse(json.dumps({
-            'errorMessage': _('Message item not found'),
-            'type': 'warning'
-        }), content_type='application/json', status=404)
-        return None, None, response
+        mi = model.objects.get(id=miid)
+    except model.DoesNotExist:
+        return None, None, _message_item_not_found()
 
     # ensure MessageItem is owned by the given user
+    if archived:
+        return (mi, mi.message, None) if mi.user_id == user.id else (mi, None, _access_denied())
     try:
         m = Message.objects.get(messageitem__id=miid, messageitem__user=user)
     except Message.DoesNotExist:
-        response = HttpResponse(json.dumps({
-            'errorMessage': _('Access denied'),
-            'type': 'error'
-        }), content_type='application/json', status=403)
-        return mi, None, response
+        return mi, None, _access_denied()
 
     return mi, m, None
+
+
+def _get_ids(ids):
+    """
+    gets a set of the given ids (from JSON), or None unless they're a list of integers (or strings of digits)
+    """
+    if not isinstance(ids, list):
+        return None
+    for _id in ids:
+        if isinstance(_id, bool) or not isinstance(_id, six.integer_types + six.string_types):
+            return None
+        if isinstance(_id, six.string_types) and not re.match(r'[0-9]+\Z', _id):
+            return None
+    return set(map(int, ids))
+
+
+def _message_item_not_found():
+    """
+    returns a 404 JSON response for a MessageItem that doesn't exist (or isn't owned by the logged in user)
+    """
+    return HttpResponse(json.dumps({
+        'errorMessage': _('Message item not found'),
+        'type': 'warning'
+    }), content_type='application/json', status=404)
+
+
+def _access_denied():
+    """
+    returns a 403 JSON response for a MessageItem that isn't owned by the logged in user
+    """
+    return HttpResponse(json.dumps({
+        'errorMessage': _('Access denied'),
+        'type': 'error'
+    }), content_type='application/json', status=403)